@@ -0,0 +1,203 @@
+"""
+End-to-end throughput and latency benchmark for crunchy.
+
+This builds synthetic directory trees of configurable size and depth, runs crunchy on them (using crunchy.init, add,
+run and complete) with a trivial workflow and reports:
+
+ - discovery latency: time between an entry being written (i.e. becoming stable) and its job being queued.
+ - queue wait: time between a job being queued and a worker starting it.
+ - job time: time taken by a worker to run each job, and the overhead (job time minus the requested work).
+ - throughput: jobs per second (from the first job being queued to the last one finishing) for each number of
+   worker threads.
+ - scout and control thread CPU time (Linux only).
+
+Results are written to a JSON file. Passing the results of a previous run with --baseline reports (and fails on)
+regressions, e.g. before deploying a new version:
+
+    python benchmarks/pipeline.py --files 1000 --depth 2 --threads 1 2 4 --output new.json --baseline old.json
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import platform
+from tempfile import mkdtemp
+from pathlib import Path
+import numpy as np
+
+import crunchy
+from crunchy.base.trigger import fileTrigger, init
+import crunchy.base.trigger as trigger
+from crunchy.base.ledger import Ledger
+
+crunchy.workflow_settings = dict(
+    depth = dict(type='int', value=1, min=0, max=10, desc='depth of the synthetic entries in the input directory.'),
+    work = dict(type='float', value=0.0, min=0.0, max=10.0, desc='time (seconds) that each job sleeps for.'),
+)
+
+@init
+def setup( indir, outdir, settings ):
+    crunchy.add( path=indir, depth=settings['depth'], clear=True )
+    return True
+
+def work( data, outpath, settings ):
+    if settings['work'] > 0:
+        time.sleep( settings['work'] )
+
+@fileTrigger( flow=[work], vb=0 )
+def bench( data, outpath, settings ):
+    return trigger.PROCESS, outpath
+
+def build( path, nfiles, depth, size, branch=10 ):
+    """
+    Write nfiles synthetic entries (directories containing a single file of the specified size) at the specified
+    depth. Returns a dictionary containing the time each entry was finished writing.
+    """
+    created = {}
+    payload = os.urandom(size)
+    for i in range(nfiles):
+        parts = ['l%d_%d' % (l, (i // branch ** l) % branch) for l in range(depth)]
+        entry = Path(path, *parts, 'entry%d' % i)
+        os.makedirs(entry, exist_ok=True)
+        with open(entry / 'data.bin', 'wb') as f:
+            f.write(payload)
+        created[str(entry)] = time.time()
+    return created
+
+def cputime( pid ):
+    """
+    Return the (user + system) CPU time of a process in seconds, or None if this cannot be determined.
+    """
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def summarise( values ):
+    values = np.array( [v for v in values if v is not None] )
+    if len(values) == 0:
+        return None
+    return dict(mean=float(np.mean(values)), p50=float(np.percentile(values, 50)),
+                p95=float(np.percentile(values, 95)), max=float(np.max(values)))
+
+def run( nthreads, args ):
+    """
+    Run the benchmark once with the specified number of worker threads.
+    """
+    base = Path( mkdtemp() )
+    try:
+        crunchy.crunchy_settings['inpath']['value'] = base / 'in'
+        crunchy.crunchy_settings['outpath']['value'] = base / 'out'
+        crunchy.crunchy_settings['wait']['value'] = args.wait
+        crunchy.crunchy_settings['idle']['value'] = args.idle
+        crunchy.crunchy_settings['backend']['value'] = args.backend
+        crunchy.crunchy_settings['ledger']['value'] = True
+        crunchy.workflow_settings['depth']['value'] = args.depth
+        crunchy.workflow_settings['work']['value'] = args.work
+        os.makedirs(base / 'in', exist_ok=True)
+
+        crunchy.init( nthreads )
+        crunchy.run()
+        time.sleep( 1.0 ) # give the scout time to start
+        created = build( base / 'in', args.files, args.depth, args.size )
+
+        start = time.time()
+        while len(crunchy.getProgress(2)) + len(crunchy.getProgress(-1)) < args.files:
+            if time.time() - start > args.timeout:
+                print("Warning: timed out waiting for jobs to finish.")
+                break
+            time.sleep(0.1)
+        scout_cpu = cputime( crunchy.scoutthread.pid )
+        control_cpu = cputime( crunchy.crunchthread.pid )
+        crunchy.complete()
+
+        ledger = Ledger( crunchy.getLedgerPath( base / 'out' ) )
+        jobs = [j for j in ledger.jobs() if j['path'] in created]
+        ledger.close()
+        finished = [j for j in jobs if j['finished'] is not None]
+        job_time = [j['finished'] - j['started'] for j in finished]
+        out = dict(
+            nthreads=nthreads,
+            jobs=len(jobs),
+            failed=len([j for j in jobs if j['status'] == -1]),
+            discovery_latency=summarise([j['queued'] - created[j['path']] for j in jobs]),
+            queue_wait=summarise([j['started'] - j['queued'] for j in finished]),
+            job_time=summarise(job_time),
+            overhead=summarise([t - args.work for t in job_time]),
+            scout_cpu=scout_cpu,
+            control_cpu=control_cpu,
+        )
+        if len(finished) > 0:
+            span = max([j['finished'] for j in finished]) - min([j['queued'] for j in finished])
+            out['throughput'] = len(finished) / max(span, 1e-6)
+        return out
+    finally:
+        shutil.rmtree( base, ignore_errors=True )
+
+def compare( results, baseline, tolerance ):
+    """
+    Compare results to a baseline and return a list of regressions (larger than tolerance, as a fraction).
+    """
+    out = []
+    old = {r['nthreads']: r for r in baseline['runs']}
+    for r in results['runs']:
+        b = old.get(r['nthreads'])
+        if b is None:
+            continue
+        if r.get('throughput') and b.get('throughput') and r['throughput'] < b['throughput'] * (1 - tolerance):
+            out.append("nthreads=%d: throughput dropped from %.1f to %.1f jobs/s" %
+                       (r['nthreads'], b['throughput'], r['throughput']))
+        for k in ['discovery_latency', 'queue_wait', 'overhead']:
+            if r.get(k) and b.get(k) and r[k]['p95'] > b[k]['p95'] * (1 + tolerance) + 1e-3:
+                out.append("nthreads=%d: p95 %s increased from %.4f to %.4f s" %
+                           (r['nthreads'], k, b[k]['p95'], r[k]['p95']))
+    return out
+
+def version():
+    try:
+        from importlib.metadata import version
+        return version('crunchy')
+    except Exception:
+        return 'unknown'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark crunchy pipelines on synthetic data.')
+    parser.add_argument('--files', type=int, default=200, help='number of entries to create.')
+    parser.add_argument('--depth', type=int, default=1, help='depth of entries within the input directory.')
+    parser.add_argument('--size', type=int, default=1024, help='size (bytes) of each entry.')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4], help='numbers of workers to test.')
+    parser.add_argument('--work', type=float, default=0.0, help='time (seconds) each job sleeps for.')
+    parser.add_argument('--wait', type=int, default=1, help='crunchy wait setting.')
+    parser.add_argument('--idle', type=float, default=0.1, help='crunchy idle setting.')
+    parser.add_argument('--backend', default='poll', choices=['poll', 'inotify'], help='scout backend.')
+    parser.add_argument('--timeout', type=float, default=600.0, help='maximum time (seconds) per run.')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file to write results to.')
+    parser.add_argument('--baseline', default=None, help='JSON results of a previous run to compare to.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change considered a regression.')
+    args = parser.parse_args()
+
+    crunchy.debug = False # don't print logs to console
+    results = dict(version=version(), python=sys.version.split()[0], platform=platform.platform(),
+                   cpus=os.cpu_count(), time=time.time(), config=vars(args), runs=[])
+    for n in args.threads:
+        r = run( n, args )
+        results['runs'].append( r )
+        print("nthreads=%d: %.1f jobs/s, discovery p50 %.3f s, queue wait p50 %.3f s, overhead p50 %.4f s" %
+              (n, r.get('throughput', 0), (r['discovery_latency'] or {}).get('p50', np.nan),
+               (r['queue_wait'] or {}).get('p50', np.nan), (r['overhead'] or {}).get('p50', np.nan)))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("Results written to %s" % args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare( results, json.load(f), args.tolerance )
+        for r in regressions:
+            print("REGRESSION: %s" % r)
+        if len(regressions) > 0:
+            sys.exit(1)
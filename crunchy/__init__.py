@@ -1,7 +1,20 @@
 import sys,os
+
+# numerical libraries (e.g. BLAS) use one thread per worker unless a job asks for more (see _limitThreads()).
+# N.B. these are only read when the libraries are loaded, so must be set before numpy is imported.
+for _v in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS']:
+    os.environ.setdefault(_v, '1')
+
 from pathlib import Path
 # from multiprocessing import Process, Queue, Manager, Value
-from multiprocess import Process, Queue, Manager, Value
+from multiprocess import Process, Queue, Manager, Value, Array, Event, Condition
+from queue import Empty
+from collections import deque
+from itertools import islice
+from concurrent.futures import Future
+from types import SimpleNamespace
+import traceback
+import threading
 import time
 from datetime import datetime
 
@@ -13,35 +26,83 @@ crunchy_settings = dict(
     inpath = dict(type='path', value='CrunchyIn', mustexist=True ),
     outpath = dict(type='path', value='CrunchyOut', mustexist=False),
     nthreads = dict(type='int', value=2, min=1, max=os.cpu_count()-1),
+    autoscale = dict(type='bool', value=False),
+    minthreads = dict(type='int', value=1, min=1, max=os.cpu_count()),
+    maxthreads = dict(type='int', value=max(1, os.cpu_count()-1), min=1, max=os.cpu_count()),
+    scaletime = dict(type='int', value=60, min=1, max=86400),
+    memorymb = dict(type='int', value=0, min=0, max=1024*1024*1024),
+    cores = dict(type='int', value=os.cpu_count(), min=1, max=1024*1024),
     wait = dict(type='int', value=5, min=1, max=100),
     idle = dict(type='float', value=1.0, min=0.0, max=100.0),
+    backend = dict(type='select', value='poll', options=['poll', 'inotify']),
+    ledger = dict(type='bool', value=False),
+    sharedmb = dict(type='int', value=1024, min=0, max=1024*1024),
+    maxqueue = dict(type='int', value=1000, min=1, max=1000000),
+    history = dict(type='int', value=10000, min=0, max=10000000),
+    maxartefacts = dict(type='int', value=10000, min=0, max=10000000),
+    loglines = dict(type='int', value=1000, min=10, max=1000000),
 )
 workflow_settings = { } # settings that are exposed to the GUI by the workflow for customisable settings.
 dashboard = None # html template that is exposed to the GUI by the workflow for visualisation.
 
 # once resolved, this will be a dictionary containing the settings used by crunchy.
 settings = None
+settings_version = None # incremented whenever settings are changed using updateSettings()
 
 # these public variables all control message passing and the worker threads
-block = None
+active = None # event that is set while workers are allowed to take jobs from the queue (i.e. not paused)
 endwhenempty = None
 queue = None
+results = None # queue that records of completed jobs are sent back through
+returns = None # queue that the control thread sends the records of jobs submitted by the main thread back through
+pending = None # the number of jobs that have been submitted but whose records have not yet been collected
+done = None # condition notified whenever a job record is collected
+capacity = None # the number of jobs the control thread can pass to the worker queue at once (one per worker)
+jobtime = None # moving average of the duration of completed jobs (used to scale the worker pool)
+autoscaler = None # thread that resizes the worker pool while crunchy is running (see base.autoscale)
+scheduler = None # orders jobs submitted in the control thread by priority and fair share (see base.scheduler)
 manager = None
 workers = None
 setup = {} # links to workflow setup functions
-entries = {} # links to workflow file filters
+entries = {} # links to workflow file filters (and job triggers, which have an 'after' attribute)
 finalize = {} # links to workflow finish functions
+workerinit = {} # links to workflow functions that initialise each worker thread
+worker_state = None # (pid, state) persistent state of the worker running in this thread (see getWorkerState())
 scoutdirs={}
 scoutthread = None
 crunchthread = None
 prog = None # dict storing a list of files being crunched. True if these have been passed to worker, False if they are queued.
-logdict = None
-file_size_dict = None
-known_files = None
-new_files = None
+logdict = None # LogBook that collects log messages from all threads (see base.logs)
+known_files = None # files that have been passed to the workflow (and their size). Updated once per batch of new files.
+scoutqueue = None # batches of new files (one dictionary per scout pass) sent from the scout to the control thread.
+scoutinbox = None # lists of files that the scout should forget (e.g. because a trigger wants to see them again).
+scoutstats = None # number of files monitored / known by the scout. Updated once per scout pass.
+ledger = None # (pid, {thread: Ledger}) used by this process to record workflow progress (if enabled; see getLedger()).
+arraystore = None # shared store for passing arrays between workflow steps and threads (see getArrayStore()).
+artefacts = None # (path, finished, trigger, key) of the most recent output files of completed jobs (see getArtefacts())
+artefacts_version = None # the number of artefacts ever added to the index (N.B. the oldest are removed from artefacts)
+deadletters = None # jobs that failed (after all retries), keyed by job id (see getDeadLetters())
+watchdog = None # thread that replaces dead workers (see base.watchdog)
+worker_slot = None # (submitter pid, job number, deadline) of the job run by this worker (see _start())
+coordinator = None # lends jobs to remote workers connected over TCP (see listen())
+remote = None # connection to the coordinator used by remote workers (see connect())
 
 debug = True # true if log should be printed straight to console. N.B this is not shared across threads!
 
+_futures = {} # futures for jobs submitted by this thread (keys are job ids)
+_jobcount = 0 # number of jobs submitted by this thread (used to create job ids)
+_dispatched = {} # jobs passed to the worker queue (keys are job ids) whose records have not yet been collected
+_blocked = [] # records of blocking jobs run by this thread that have not yet been collected (see submit())
+_parent = None # pid of the main thread, in the control thread (see collect())
+_retries = [] # (time, job) of failed jobs waiting to be retried (see _retry())
+_deadline = 0 # time by which the job running in this worker must finish (0 if it has no time limit)
+_hostmb = None # total memory of this host (see _admit())
+_threads = None # (pid, n) number of threads that numerical libraries are limited to in this thread (see _execute())
+_completed = deque() # paths of completed jobs (oldest first), used to limit the size of prog
+_snapshot = None # read-only copy of settings used by this thread (see getSettings())
+_artefact_cache = dict(version=0, items={}, queries={}) # copy of the artefact index kept by this process
+_artefact_lock = threading.Lock() # N.B. the copy is shared by e.g. the threads of the Flask app
+
 ###################################################################################
 ## Getters: used for getting the above attributes. These are needed by decorators.
 ###################################################################################
@@ -49,13 +110,175 @@ def getQueue():
     return queue
 
 def getLogDict():
+    """
+    Return the log of this thread, which can be passed to crunchy.log(...). In the main thread this can also be used
+    to read the (most recent) log messages of each thread; see crunchy.base.logs.LogBook.
+    """
     return logdict
 
+def getSettings():
+    """
+    Return a read-only copy of the current settings. This is cached by each thread and only refreshed when the settings
+    are changed (using updateSettings()), so that jobs can read settings without querying the shared dictionary.
+
+    :return: A crunchy.base.config.Settings object (this behaves like a dictionary that cannot be modified).
+    """
+    global _snapshot
+    from .base.config import Settings
+    version = settings_version.value if settings_version is not None else 0
+    if _snapshot is None or _snapshot[0] != os.getpid() or _snapshot[1].version != version:
+        _snapshot = (os.getpid(), Settings(settings.copy() if settings is not None else {}, version))
+    return _snapshot[1]
+
+def updateSettings( values=None, **kwargs ):
+    """
+    Change one or more settings. These changes are visible to all threads (including jobs that start after this is
+    called). For example: crunchy.updateSettings(workflow_stage=2).
+
+    :param values: a dictionary of settings to change. Default is None.
+    :param kwargs: further settings to change can also be passed as keyword arguments.
+    """
+    values = dict(values or {}, **kwargs)
+    settings.update(values)
+    if settings_version is not None:
+        with settings_version.get_lock():
+            settings_version.value += 1
+    if remote is not None: # remote workers also send changes to the coordinator (and so all other workers)
+        remote.send(('SET', values))
+
+def getWorkerState():
+    """
+    Return the persistent state object of the worker running in this thread. This is created (by running all
+    functions registered with the @workerInit decorator) the first time it is needed in each thread, and then
+    kept for all subsequent jobs. It can be used by workflow functions to avoid repeating expensive setup (e.g.
+    loading reference data or models) for every job.
+
+    :return: A types.SimpleNamespace containing the attributes defined by workerInit functions.
+    """
+    global worker_state
+    if worker_state is None or worker_state[0] != os.getpid():
+        state = SimpleNamespace()
+        worker_state = (os.getpid(), state)
+        for k, v in workerinit.items():
+            try:
+                v(state, getSettings())
+            except BaseException as E:
+                err = "".join(traceback.format_exception(type(E), E, E.__traceback__))
+                if logdict is not None:
+                    log("Error initialising worker with %s:\n %s\n" % (k, err), logdict)
+                else: # e.g. called before init()
+                    print("Error initialising worker with %s:\n %s\n" % (k, err))
+    return worker_state[1]
+
+def getArrayStore():
+    """
+    Return the shared array store, which can be used to pass (large) numpy arrays between workflow steps and
+    worker threads without copying them. See crunchy.base.shared.ArrayStore.
+    """
+    return arraystore
+
+def getArtefacts( pattern=None ):
+    """
+    Return the output files produced by completed jobs (i.e. that workflow functions added to data['outputs']), in
+    the order they were (last) produced. This can be used by e.g. dashboards to find results without searching the
+    output directory. Each process keeps a copy of the index and only fetches the artefacts added since it last looked.
+    Only the most recent crunchy_settings['maxartefacts'] artefacts are kept (and, if the ledger is enabled, restored
+    when crunchy is restarted).
+
+    :param pattern: a glob-style pattern (e.g. '*/comp.image.png') that paths must match. Default is None (return all).
+    :return: a list of file paths.
+    """
+    from fnmatch import fnmatch
+    if artefacts is None:
+        return []
+    with _artefact_lock:
+        items, queries = _artefact_cache['items'], _artefact_cache['queries']
+        with artefacts_version.get_lock(): # N.B. so the index does not change while we read it
+            total = artefacts_version.value
+            if total < _artefact_cache['version']: # a new index (e.g. crunchy was restarted)
+                items.clear()
+                queries.clear()
+                _artefact_cache['version'] = 0
+            n = total - _artefact_cache['version']
+            new = artefacts[-n:] if n > 0 else [] # N.B. only the artefacts added since we last looked
+            _artefact_cache['version'] = total
+        for p, *_ in new: # N.B. dictionaries keep the order paths were (last) added in
+            items.pop(p, None)
+            items[p] = True
+            for q, matches in queries.items():
+                matches.pop(p, None)
+                if fnmatch(p, q):
+                    matches[p] = True
+        limit = int(getSettings().get('maxartefacts', len(items)))
+        while len(items) > limit: # forget the oldest
+            p = next(iter(items))
+            del items[p]
+            for matches in queries.values():
+                matches.pop(p, None)
+        if pattern is None:
+            return list(items)
+        if pattern not in queries:
+            queries[pattern] = {p: True for p in items if fnmatch(p, pattern)}
+        return list(queries[pattern])
+
+def addArtefacts( records ):
+    """
+    Add the outputs of completed jobs to the artefact index (see getArtefacts()), and record them in the ledger (if
+    enabled).
+
+    :param records: a list of job records (see collect()).
+    """
+    new = []
+    for r in records:
+        if r['error'] is None and isinstance(r['result'], dict):
+            key = r['result'].get('key', None)
+            for o in r['result'].get('outputs', []):
+                new.append((str(o), r['finished'], r['trigger'], None if key is None else str(key)))
+    if len(new) > 0 and artefacts is not None:
+        _indexArtefacts(new)
+        l = getLedger()
+        if l is not None:
+            l.produced(new)
+
+def _indexArtefacts( new ):
+    """
+    Append (path, finished, trigger, key) tuples to the shared artefact index, removing the oldest once it holds
+    more than crunchy_settings['maxartefacts'].
+    """
+    limit = int(getSettings().get('maxartefacts', 10000))
+    with artefacts_version.get_lock():
+        artefacts.extend(new) # N.B. one message per batch of records
+        n = len(artefacts) - limit
+        if n > 0:
+            del artefacts[:n]
+        artefacts_version.value += len(new)
+
+def getScoutStats():
+    """
+    Return a dictionary containing the number of files being monitored by the scout (monitored), that are
+    known and unchanged (known) and that have been found but are waiting for the job queue to have space before
+    being passed to the workflow (backlog).
+    """
+    out = dict(monitored=0, known=0, backlog=0)
+    if scoutstats is not None:
+        out.update(scoutstats.copy())
+    return out
+
+def getDeadLetters():
+    """
+    Return a list of jobs that failed (or timed out) and were not retried, or failed on every retry (oldest first). Each
+    is a dictionary containing the path and trigger of the job, the number of attempts made, the time it last
+    failed (finished) and the error.
+    """
+    if deadletters is None:
+        return []
+    return sorted(deadletters.values(), key=lambda d: d['finished'])
+
 def getProgress( status=0 ):
     """
     Return a list containing the file paths at the specified status.
 
-    :param status: the file status to return. 0 is queued, 1 is running, 2 is completed.
+    :param status: the file status to return. 0 is queued, 1 is running, 2 is completed and -1 is failed.
     :return: A list of file paths.
     """
     out = []
@@ -64,18 +287,68 @@ def getProgress( status=0 ):
             out.append(k)
     return out
 
+def setProgress( path, status, record=None ):
+    """
+    Update the status of a job (and record it in the ledger, if enabled).
+
+    :param path: the file path that triggered the job.
+    :param status: the job status. 0 is queued, 1 is running, 2 is completed and -1 is failed.
+    :param record: the job record (see collect()) of a finished job, used to store the time it started and
+                   finished (on the worker) in the ledger. Default is None.
+    """
+    prog[path] = status
+    l = getLedger()
+    if l is not None:
+        if record is not None:
+            l.finished(record)
+        else:
+            l.job(path, status)
+
+def getLedger():
+    """
+    Return the ledger used to persistently store workflow progress in the output directory, or None if
+    the ledger is disabled (see crunchy_settings['ledger']). N.B. each process (and thread within it, e.g. see
+    _receive()) opens its own connection to the ledger.
+    """
+    global ledger
+    import threading
+    owner = (os.getpid(), threading.get_ident())
+    if ledger is None or ledger[0] != owner[0]:
+        ledger = (owner[0], {})
+    if ledger[1] is None: # disabled in this process (e.g. remote workers)
+        return None
+    if owner[1] not in ledger[1]:
+        l = None
+        s = getSettings()
+        if s.get('ledger', False) and s.get('outpath', None) is not None:
+            from .base.ledger import Ledger
+            l = Ledger(getLedgerPath(s['outpath']))
+        ledger[1][owner[1]] = l
+    return ledger[1][owner[1]]
+
+def getLedgerPath( outpath ):
+    """
+    Return the path of the ledger file used for the specified output directory.
+    """
+    return Path(outpath) / '.crunchy' / 'ledger.sqlite'
+
 def printLog():
     for k,v in logdict.items():
         print("Thread %s" % k)
         print(v)
 
+def getLogPath( outpath ):
+    """
+    Return the path of the (rotating) log file written in the specified output directory.
+    """
+    return Path(outpath) / '.crunchy' / 'crunchy.log'
+
 def log( message, logdict, master=False ):
     """
     Add a message to the log for the thread (based on PID) calling this function.
     :param message:  The message to add to the log.
-    :param logdict: The (threadsafe) logging dictionary to log to. Use crunchy.getLogDict().
-    :param master: True if this message should be added to the master log rather than the worker thread log.
-                    N.B. master logging may not be threadsafe, so avoid calling often!
+    :param logdict: The log to write to. Use crunchy.getLogDict().
+    :param master: True if this message should be added to the master log as well as the worker thread log.
     """
     assert logdict is not None, "[%d] Error - log must not be none. Some multithreading nightmare has occured." % os.getpid()
 
@@ -83,16 +356,8 @@ def log( message, logdict, master=False ):
     pid = os.getpid()
     time = datetime.now().strftime("%H:%M:%S")
 
-    # init logging if need be
-    if 'master' not in logdict:
-        logdict['master'] = "[%s][%d] Logging started.\n"%(time,pid)
-    if pid not in logdict:
-        logdict[pid] = "[%s] Logging started.\n"%time
-
-    # append message
-    if master: # log to master log
-        logdict['master'] += "[%s][%d] %s.\n" % (time, pid, message)
-    logdict[pid] += "[%s] %s.\n"%(time,message) # also add to thread-specific log for reference
+    # send message (this does not wait for it to be stored)
+    logdict.write(message, master)
 
     if debug:
         print("[%s][%d] %s.\n"%(time,pid,message), end='') # also print straight to console
@@ -100,44 +365,469 @@ def log( message, logdict, master=False ):
 #################################################################
 ## Workers: the following setup, run and manage worker threads
 #################################################################
-def crunch(_queue, _logdict, _block, _end, _prog, _settings):
-    """Read from the queue and process or execute corresponding messages"""
+def crunch(_queue, _logdict, _active, _end, _prog, _settings, _version, _results, _pending, _workerinit, _arraystore,
+           _retire, _slot):
+    """Read from the queue and process or execute corresponding messages (until _retire is set)"""
     
     # store globals in this thread
     global logdict
     global queue
-    global block
+    global active
     global end
     global prog
     global settings
+    global settings_version
+    global results
+    global pending
+    global arraystore
+    global worker_slot
     
     queue = _queue
     logdict = _logdict
-    block = _block
+    active = _active
     end = _end
     prog = _prog
     settings = _settings
-        
+    settings_version = _version
+    results = _results
+    pending = _pending
+    arraystore = _arraystore
+    worker_slot = _slot
+    workerinit.update(_workerinit)
+
+    getWorkerState() # run any workflow initialisation (once per worker)
     log("Worker initialised", logdict)
     
-    while True:
-        if bool( block.value ) is False:
+    while not _retire.is_set():
+        if not active.wait(0.5): # block (without using any CPU) while paused
+            continue
+        try:
+            msg, value = queue.get(True, 0.5)
+        except Empty: # empty queue
+            if bool( end.value ) is True and pending.value <= 0:
+                break # done!
+            else: # wait for further jobs
+                continue
+        if msg == "EXEC":
+            while not active.wait(0.5) and not _retire.is_set():
+                pass # paused while we were waiting; hold the job (so it keeps its place) until we resume
+            if not active.is_set(): # retired while paused, so leave the job to another worker
+                queue.put((msg, value))
+                continue
+            results.put( _execute( value ) ) # execute job and report back to the control thread
+        else:
+            log("Error - %s is an invalid message." % msg, logdict)
+    if arraystore is not None:
+        arraystore.detach(os.getpid()) # e.g. this worker was retired (see resize())
+    log("Work complete", logdict)
+
+def _remote( address, authkey, interval ):
+    """Connect to a coordinator (see listen()) and execute jobs leased from it until told to stop."""
+
+    # store globals in this thread
+    global logdict
+    global prog
+    global settings
+    global settings_version
+    global ledger
+    global remote
+
+    import threading
+    from .base.remote import connect, heartbeat, RemoteLog
+    remote = connect(address, authkey)
+    _, _workerinit, _settings, version = remote.recv()
+    logdict = RemoteLog(remote)
+    prog = {} # N.B. progress is tracked by the coordinator
+    ledger = (os.getpid(), None)
+    settings = dict(_settings)
+    settings_version = Value('i', version)
+    workerinit.update(_workerinit)
+
+    stop = threading.Event()
+    threading.Thread(target=heartbeat, args=(remote, interval, stop), daemon=True).start()
+    getWorkerState() # run any workflow initialisation (once per worker)
+    log("Remote worker initialised", logdict)
+    try:
+        while True:
+            remote.send(('LEASE',))
+            msg = remote.recv()
+            if msg[0] == 'END':
+                break
+            elif msg[0] == 'EXEC':
+                _, job, _settings, version = msg
+                if _settings is not None: # settings have changed
+                    settings.clear()
+                    settings.update(_settings)
+                    settings_version.value = version
+                remote.send(('DONE', _execute( job )))
+    except (EOFError, OSError): # the coordinator has gone away
+        pass
+    finally:
+        stop.set()
+        remote.close()
+
+def _execute( job ):
+    """
+    Execute a job (in this thread) and return a record describing the outcome.
+    """
+    record = dict(id=job['id'], path=job['path'], trigger=job['trigger'], pid=os.getpid(),
+                  queued=job['queued'], started=time.time(), result=None, error=None)
+    setProgress(job['path'], 1) # set as in-progress.
+    _limitThreads(job.get('threads', 1))
+    _start(job)
+    outcome = None
+    if job.get('isolate', False) and worker_slot is not None: # run in a child process that can be killed
+        outcome = _isolate(job)
+    if outcome is not None:
+        record['result'], record['error'] = outcome
+    else:
+        try:
+            record['result'] = job['func'](*job['args'], **job['kwargs']) # execute function
+        except BaseException as E:
+            record['error'] = "".join(traceback.format_exception(type(E), E, E.__traceback__))
+    _start(None)
+    record['finished'] = time.time()
+    record['duration'] = record['finished'] - record['started']
+    return record
+
+def _isolate( job ):
+    """
+    Run a job in a child process of this worker, and kill it if it takes longer than its time limit (see limit()). The
+    child sends its log messages and outcome back through a pipe (rather than the queues shared by all workers), so
+    killing it cannot leave their locks held.
+
+    :return: a tuple containing the result of the job and the error (a traceback string, or None if it succeeded), or
+             None if jobs cannot be run in a child process on this system.
+    """
+    from multiprocess import Pipe, current_process, get_context
+    try:
+        context = get_context('fork') # N.B. the child needs a copy of this worker's globals (e.g. its log)
+    except ValueError: # e.g. on windows
+        return None
+    conn, child = Pipe(duplex=False)
+    config = current_process()._config # N.B. multiprocess does not let daemonic workers start children, as they
+    daemon = config.pop('daemon', False) # would be orphaned if the worker is killed. _isolated() checks for this.
+    try:
+        p = context.Process(target=_isolated, args=(job, child))
+        p.daemon = True
+        p.start()
+    finally:
+        config['daemon'] = daemon
+    child.close()
+    outcome = None
+    while outcome is None:
+        if conn.poll(0.1):
             try:
-                msg, value = queue.get(False, 0.1)
-            except: # empty queue
-                if bool( end.value ) is True:
-                    break # done!
-                else: # wait for further jobs
-                    continue
-            if msg == "EXEC":
-                f,args,kwargs = value
-                p = args[-3].get('path', "UNKNOWN") # get file path for updating progress dictionary.
-                prog[p] = 1 # set as in-progress.
-                f(*args,**kwargs) # execute function
-                prog[p] = 2 # set as complete.
+                msg = conn.recv()
+            except EOFError: # the child died without reporting back
+                p.join()
+                outcome = (None, "Job process died (exit code %s)" % p.exitcode)
+                break
+            if msg[0] == 'LOG':
+                logdict.queue.put(msg[1]) # N.B. as if written by this worker
             else:
-                log("Error - %s is an invalid message." % msg, logdict)
-    log("Work complete", logdict)
+                outcome = msg[1:]
+        elif 0 < worker_slot[2] < time.time(): # N.B. the deadline can be changed by the job (see limit())
+            p.kill()
+            p.join()
+            outcome = (None, "TimeoutError: job exceeded its time limit; killed process %d" % p.pid)
+    p.join()
+    conn.close()
+    if arraystore is not None and arraystore.recover(p.pid):
+        log("Released the array store lock held by killed process %d" % p.pid, logdict, master=True)
+    if arraystore is not None:
+        arraystore.detach(p.pid) # N.B. arrays attached by the job process are no longer in use
+    return outcome
+
+def _isolated( job, conn ):
+    """Run a job in a child process of a worker (see _isolate()) and send its outcome to the worker."""
+    import threading
+    from .base.logs import Relay
+    logdict.queue = Relay(conn) # send log messages to the worker (N.B. this is our copy of its log)
+    parent = os.getppid()
+    def orphaned(): # exit if the worker dies
+        while os.getppid() == parent:
+            time.sleep(1.0)
+        os._exit(1)
+    threading.Thread(target=orphaned, daemon=True).start()
+    result, error = None, None
+    try:
+        result = job['func'](*job['args'], **job['kwargs']) # execute function
+    except BaseException as E:
+        error = "".join(traceback.format_exception(type(E), E, E.__traceback__))
+    try:
+        conn.send(('DONE', result, error))
+    except Exception as E: # e.g. the result cannot be pickled
+        conn.send(('DONE', None, "".join(traceback.format_exception(type(E), E, E.__traceback__))))
+    conn.close()
+
+def _start( job ):
+    """
+    Tell the watchdog which job this worker is running, and when it must finish by (see _isolate()), or that it is idle
+    (if job is None).
+    """
+    global _deadline
+    _deadline = 0
+    if job is not None and job.get('timeout', None):
+        _deadline = time.time() + job['timeout']
+    if worker_slot is not None:
+        pid, count = job['id'].split(':') if job is not None else (0, 0)
+        worker_slot[:] = [int(pid), int(count), _deadline]
+
+def limit( timeout=None ):
+    """
+    Set the time that the current step of the job running in this worker can take, after which the job will be
+    killed (and retried, if allowed). The job's own time limit (if any) still applies. This is used to enforce step
+    timeouts (see trigger.timeout), but can also be called by workflow functions directly. N.B. time limits are only
+    enforced for jobs that run in their own process (see the isolate argument of submit()).
+
+    :param timeout: the time limit (in seconds), or None to reset it to the time limit of the job.
+    """
+    deadline = _deadline
+    if timeout is not None:
+        deadline = time.time() + timeout if deadline == 0 else min(deadline, time.time() + timeout)
+    if worker_slot is not None:
+        worker_slot[2] = deadline
+
+def _limitThreads( n ):
+    """
+    Limit the number of threads used by numerical libraries (e.g. BLAS, OpenMP) in this thread. Libraries that are
+    already loaded are limited using threadpoolctl; the environment variables are also set for libraries (and
+    processes) started later.
+    """
+    global _threads
+    from threadpoolctl import threadpool_limits
+    n = max(1, int(n))
+    if _threads is not None and _threads == (os.getpid(), n):
+        return
+    for v in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS']:
+        os.environ[v] = str(n)
+    threadpool_limits(limits=n)
+    _threads = (os.getpid(), n)
+
+def submit( func, args=(), kwargs={}, path=None, trigger=None, block=False, priority=0, weight=1, memory=0, cores=1,
+            threads=None, timeout=None, retries=0, backoff=10.0, isolate=None ):
+    """
+    Submit a job to the worker threads.
+
+    :param func: The function to execute.
+    :param args: A tuple of arguments to pass to the function.
+    :param kwargs: A dictionary of keyword arguments to pass to the function.
+    :param path: The file path that triggered this job (used to track progress). Default is None.
+    :param trigger: The name of the trigger that created this job. Default is None.
+    :param block: True if this job should be run in the current thread (blocking it). Its record is returned by the
+                  next call to collect() and, if it fails, it is retried by the workers. Default is False.
+    :param priority: Jobs with a higher priority are passed to workers first. Default is 0.
+    :param weight: The relative share of workers given to this job's trigger when triggers with the same priority
+                   have jobs waiting. Default is 1. N.B. priority and weight are only used for jobs submitted in the
+                   control thread (i.e. by file triggers); other jobs are passed straight to the worker queue.
+    :param memory: The memory (Mb) this job needs. Jobs are only passed to workers while the memory needed by running
+                   jobs fits in crunchy_settings['memorymb'] (or the host memory, if this is 0). Default is 0.
+    :param cores: The number of CPU cores this job uses. Jobs are only passed to workers while the cores used by
+                  running jobs fit in crunchy_settings['cores']. Default is 1. N.B. like priority, memory and cores
+                  are only used for jobs submitted in the control thread.
+    :param threads: The number of threads numerical libraries (e.g. BLAS) can use while running this job. Default is
+                    None (use cores).
+    :param timeout: The time (in seconds) this job can run for before it is killed. Default is None (no limit).
+                    N.B. this is only enforced for jobs run (in their own process) by local workers.
+    :param retries: The number of times to retry this job if it fails or times out. Jobs that fail on every attempt
+                    are added to the dead letters (see getDeadLetters()). Default is 0.
+    :param backoff: The time to wait (in seconds) before retrying. This is doubled for each further retry. It can also
+                    be a function that takes the number of the retry (starting at 1) and returns the time to wait.
+                    Default is 10.
+    :param isolate: True if this job should run in its own (child) process, which is killed if the job takes longer
+                    than its time limit (see limit()). Default is None (only if timeout is set).
+    :return: A Future that will contain the result of func once the job has completed. N.B. futures are resolved
+             when job records are collected (see collect()), which is done by the control thread (if running) or
+             by wait() and complete(). The control thread sends the records of jobs submitted by the main thread
+             back to it (see _receive()), so their futures are resolved (and failures retried) there.
+    """
+    global _jobcount
+    _jobcount += 1
+    job = dict(id='%d:%d' % (os.getpid(), _jobcount), path=path, trigger=trigger,
+               func=func, args=args, kwargs=kwargs, queued=time.time(), priority=priority, weight=weight,
+               memory=memory, cores=cores, threads=cores if threads is None else threads,
+               timeout=timeout, retries=retries, backoff=backoff, attempt=1,
+               isolate=timeout is not None if isolate is None else bool(isolate))
+    future = Future()
+    future.set_running_or_notify_cancel()
+    _futures[job['id']] = future
+    with done:
+        pending.value += 1
+    if block:
+        _dispatched[job['id']] = job # N.B. so that it is retried (by the workers) if it fails (see _finished())
+        record = _execute( job )
+        if _finished( record ):
+            addArtefacts( [record] )
+            _blocked.append( record ) # returned with the records collected next (see collect())
+    else:
+        setProgress(path, 0) # register job as queued.
+        _enqueue( job )
+    return future
+
+def _enqueue( job ):
+    """
+    Pass a job to the scheduler (in the control thread) or straight to the worker queue.
+    """
+    if scheduler is not None:
+        scheduler.add( job ) # held until a worker is free (see dispatch())
+        dispatch()
+    else:
+        _dispatched[job['id']] = job
+        queue.put( ("EXEC", job) )
+
+def dispatch():
+    """
+    Pass jobs held by the scheduler to the worker queue (in order of priority and fair share) until there is one
+    job for each worker, or the next job needs more memory or cores than are left (see _admit()). Jobs are kept
+    in the scheduler until then, so that high priority jobs submitted later do not have to wait behind a long
+    queue of low priority ones.
+    """
+    while len(scheduler) > 0 and len(_dispatched) < capacity.value:
+        job = scheduler.peek()
+        if not _admit( job ):
+            break # N.B. wait for resources rather than letting smaller jobs overtake it
+        scheduler.pop()
+        _dispatched[job['id']] = job # N.B. kept until it completes, so that it can be retried
+        queue.put( ("EXEC", job) )
+
+def _admit( job ):
+    """
+    Return True if there is enough memory and cores left (after those needed by dispatched jobs) to run a job. One job
+    is always admitted, so that jobs that need more than is available still run (one at a time).
+    """
+    global _hostmb
+    if len(_dispatched) == 0:
+        return True
+    s = getSettings()
+    memory = int(s.get('memorymb', 0))
+    if memory <= 0:
+        if _hostmb is None:
+            from .base.autoscale import hostMemory
+            _hostmb = hostMemory() or float('inf')
+        memory = _hostmb
+    cores = int(s.get('cores', os.cpu_count()))
+    used = [sum(v) for v in zip(*[(j.get('memory', 0), j.get('cores', 1)) for j in _dispatched.values()])]
+    return used[0] + job.get('memory', 0) <= memory and used[1] + job.get('cores', 1) <= cores
+
+def _retry():
+    """
+    Pass failed jobs that are due to be retried back to the workers.
+    """
+    now = time.time()
+    for t, job in [r for r in _retries if r[0] <= now]:
+        try:
+            _retries.remove((t, job))
+        except ValueError: # already retried by another thread (see _receive())
+            continue
+        _enqueue( job )
+
+def collect( timeout=0 ):
+    """
+    Collect the records of completed jobs sent back by worker threads, update job progress, resolve futures
+    for jobs submitted by this thread and add any outputs to the artefact index (see getArtefacts()). N.B. this
+    should only be called by one thread at a time (the control thread if crunchy is running, which sends the records
+    of jobs submitted by the main thread back to it).
+
+    :param timeout: The maximum time to wait for a record to arrive. Default is 0 (don't wait).
+    :return: A list of collected job records. These are dictionaries containing the job id, path, trigger, pid
+             (of the worker that ran it), queued, started and finished times, duration and error (a traceback string,
+             or None if the job succeeded).
+    """
+    _retry()
+    blocked = _blocked[:] # N.B. blocking jobs run by this thread are already handled (see submit())
+    del _blocked[:]
+    out = []
+    while True:
+        try:
+            if len(out) + len(blocked) == 0 and timeout > 0:
+                record = results.get(True, timeout)
+            else:
+                record = results.get_nowait()
+        except Empty:
+            addArtefacts(out)
+            return blocked + out
+        if _parent is not None and record['id'].split(':')[0] == str(_parent):
+            returns.put(record) # the main thread resolves its own futures and retries (see _receive())
+        elif _finished(record):
+            out.append(record)
+
+def _receive( inbox ):
+    """
+    Handle the records of jobs submitted by the main thread that were collected by the control thread (see
+    collect()), so that their futures are resolved and failed jobs are retried. This runs in a (daemon) thread of
+    the main thread until None is received.
+    """
+    while True:
+        try:
+            record = inbox.get(True, 0.5)
+        except Empty:
+            record = False
+        except (EOFError, OSError): # crunchy is shutting down
+            break
+        if record is None:
+            break
+        if record is not False and _finished(record):
+            addArtefacts([record])
+        _retry()
+
+def _finished( record ):
+    """
+    Handle the record of a finished job. Failed jobs are retried if allowed (see submit()).
+
+    :return: True if the job is finished, or False if it will be retried.
+    """
+    job = _dispatched.pop(record['id'], None)
+    if record.get('lost', False): # reported by the watchdog
+        if job is None:
+            return False # N.B. the worker reported this job before it was killed
+        record.update(path=job['path'], trigger=job['trigger'], queued=job['queued'])
+    if record['error'] is not None and job is not None:
+        record['attempt'] = job.get('attempt', 1)
+        if job['attempt'] <= job.get('retries', 0):
+            b = job.get('backoff', 10.0)
+            delay = b(job['attempt']) if callable(b) else b * 2 ** (job['attempt'] - 1)
+            log("Job for %s failed; retrying in %.1f seconds (retry %d of %d)" % (
+                record['path'], delay, job['attempt'], job['retries']), logdict, master=True)
+            job['attempt'] += 1
+            _retries.append((time.time() + delay, job))
+            setProgress(record['path'], 0) # queued (again)
+            return False
+    if record['error'] is not None and deadletters is not None:
+        deadletters[record['id']] = dict(path=None if record['path'] is None else str(record['path']),
+                                         trigger=record['trigger'], attempts=record.get('attempt', 1),
+                                         finished=record['finished'], error=record['error'])
+        if job is not None:
+            from .base.trigger import _discard
+            _discard(job) # N.B. checkpoints of dead-lettered jobs are not needed
+    setProgress(record['path'], 2 if record['error'] is None else -1, record) # set as complete (or failed).
+    if jobtime is not None and record.get('duration', None) is not None:
+        with jobtime.get_lock():
+            jobtime.value = record['duration'] if jobtime.value <= 0 else 0.9 * jobtime.value + 0.1 * record['duration']
+    if record['error'] is None: # forget the oldest completed jobs (N.B. failed jobs are kept)
+        _completed.append(record['path'])
+        while len(_completed) > int(getSettings().get('history', len(_completed))):
+            p = _completed.popleft()
+            if prog.get(p, None) == 2:
+                prog.pop(p, None)
+    future = _futures.pop(record['id'], None)
+    if future is not None:
+        future.record = record
+        if record['error'] is None:
+            future.set_result(record['result'])
+        else:
+            from .base.errors import JobError
+            future.set_exception(JobError(record['error']))
+    with done:
+        pending.value -= 1
+        done.notify_all()
+    return True
+
+def _controlling():
+    """
+    Return True if a control thread is running (and so is responsible for collecting job records).
+    """
+    return crunchthread is not None and crunchthread.is_alive()
 
 def init( nworkers=None ):
     """
@@ -148,46 +838,184 @@ def init( nworkers=None ):
     # setup threadsafe globals
     global manager
     global queue
-    global block
+    global active
     global endwhenempty
+    global results
+    global pending
+    global done
+    global capacity
+    global jobtime
+    global autoscaler
     global workers
     global logdict
-    global file_size_dict
     global known_files
-    global new_files
+    global scoutqueue
+    global scoutinbox
+    global scoutstats
     global prog
     global settings
+    global settings_version
+    global ledger
+    global arraystore
+    global artefacts
+    global artefacts_version
+    global deadletters
+    global watchdog
+    global returns
+    global _snapshot
 
+    ledger = None
+    _snapshot = None
+    if autoscaler is not None:
+        autoscaler.stop()
+    if watchdog is not None:
+        watchdog.stop()
+    if logdict is not None and logdict.owner == os.getpid():
+        logdict.close() # stop receiving messages for the previous run
     queue = Queue()
-    block = Value('i', 0)
+    active = Event()
+    active.set()
     endwhenempty = Value('i', 0)
+    results = Queue()
+    if returns is not None:
+        returns.put(None) # stop receiving records for the previous run
+    returns = Queue()
+    import threading
+    threading.Thread(target=_receive, args=(returns,), daemon=True).start()
+    pending = Value('i', 0)
+    jobtime = Value('d', 0.0)
+    done = Condition()
+    _futures.clear()
+    _dispatched.clear()
+    _completed.clear()
+    del _blocked[:]
+    del _retries[:]
     manager = Manager()
-    logdict = manager.dict()
     prog = manager.dict()
     settings = manager.dict()
+    settings_version = Value('i', 0)
     
     
-    # setup dictionaries used by file trackers
-    file_size_dict = manager.dict()  # store file size info
+    # setup messaging used by file trackers
     known_files = manager.dict()  # files we know about, so ignore
-    new_files = manager.dict()  # dictionary containing new files (as keys)
+    scoutqueue = Queue() # new files found by the scout
+    scoutinbox = Queue() # files that the scout should forget
+    scoutstats = manager.dict()
+    artefacts = manager.list()
+    artefacts_version = Value('i', 0)
+    deadletters = manager.dict()
+    _artefact_cache.update(version=0, items={}, queries={})
 
     # populate default settings
     for k,v in workflow_settings.items():
         settings[k] = v['value']
     for k,v in crunchy_settings.items():
         settings[k] = v['value']
+
+    # setup log
+    from .base.logs import LogBook
+    logdict = LogBook(Queue(), maxlen=int(settings['loglines']))
+    logdict.start()
+
+    # setup shared array store
+    from .base.shared import ArrayStore, getRoot
+    arraystore = ArrayStore(getRoot(), manager.dict(), manager.Lock(), limit=int(settings['sharedmb']) * 1024**2,
+                            owner=manager.Value('i', 0))
     
     # setup queue
     workers = []
     if nworkers is None:
         nworkers = settings['nthreads']
+    capacity = Value('i', nworkers)
     for i in range(nworkers):
-        # create worker process
-        p = Process(target=crunch, args=(queue, logdict, block, endwhenempty, prog, settings))
-        p.daemon = True # it should run in the background
-        p.start() # start it
-        workers.append(p) # store reference to it
+        _spawn()
+
+    # resize the pool while running (see crunchy_settings['autoscale'])
+    from .base.autoscale import Autoscaler
+    autoscaler = Autoscaler(nworkers)
+    autoscaler.start()
+
+    # replace workers that die
+    from .base.watchdog import Watchdog
+    watchdog = Watchdog()
+    watchdog.start()
+
+def _spawn():
+    """
+    Start a worker process and add it to the pool. Each worker has its own event that tells it to finish (see resize()).
+    """
+    retire = Event()
+    slot = Array('d', 3, lock=False) # see _start(). N.B. no lock, as jobs that hold it could be killed
+    p = Process(target=crunch, args=(queue, logdict, active, endwhenempty, prog, settings, settings_version,
+                                     results, pending, dict(workerinit), arraystore, retire, slot))
+    p.daemon = True # it should run in the background
+    p.start() # start it
+    p.retire = retire
+    p.slot = slot
+    workers.append(p) # store reference to it
+
+def resize( n ):
+    """
+    Grow or shrink the pool of (local) worker threads. Workers that are removed finish the job they are running first.
+    This is done automatically if crunchy_settings['autoscale'] is True.
+
+    :param n: the number of workers to use.
+    """
+    workers[:] = [w for w in workers if w.is_alive() or not w.retire.is_set()] # forget retired workers
+    live = [w for w in workers if not w.retire.is_set()]
+    n = max(0, int(n))
+    for i in range(n - len(live)):
+        _spawn()
+    for w in live[n:]:
+        w.retire.set()
+    with capacity.get_lock():
+        capacity.value += n - len(live)
+
+def listen( address=('127.0.0.1', 6000), authkey=None, timeout=60.0 ):
+    """
+    Accept connections from remote workers (see connect()), e.g. on other servers that can access the input and
+    output directories, which then take jobs from the worker queue alongside the local workers. Must be called after
+    init() (in the same thread).
+
+    :param address: the (host, port) to listen on. Use port 0 to pick a free port. Default is ('127.0.0.1', 6000), so
+                    only workers on this server can connect; use e.g. ('0.0.0.0', 6000) to accept remote workers.
+    :param authkey: the key (bytes) that remote workers must present to connect. If None (default), a random key is
+                    generated and printed (it can also be read from crunchy.coordinator.authkey).
+    :param timeout: the time (in seconds) after the last heartbeat from a remote worker that it is considered dead and
+                    the jobs it was running are given to other workers. Default is 60.
+    :return: the address that is being listened on.
+    """
+    global coordinator
+    if coordinator is not None:
+        coordinator.close()
+    from .base.remote import Coordinator
+    if authkey is None:
+        import secrets
+        authkey = secrets.token_hex(16).encode()
+        print("Remote workers can connect to %s:%s with the key %s" % (*address[:2], authkey.decode()))
+    coordinator = Coordinator(address, authkey, timeout)
+    coordinator.start()
+    return coordinator.address
+
+def connect( address, authkey, nworkers=1, heartbeat=5.0 ):
+    """
+    Start worker threads that execute jobs leased from a crunchy coordinator (see listen()) running on this or another
+    server. The workflow module should be imported first, so that its functions can be received. N.B. remote workers
+    do not have access to the shared array store (see getArrayStore()).
+
+    :param address: the (host, port) of the coordinator.
+    :param authkey: the key (bytes) used to connect (see listen()).
+    :param nworkers: the number of worker threads to start. Default is 1.
+    :param heartbeat: the interval (in seconds) at which workers tell the coordinator that they are still alive.
+                      Default is 5.
+    :return: a list of the worker processes. These finish when crunchy completes (or the coordinator stops).
+    """
+    out = []
+    for i in range(nworkers):
+        p = Process(target=_remote, args=(address, authkey, heartbeat))
+        p.start()
+        out.append(p)
+    return out
 
 def initialised():
     """
@@ -206,26 +1034,34 @@ def pause():
     Pause worker threads. Currently running jobs will be finished, but new jobs will not be launched
     from the queue. This will not pause file scouts.
     """
-    global block
-    block.value = 1
+    active.clear()
 
 def paused():
-    global block
-    return block.value == 1
+    return not active.is_set()
 
 def resume():
     """
     Resume paused worker threads so that they continue taking new jobs from the queue.
     """
-    global block
-    block.value = 0
+    active.set()
 
-def wait():
+def wait( timeout=None ):
     """
-    Join each worker until the next time the queue becomes empty.
+    Block until all submitted jobs have been completed.
+
+    :param timeout: The maximum time to wait (in seconds). Default is None (wait forever).
+    :return: True if all jobs were completed, or False if the timeout expired.
     """
-    while not queue.empty():
-        time.sleep(0.5)
+    start = time.time()
+    while pending.value > 0:
+        if timeout is not None and time.time() - start > timeout:
+            return False
+        if _controlling(): # wait for the control thread to collect completed jobs
+            with done:
+                done.wait(0.5)
+        else: # collect them ourselves
+            collect(0.5)
+    return True
 
 def complete(join = True, end=True):
     """
@@ -243,12 +1079,29 @@ def complete(join = True, end=True):
     global settings
     global finalize
     global logdict
+    global arraystore
+    global coordinator
+    global autoscaler
+    global watchdog
+    global returns
+    if autoscaler is not None:
+        autoscaler.stop() # don't resize the pool while finishing
+        autoscaler = None
     endwhenempty.value = 1 # tell jobs to exit once queue is empty
     if join:
+        if coordinator is not None and not _controlling():
+            wait() # collect the results of jobs run by remote workers
         if workers is not None:
-            for w in workers:
-                w.join()
+            for w in workers: # N.B. the watchdog may add workers (to replace dead ones) while we wait
+                while w.is_alive():
+                    if not _controlling():
+                        collect(0.1) # workers only exit once their results have been collected
+                    w.join(0.1)
+        logdict.flush() # make sure messages sent by workers before they finished have been received
     if end:
+        if watchdog is not None:
+            watchdog.stop()
+            watchdog = None
         if workers is not None:
             for w in workers:
                 if w.is_alive():
@@ -257,12 +1110,21 @@ def complete(join = True, end=True):
         if scoutthread is not None:
             if scoutthread.is_alive():
                 scoutthread.terminate()
-                scoutthread = None
+            scoutthread = None
         if crunchthread is not None:
             if crunchthread.is_alive():
                 crunchthread.terminate()
-                crunchthread = None
+            crunchthread = None
         scoutdirs.clear()
+        if coordinator is not None:
+            coordinator.close() # N.B. remote workers finish when they next ask for a job
+            coordinator = None
+        if arraystore is not None:
+            arraystore.clear()
+            arraystore = None
+        if returns is not None:
+            returns.put(None)
+            returns = None
 
     # and finally, run any "finish" jobs ( in this thread )
     for k, v in finalize.items():
@@ -290,8 +1152,9 @@ def scout( clear = True ):
     then it will be terminated and a new one run (in case e.g. settings have changed). Note that this will not
     launch a thread passing identified files to the workflow - use crunchy.run() to do this.
 
-    :param clear: True if the known_files, file_size_dict and new_files dictionaries should be emptied before launching
-               or re-launching this scout. Default is True.
+    :param clear: True if the known_files dictionary should be emptied before launching or re-launching this scout.
+                  Default is True. Note that the scout keeps its own (local) copy of known_files, which is populated
+                  from the shared known_files dictionary when it is launched.
     """
 
     assert len(scoutdirs) > 0, "Error - cannot start crunchy without any hot directories."
@@ -304,70 +1167,151 @@ def scout( clear = True ):
 
     # clear file dictionaries
     if clear:
-        new_files.clear()
         known_files.clear()
-        file_size_dict.clear()
+        if settings.get('ledger', False): # reload files that have been processed previously
+            from .base.ledger import Ledger
+            path = getLedgerPath(settings['outpath'])
+            if os.path.exists(path):
+                l = Ledger(path)
+                known_files.update(l.known())
+                l.close()
 
     # launch new scout thread
     from .base import scout # here to avoid circular imports
     scoutthread = Process(target=scout,
                      args=(list(scoutdirs.keys()),  # search paths
                            list(scoutdirs.values()),  # search depths
-                           new_files,
-                           known_files,
-                           file_size_dict,
+                           scoutqueue,
+                           known_files.copy(), # N.B. the scout keeps a local copy of this
+                           {},
                            int(settings.get('wait',1)),
-                           float(settings.get('idle',1.0))))
+                           float(settings.get('idle',1.0))),
+                     kwargs=dict(backend=settings.get('backend', 'poll'),
+                                 inbox=scoutinbox, stats=scoutstats))
     scoutthread.start()
     return scoutthread
 
 def setOutpath( path ):
-    settings['outpath'] = Path(path)
+    updateSettings(outpath=Path(path))
     crunchy_settings['outpath']['value'] = Path(path)
 
 def setInpath( path ):
-    settings['inpath'] = Path(path)
+    updateSettings(inpath=Path(path))
     crunchy_settings['inpath']['value'] = Path(path)
 
-def process_new_files( settings, new_files, known_files, entries, outpath, _logdict ):
+def process_new_files( settings, new_files, forget, entries, outpath, _logdict ):
     """
     Process any new files in the new_files dictionary and pass them to each listening filefilter to trigger
     workflow events.
+
+    :param settings: the settings to pass to file filters (see getSettings()).
+    :param new_files: a dictionary of new files (keys) and their sizes (values). This will be emptied.
+    :param forget: a list that paths are appended to if a file filter wants to see them again.
     """
     assert settings.get('outpath',None) is not None, 'Error - no outpath set. See setOutpath()'
     os.makedirs(settings['outpath'], exist_ok=True)
 
     from crunchy.base import trigger # here to circular imports
     if new_files is not None:
+        l = getLedger()
+        if l is not None:
+            l.discovered(new_files)
+        outcomes = []
         for p,s in new_files.items():
-            known_files[p] = s # we can now ignore this file (unless the file size changes at some point)
-            for f in entries.values():
+            for n,f in entries.items():
+                if hasattr(f, 'after'):
+                    continue # job triggers are run by process_records
                 status = f(Path(p), Path(settings['outpath']), settings ) # pass to our file filters
+                outcomes.append((p, n, status))
                 if status == trigger.WAIT: # file-filter wants to see this file again; remove it from known files
-                    del known_files[p]
+                    if p not in forget:
+                        forget.append(p)
+        if l is not None:
+            l.outcomes(outcomes)
         new_files.clear()
     else:
         assert False, 'Error - a serious multithreading failure has occurred...'
 
+def process_records( settings, records, entries ):
+    """
+    Pass the records of completed jobs to each job trigger that depends on them (see trigger.jobTrigger).
+
+    :param records: a list of job records (see collect()).
+    """
+    for r in records:
+        for n,f in entries.items():
+            if r['trigger'] in getattr(f, 'after', []):
+                f(r, settings)
+
+def restore_records( settings, entries ):
+    """
+    Pass the jobs completed before crunchy was (re)started to each job trigger (see trigger.jobTrigger), if the ledger
+    is enabled.
+    """
+    l = getLedger()
+    if l is None:
+        return
+    for n,f in entries.items():
+        if hasattr(f, 'restore'):
+            f.restore(l, settings)
+
 # setup thread that runs crunchy (passes files to worker threads).
-def _serve(_settings, _queue, _new_files, _known_files, _entries, _outpath, _prog, _logdict):
+def _serve(_settings, _version, _queue, _scoutqueue, _scoutinbox, _scoutstats, _known_files, _entries, _outpath, _prog,
+           _logdict, _results, _pending, _done, _arraystore, _capacity, _artefacts, _artefacts_version, _jobtime,
+           _deadletters, _returns):
     """
     Private function called by thread spawned by (run).
     """
     
     # define globals in this thread
     global settings
+    global settings_version
     global queue
-    global new_files
+    global scoutqueue
+    global scoutinbox
+    global scoutstats
     global known_files
     global entries
     global outpath
     global prog
     global logdict
+    global results
+    global pending
+    global done
+    global arraystore
+    global capacity
+    global jobtime
+    global scheduler
+    global artefacts
+    global artefacts_version
+    global deadletters
+    global returns
+    global _parent
     
     settings = _settings
+    settings_version = _version
     queue = _queue
-    new_files = _new_files
+    results = _results
+    pending = _pending
+    done = _done
+    arraystore = _arraystore
+    capacity = _capacity
+    jobtime = _jobtime
+    artefacts = _artefacts
+    artefacts_version = _artefacts_version
+    deadletters = _deadletters
+    returns = _returns
+    _parent = os.getppid() # N.B. records of jobs it submits are sent back to it
+    _futures.clear()
+    _dispatched.clear()
+    _completed.clear()
+    del _blocked[:]
+    del _retries[:]
+    from .base.scheduler import Scheduler
+    scheduler = Scheduler()
+    scoutqueue = _scoutqueue
+    scoutinbox = _scoutinbox
+    scoutstats = _scoutstats
     known_files = _known_files
     entries = _entries
     outpath = _outpath
@@ -376,15 +1320,38 @@ def _serve(_settings, _queue, _new_files, _known_files, _entries, _outpath, _pro
     
     import crunchy
     crunchy.log('Spawning control thread.', logdict)
+    restore_records(getSettings(), entries) # rebuild job trigger groups from the ledger
+    new_files = {} # new files received from the scout (and not yet passed to the workflow)
+    backlog = 0
     while True:
-        #assert outpath is not None, 'Error - no outpath set. See setOutpath()'
-        #for p, s in new_files.items():
-        #    known_files[p] = s  # we can now ignore this file (unless the file size changes at some point)
-        #    for f in entries.values():
-        #        f(Path(p), Path(outpath), settings)  # pass to our file filters
-        #new_files.clear()
-        process_new_files(settings,new_files, known_files, entries, outpath, prog)
-        time.sleep(1.0)
+        records = collect(0.1) # handle completed jobs (waiting for at most 0.1 seconds, so free workers get jobs quickly)
+        process_records(getSettings(), records, entries) # run triggers that depend on them
+        dispatch()
+
+        # receive batches of new files from the scout
+        try:
+            while True:
+                new_files.update(scoutqueue.get_nowait())
+        except: # empty queue
+            pass
+        if len(new_files) != backlog: # report the backlog size (only when it changes)
+            backlog = len(new_files)
+            scoutstats['backlog'] = backlog
+        if len(new_files) == 0:
+            continue
+
+        # pass as many as there is space for in the job queue to the workflow. The rest stay here (as paths
+        # and sizes only) until the workers catch up, so that memory use does not grow with the backlog.
+        space = int(getSettings()['maxqueue']) - len(scheduler)
+        if space > 0:
+            batch = {p: new_files.pop(p) for p in list(islice(new_files, space))} # oldest first
+            known_files.update(batch) # N.B. this is one message per batch (rather than per file)
+            forget = []
+            process_new_files(getSettings(), batch, forget, entries, outpath, prog)
+            if len(forget) > 0: # tell the scout about files that should be looked at again
+                for p in forget:
+                    known_files.pop(p, None)
+                scoutinbox.put(forget)
         
 def run():
     """
@@ -408,6 +1375,11 @@ def run():
     if not succ:
         print("Crunchy workflow could not start due to errors during initialisation.")
         return None
+    updateSettings() # tell threads to refresh their copy of the settings
+    logdict.setFile(getLogPath(settings['outpath'])) # also write log messages to the output directory
+    l = getLedger()
+    if l is not None and artefacts_version.value == 0: # restore the artefact index of previous runs
+        _indexArtefacts(l.artefacts(int(settings['maxartefacts'])))
 
     # start scout thread
     scout()
@@ -416,7 +1388,10 @@ def run():
 
     # launch crunchy thread
     global crunchthread
-    crunchthread = Process(target=_serve, args=(settings, queue, new_files, known_files, entries, settings['outpath'], prog, logdict))
+    crunchthread = Process(target=_serve, args=(settings, settings_version, queue, scoutqueue, scoutinbox, scoutstats,
+                                                known_files, entries, settings['outpath'], prog, logdict, results,
+                                                pending, done, arraystore, capacity, artefacts, artefacts_version,
+                                                jobtime, deadletters, returns))
     crunchthread.start()
     return crunchthread
     
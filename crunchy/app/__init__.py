@@ -1,19 +1,92 @@
 from flask import Flask , render_template, render_template_string, send_file, abort, send_from_directory, request
+from flask import Response, jsonify
 from pathlib import Path
 from natsort import natsorted
+from collections import Counter
 import crunchy
 import re
+import json
+import time
+import threading
 from glob import glob
-
-# set numpy to run in a single thread
+from crunchy.app.listing import ListingCache
+from crunchy.base import preview
 import os
-os.environ['OPENBLAS_NUM_THREADS'] = '1'
-os.environ['MKL_NUM_THREADS'] = '1'
 
 # globals
 root = Path('/')
 flaskapp = None
 server = None
+task = None # (name, thread) of the control action (e.g. launch or finish) running in the background
+lock = threading.Lock() # held while a control action runs, so that e.g. a launch and a finish cannot overlap
+MAXCLIENTS = 8 # maximum number of clients that can stream /api/events at once
+clients = threading.BoundedSemaphore(MAXCLIENTS)
+listings = ListingCache() # cached directory listings used by the file browser
+
+def busy():
+    """
+    Return True if a control action (e.g. launching or finishing a workflow) is running in the background.
+    """
+    return task is not None and task[1].is_alive()
+
+def _background( name, func ):
+    """
+    Run a (potentially slow) control action in a background thread, so that the app stays responsive while it runs.
+    The action holds the lock until it has finished; nothing is done if another action is already running.
+
+    :return: True if the action was started.
+    """
+    global task
+    if not lock.acquire(blocking=False):
+        return False
+    def action():
+        try:
+            func()
+        finally:
+            lock.release()
+    t = threading.Thread(target=action, daemon=True)
+    task = (name, t)
+    t.start()
+    return True
+
+def _launch():
+    if crunchy.running(): # N.B. checked while holding the lock
+        return
+    crunchy.init()
+    crunchy.log('Starting workflow', crunchy.getLogDict(), True)
+    thread = crunchy.run() # run workers
+    if thread is None: # this failed
+        crunchy.complete(False, True)
+
+def _finish():
+    if not crunchy.running():
+        return
+    crunchy.log('Finishing jobs... please wait', crunchy.getLogDict(), True)
+    crunchy.complete(True, True)
+    crunchy.log('Workflow complete', crunchy.getLogDict(), True)
+
+def _terminate():
+    if not crunchy.initialised():
+        return
+    crunchy.complete(False, True)
+    crunchy.log('Workers have been brutally terminated.', crunchy.getLogDict(), True)
+
+def status():
+    """
+    Return a (JSON serialisable) dictionary describing the current state of crunchy.
+    """
+    out = dict(time=time.time(), initialised=crunchy.initialised(), running=crunchy.running(),
+               action=task[0] if busy() else None)
+    try:
+        if crunchy.initialised():
+            counts = Counter(crunchy.prog.values())
+            out.update(paused=crunchy.paused(),
+                       jobs=dict(queued=counts[0], running=counts[1], completed=counts[2], failed=counts[-1]),
+                       deadletters=len(crunchy.deadletters),
+                       scout=crunchy.getScoutStats())
+    except (AttributeError, EOFError, OSError): # crunchy was shut down while we were asking
+        pass
+    return out
 
 def run( basepath ):
     """
@@ -44,6 +117,7 @@ def run( basepath ):
                     continue
 
                 if 'action' in target: # this was an action button
+                    # N.B. slow actions are run in the background; the page shows their progress until they finish
                     if 'launch' in key.lower():
                         launch = True
                     elif 'pause' in key.lower():
@@ -53,13 +127,23 @@ def run( basepath ):
                         crunchy.resume()
                         crunchy.log('Resuming work', crunchy.getLogDict(), True)
                     elif 'finish' in key.lower():
-                        crunchy.log('Finishing jobs... please wait', crunchy.getLogDict(), True)
-                        crunchy.complete(True,True)
-                        crunchy.log('Workflow complete', crunchy.getLogDict(), True)
-
-                    elif 'terminate' in key.lower():
-                        crunchy.complete(False, True)
-                        crunchy.log('Workers have been brutally terminated.', crunchy.getLogDict(), True)
+                        _background('finish', _finish)
+                    elif 'terminate' in key.lower(): # N.B. this does nothing once e.g. finish has started
+                        _background('terminate', _terminate)
+                    elif 'scale' in key.lower(): # resize the worker pool (see crunchy.base.autoscale)
+                        values = dict(autoscale='scale__autoscale' in request.form)
+                        for n in ['nthreads', 'minthreads', 'maxthreads']:
+                            try:
+                                values[n] = max(1, int(request.form['scale__%s' % n]))
+                            except (KeyError, ValueError):
+                                errors.append(n)
+                        for n, v in values.items():
+                            crunchy.crunchy_settings[n]['value'] = v
+                        if crunchy.running():
+                            crunchy.updateSettings(values)
+                            crunchy.log('Worker pool settings changed', crunchy.getLogDict(), True)
+                elif 'scale' in target:
+                    continue # handled by the scale action
                 else: # we are updating settings
                     if 'crunchy' in target: # update crunchy settings
                         target = crunchy.crunchy_settings
@@ -100,22 +184,51 @@ def run( basepath ):
                                 v['value'] = False
 
                 # spawn worker threads
-                crunchy.init()
-                crunchy.log('Starting workflow', crunchy.getLogDict(), True)
-                thread = crunchy.run() # run workers
-                if thread == None: # this failed
-                    crunchy.complete(False, True)
-                    launch = False
+                _background('launch', _launch)
 
         # is crunchy running
         if crunchy.running(): # render status
-            return render_template('index.html', log=crunchy.getLogDict(), crunchy=crunchy,
+            return render_template('index.html', log=crunchy.getLogDict(), crunchy=crunchy, action=task[0] if busy() else None,
                                    reversed=reversed, len=len, enumerate=enumerate)
+        elif busy(): # e.g. launching
+            return render_template('busy.html', action=task[0])
         else: # render settings / setup
             return render_template('settings.html', cset=crunchy.crunchy_settings, root=str(root),
                                    wset=crunchy.workflow_settings, errors=errors,
                                    enumerate=enumerate, )
     
+    @flaskapp.route('/api/status')
+    def api_status():
+        return jsonify(status())
+
+    @flaskapp.route('/api/events')
+    def api_events():
+        """
+        Stream changes to the crunchy status (see status()) to the client as server-sent events. The first event
+        contains the full status and later ones only the values that changed. The stream ends (with an "end" event)
+        once crunchy has stopped running.
+        """
+        if not clients.acquire(blocking=False):
+            return abort(503)
+        def stream():
+            last = {}
+            while True:
+                s = status()
+                delta = {k: v for k, v in s.items() if k != 'time' and last.get(k) != v}
+                if len(delta) > 0 or len(last) == 0:
+                    delta['time'] = s['time']
+                    yield "data: %s\n\n" % json.dumps(delta)
+                    last = s
+                else:
+                    yield ": keep-alive\n\n" # N.B. lets us notice clients that have gone away
+                if not (s['running'] or s['action']):
+                    yield "event: end\ndata: {}\n\n"
+                    return
+                time.sleep(1.0)
+        response = Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+        response.call_on_close(clients.release)
+        return response
+
     @flaskapp.route('/status', methods=['GET', 'POST'])
     def workflow():
         return render_template('status.html', settings=crunchy.settings, root=str(root), enumerate=enumerate, )
@@ -146,6 +259,44 @@ def run( basepath ):
             else:
                 return "Crunchy is not running. Please start it before viewing dashboard."
 
+    @flaskapp.route('/thumb/<path:req_path>')
+    def thumb(req_path):
+        """
+        Serve a (cached) thumbnail of an image or array. Use ?size=... to set the maximum width and height.
+        """
+        path = (root / req_path).resolve()
+        if not os.path.isfile(path):
+            return abort(404)
+        size = min(max(request.args.get('size', 256, type=int), 16), 2048)
+        try:
+            return send_file(preview.thumbnail(path, size), mimetype='image/jpeg')
+        except preview.TooLarge:
+            return abort(413)
+        except (ValueError, OSError):
+            return abort(415)
+
+    @flaskapp.route('/tile/<int:z>/<int:x>/<int:y>/<path:req_path>')
+    def tile(z, x, y, req_path):
+        """
+        Serve a (cached) tile of an image pyramid, e.g. for zoomable previews (see crunchy.base.preview.tile).
+        """
+        path = (root / req_path).resolve()
+        if not os.path.isfile(path):
+            return abort(404)
+        try:
+            return send_file(preview.tile(path, z, x, y), mimetype='image/jpeg')
+        except preview.TooLarge:
+            return abort(413)
+        except (ValueError, OSError):
+            return abort(404)
+
+    @flaskapp.route('/tileinfo/<path:req_path>')
+    def tileinfo(req_path):
+        path = (root / req_path).resolve()
+        if not (os.path.isfile(path) and preview.previewable(path)):
+            return abort(404)
+        return jsonify(preview.info(path))
+
     @flaskapp.route('/', defaults={'req_path': ''})
     @flaskapp.route('/<path:req_path>')
     def dir_listing(req_path):
@@ -157,10 +308,11 @@ def run( basepath ):
         # Check if path is a file and serve
         if os.path.isfile(path):
             return send_file(path)
-        else: # Show directory contents
-            content = natsorted(os.listdir(path))
-            files = [f for f in content if os.path.isfile(path / f)]
-            dirs = [f for f in content if os.path.isdir(path / f)]
+        else: # Show directory contents (one page at a time, optionally filtered using ?q=...)
+            page = request.args.get('page', 1, type=int)
+            per = request.args.get('per', 200, type=int)
+            q = request.args.get('q', '')
+            dirs, files, pages = listings.page(path, page, per, q)
             if path != root:
                 pdir = str(path.parent.relative_to(root))
             else:
@@ -169,13 +321,14 @@ def run( basepath ):
                                    parent_dir=pdir,
                                    dirs=dirs,
                                    files=files,
-                                   basename=os.path.basename)
+                                   page=min(max(1, page), pages), pages=pages, per=per, q=q,
+                                   basename=os.path.basename, previewable=preview.previewable)
 
     # run
     try: # try first with default port
-        flaskapp.run(threaded=False, processes=1, host="0.0.0.0", port=5001, debug=False, use_reloader=False)
+        flaskapp.run(threaded=True, host="0.0.0.0", port=5001, debug=False, use_reloader=False)
     except: # otherwise find a random port
-       flaskapp.run(threaded=False, processes=1, host="0.0.0.0", port=0, debug=False, use_reloader=False)
+       flaskapp.run(threaded=True, host="0.0.0.0", port=0, debug=False, use_reloader=False)
 
 if __name__ == "__main__":
     import sys,os
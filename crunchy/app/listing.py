@@ -0,0 +1,85 @@
+"""
+Cached directory listings used by the file browser, so that large (e.g. output) directories do not need to be
+listed and sorted again for every request.
+"""
+import os
+import time
+import threading
+from fnmatch import fnmatch
+from collections import OrderedDict
+from natsort import natsorted
+
+class ListingCache(object):
+    """
+    Cache of (naturally sorted) directory listings, keyed by the directory modification time so that they
+    are refreshed whenever entries are added, removed or renamed.
+    """
+    def __init__(self, maxsize=64, racy=2.0):
+        """
+        :param maxsize: the maximum number of directories to keep listings for. The least recently used are
+                        discarded first.
+        :param racy: listings of directories modified less than this many seconds ago are not cached, as further
+                     changes within the resolution of the file system timestamps would not be detected.
+        """
+        self.maxsize = maxsize
+        self.racy = racy
+        self.listings = OrderedDict() # path -> (mtime_ns, inode, dirs, files)
+        self.lock = threading.Lock()
+
+    def list(self, path):
+        """
+        List a directory.
+
+        :param path: the directory to list.
+        :return: a tuple containing sorted lists of subdirectory and file names.
+        """
+        path = str(path)
+        st = os.stat(path)
+        with self.lock:
+            entry = self.listings.get(path, None)
+            if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_ino:
+                self.listings.move_to_end(path)
+                return entry[2], entry[3]
+
+        # (re)build listing using the file type information returned by scandir (no stat per entry)
+        dirs, files = [], []
+        with os.scandir(path) as it:
+            for e in it:
+                try:
+                    (dirs if e.is_dir() else files).append(e.name)
+                except OSError: # e.g. broken link or removed while listing
+                    files.append(e.name)
+        dirs, files = natsorted(dirs), natsorted(files)
+        if time.time() - st.st_mtime > self.racy:
+            with self.lock:
+                self.listings[path] = (st.st_mtime_ns, st.st_ino, dirs, files)
+                self.listings.move_to_end(path)
+                while len(self.listings) > self.maxsize:
+                    self.listings.popitem(last=False)
+        return dirs, files
+
+    def page(self, path, page=1, per=200, q=None):
+        """
+        Get one page of a (filtered) directory listing.
+
+        :param path: the directory to list.
+        :param page: the page to return (starting at 1).
+        :param per: the number of entries (directories and files) per page.
+        :param q: only include names containing this string (case insensitive). If q contains wildcards (* or ?)
+                  then it is matched as a glob pattern instead. Default is None (include everything).
+        :return: a tuple containing lists of subdirectory and file names on this page, and the total number of pages.
+        """
+        dirs, files = self.list(path)
+        if q:
+            q = q.lower()
+            if '*' in q or '?' in q:
+                match = lambda n: fnmatch(n.lower(), q)
+            else:
+                match = lambda n: q in n.lower()
+            dirs = [d for d in dirs if match(d)]
+            files = [f for f in files if match(f)]
+        per = max(1, int(per))
+        pages = max(1, (len(dirs) + len(files) + per - 1) // per)
+        start = (min(max(1, int(page)), pages) - 1) * per
+        end = start + per
+        return dirs[start:end], files[max(0, start - len(dirs)):max(0, end - len(dirs))], pages
@@ -0,0 +1,149 @@
+"""
+Grow and shrink the (local) worker pool while crunchy is running, based on the number of outstanding jobs, how long
+jobs take and how busy the host is (see crunchy_settings['autoscale']).
+"""
+import os
+import math
+import time
+import threading
+
+MAXLOAD = 1.0 # don't add workers while the load average per CPU is above this
+MINMEM = 0.1 # remove workers while less than this fraction of memory is available
+
+def target( n, demand, duration, settings, load=None, memory=None ):
+    """
+    Return the number of workers that should be used.
+
+    :param n: the current number of workers.
+    :param demand: the number of jobs that are queued or running (including new files waiting to be passed to the
+                   workflow).
+    :param duration: the typical time (seconds) that jobs take, or None if this is not known yet.
+    :param settings: the crunchy settings. Workers are added until the outstanding jobs should be finished within
+                     settings['scaletime'] seconds, between settings['minthreads'] and settings['maxthreads'].
+    :param load: the load average per CPU, or None if this is not known. Default is None.
+    :param memory: the fraction of memory that is available, or None if this is not known. Default is None.
+    """
+    lo = int(settings.get('minthreads', 1))
+    hi = max(lo, int(settings.get('maxthreads', lo)))
+    if demand <= 0:
+        want = lo
+    elif duration is None: # one worker per job until we know how long they take
+        want = demand
+    else:
+        want = min(demand, math.ceil(demand * duration / max(float(settings.get('scaletime', 60)), 1e-3)))
+    if memory is not None and memory < MINMEM:
+        want = min(want, n - 1)
+    elif load is not None and load > MAXLOAD:
+        want = min(want, n)
+    return int(min(max(want, lo), hi))
+
+def hostLoad():
+    """
+    Return the (1 minute) load average per CPU and the fraction of memory that is available. Either will be None if
+    it cannot be determined on this system.
+    """
+    load, memory = None, None
+    try:
+        load = os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        pass
+    try:
+        info = _meminfo()
+        memory = info['MemAvailable'] / info['MemTotal']
+    except (OSError, KeyError, ValueError, ZeroDivisionError):
+        pass
+    return load, memory
+
+def hostMemory():
+    """
+    Return the total memory (Mb) of this host, or None if it cannot be determined on this system.
+    """
+    try:
+        return _meminfo()['MemTotal'] / 1024
+    except (OSError, KeyError, ValueError):
+        return None
+
+def _meminfo():
+    info = {} # N.B. values are in kb
+    with open('/proc/meminfo') as f:
+        for line in f:
+            k, v = line.split(':', 1)
+            info[k] = float(v.split()[0])
+    return info
+
+class Autoscaler(object):
+    """
+    Thread (in the main crunchy thread) that periodically resizes the worker pool (see crunchy.resize()). If autoscaling
+    is disabled then the pool is only resized when settings['nthreads'] is changed. Workers are added as soon as they
+    are needed, but removed one at a time and only once they have not been needed for cooldown seconds, so that the
+    pool does not shrink between bursts of jobs.
+    """
+    def __init__(self, n, interval=2.0, cooldown=30.0):
+        """
+        :param n: the initial number of workers.
+        :param interval: the time (seconds) between checks. Default is 2.
+        :param cooldown: the time (seconds) fewer workers must be needed for before one is removed. Default is 30.
+        """
+        self.n = n
+        self.nthreads = None
+        self.interval = interval
+        self.cooldown = cooldown
+        self.low = None # time since which fewer workers have been needed
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._loop, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def _loop(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.step()
+            except (EOFError, OSError, BrokenPipeError): # crunchy is shutting down
+                break
+
+    def step(self):
+        """
+        Check the pool once, and resize it if needed.
+        """
+        import crunchy
+        if crunchy.endwhenempty.value or not crunchy.initialised():
+            return
+        s = crunchy.getSettings()
+        if self.nthreads is None:
+            self.nthreads = s.get('nthreads', self.n)
+        if not s.get('autoscale', False):
+            if s.get('nthreads', self.n) != self.nthreads: # changed at runtime
+                self.nthreads = s['nthreads']
+                self._resize(int(self.nthreads), "nthreads was changed")
+            return
+        demand = crunchy.pending.value + crunchy.getScoutStats()['backlog']
+        duration = crunchy.jobtime.value if crunchy.jobtime.value > 0 else None
+        load, memory = hostLoad()
+        want = target(self.n, demand, duration, s, load, memory)
+        if want > self.n or (memory is not None and memory < MINMEM and want < self.n):
+            self.low = None
+            self._resize(want, "%d jobs outstanding" % demand)
+        elif want < self.n:
+            if self.low is None:
+                self.low = time.time()
+            elif time.time() - self.low > self.cooldown:
+                self.low = time.time()
+                self._resize(self.n - 1, "%d jobs outstanding" % demand)
+        else:
+            self.low = None
+
+    def _resize(self, n, reason):
+        import crunchy
+        if n != self.n:
+            crunchy.log("Resizing worker pool from %d to %d (%s)" % (self.n, n, reason), crunchy.getLogDict(), master=True)
+            crunchy.resize(n)
+            self.n = n
@@ -0,0 +1,110 @@
+"""
+Checkpoints of the data dictionary passed between workflow functions, so that jobs that fail (or whose worker dies)
+can resume from the last completed step when they are retried or crunchy is restarted (see the checkpoint argument
+of fileTrigger and jobTrigger).
+
+Each checkpoint is a directory containing a pickle of the data dictionary and one .npy file for each large array in it.
+These arrays are memory-mapped (copy-on-write) when the checkpoint is loaded, so they are only read as needed.
+"""
+import os
+import uuid
+import shutil
+import hashlib
+from pathlib import Path
+import numpy as np
+import dill
+
+MMAP = 1024**2 # arrays larger than this (bytes) are stored as separate .npy files
+
+def getFolder( data, flow, outpath, signature=None ):
+    """
+    Return the directory that checkpoints for a job are stored in. This depends on the path that triggered the job,
+    the signature of its contents (see signature()) and the names of the workflow functions, so that a job run again
+    for the same path resumes from the same checkpoint unless its input has changed since.
+    """
+    key = "%s|%s|%s" % (data.get('path', ''), signature or '', ",".join([f.__name__ for f in flow]))
+    return Path(outpath) / '.crunchy' / 'checkpoints' / hashlib.sha1(key.encode()).hexdigest()
+
+def signature( path ):
+    """
+    Return a fingerprint of the file or directory that triggered a job: the size and modification time of a file, or
+    the number, total size and latest modification time of the files in a directory. This is computed once, when the
+    job is submitted (see trigger.fileTrigger), so it does not change when the job is retried.
+
+    :return: a string, or None if path does not exist.
+    """
+    try:
+        st = os.stat(path)
+    except (OSError, TypeError, ValueError):
+        return None
+    if not os.path.isdir(path):
+        return "%d|%d" % (st.st_size, st.st_mtime_ns)
+    n, size, mtime = 0, 0, 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                st = os.stat(os.path.join(root, f))
+            except OSError: # e.g. removed since listing directory
+                continue
+            n, size, mtime = n + 1, size + st.st_size, max(mtime, st.st_mtime_ns)
+    return "%d|%d|%d" % (n, size, mtime)
+
+def save( folder, step, data ):
+    """
+    Store the data dictionary after a number of workflow steps have completed. The previous checkpoint is only removed
+    once this one has been written.
+
+    :param folder: the checkpoint directory (see getFolder()).
+    :param step: the number of workflow functions that have completed.
+    :param data: the data dictionary.
+    """
+    folder = Path(folder)
+    os.makedirs(folder, exist_ok=True)
+    tmp = folder / ('.tmp-%s' % uuid.uuid4().hex)
+    os.makedirs(tmp)
+    try:
+        state = {}
+        arrays = []
+        for k, v in data.items():
+            if isinstance(v, np.ndarray) and v.nbytes >= MMAP:
+                np.save(tmp / ('%d.npy' % len(arrays)), v)
+                arrays.append(k)
+            else:
+                state[k] = v
+        with open(tmp / 'data.pkl', 'wb') as f:
+            dill.dump(dict(step=step, data=state, arrays=arrays), f)
+        os.rename(tmp, folder / ('step%d' % step)) # N.B. atomic, so incomplete checkpoints are never loaded
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    for p in folder.iterdir(): # remove older checkpoints
+        if p.name.startswith('step') and p.name != 'step%d' % step:
+            shutil.rmtree(p, ignore_errors=True)
+
+def load( folder ):
+    """
+    Load the most recent checkpoint.
+
+    :param folder: the checkpoint directory (see getFolder()).
+    :return: a tuple containing the number of workflow functions that had completed and the data dictionary, or
+             (0, None) if there is no checkpoint.
+    """
+    folder = Path(folder)
+    if not folder.exists():
+        return 0, None
+    steps = [int(p.name[4:]) for p in folder.iterdir() if p.name.startswith('step') and p.name[4:].isdigit()]
+    if len(steps) == 0:
+        return 0, None
+    path = folder / ('step%d' % max(steps))
+    with open(path / 'data.pkl', 'rb') as f:
+        state = dill.load(f)
+    data = state['data']
+    for i, k in enumerate(state['arrays']):
+        data[k] = np.load(path / ('%d.npy' % i), mmap_mode='c') # changes are not written back to the checkpoint
+    return state['step'], data
+
+def clear( folder ):
+    """
+    Delete all checkpoints for a job (e.g. once it has completed, or has failed on every attempt).
+    """
+    shutil.rmtree(folder, ignore_errors=True)
@@ -0,0 +1,42 @@
+"""
+Read-only snapshots of the crunchy settings that can be used by worker and control threads without querying
+the (shared) settings dictionary every time a value is needed.
+"""
+from collections.abc import Mapping
+
+class Settings(Mapping):
+    """
+    An immutable (dictionary-like) copy of the crunchy settings at a specific version. Settings should be changed using
+    crunchy.updateSettings(...), which increments the version so that each thread refreshes its copy.
+    """
+    def __init__(self, values, version=0):
+        """
+        :param values: a dictionary of settings values (this will be copied).
+        :param version: the version number of these settings.
+        """
+        self._values = dict(values)
+        self.version = version
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __setitem__(self, key, value):
+        raise TypeError("Settings are read-only. Use crunchy.updateSettings(%s=...) to change them." % key)
+
+    def __delitem__(self, key):
+        raise TypeError("Settings are read-only.")
+
+    def copy(self):
+        """
+        Return a (mutable) dictionary containing these settings.
+        """
+        return dict(self._values)
+
+    def __repr__(self):
+        return "Settings(version=%d, %s)" % (self.version, self._values)
@@ -5,6 +5,13 @@ import traceback
 from crunchy import log
 from crunchy import getLogDict
 
+class JobError(Exception):
+    """
+    Raised (e.g. by Future.result()) when a job submitted to crunchy fails. The message contains the traceback
+    of the original exception (which was raised in a worker thread).
+    """
+    pass
+
 # error loggers
 def logAndStop( logDict, E, *, function, data, outpath, settings ):
     err = "EXCEPTION TRACE  PRINT:\n{}".format( "".join(traceback.format_exception(type(E), E, E.__traceback__)))
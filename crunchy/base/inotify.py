@@ -0,0 +1,142 @@
+"""
+Minimal ctypes wrapper around the Linux inotify API. This is used by the event-driven scout backend
+so that new files can be discovered without repeatedly listing every hot directory.
+"""
+import os
+import sys
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# event flags (see inotify(7))
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# events that can change the size of a file or directory
+MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+        IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+_header = struct.Struct('iIII') # wd, mask, cookie, len
+_libc = None
+
+def _getLibc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    return _libc
+
+def available():
+    """
+    Return True if inotify can be used on this system (i.e. we are running on Linux).
+    """
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        return hasattr(_getLibc(), 'inotify_init1')
+    except OSError:
+        return False
+
+class Watcher(object):
+    """
+    Watch a set of directories for changes using inotify. Note that (like inotify itself) this is not
+    recursive; each directory that should be monitored must be added with add(...).
+    """
+    def __init__(self):
+        libc = _getLibc()
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, "Could not initialise inotify: %s" % os.strerror(e))
+        self.wd = {} # watch descriptor -> directory path
+        self.paths = {} # directory path -> watch descriptor
+
+    def add(self, path):
+        """
+        Start watching the specified directory.
+
+        :param path: the directory to watch.
+        :return: True if the watch was added, or False if the directory has vanished.
+        :raises OSError: if the watch could not be added, e.g. with errno.ENOSPC if the kernel limit on the number of
+                         watches (fs.inotify.max_user_watches) has been reached.
+        """
+        path = str(path)
+        if path in self.paths:
+            return True
+        wd = _getLibc().inotify_add_watch(self.fd, os.fsencode(path), MASK | IN_ONLYDIR)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                return False # directory was removed (or is not readable); ignore it
+            raise OSError(e, "Could not watch %s: %s" % (path, os.strerror(e)))
+        self.wd[wd] = path
+        self.paths[path] = wd
+        return True
+
+    def remove(self, path):
+        """
+        Stop watching the specified directory (and any subdirectories).
+        """
+        path = str(path)
+        for p in [p for p in self.paths if p == path or p.startswith(path + os.sep)]:
+            wd = self.paths.pop(p)
+            del self.wd[wd]
+            _getLibc().inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """
+        Wait for (at most) timeout seconds for events and return them.
+
+        :param timeout: the maximum time to wait for, in seconds. None waits forever.
+        :return: a list of (directory, name, mask) tuples. If the kernel event queue overflowed an event with
+                 directory = None and mask = IN_Q_OVERFLOW will be included.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        out = []
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            i = 0
+            while i + _header.size <= len(buf):
+                wd, mask, cookie, n = _header.unpack_from(buf, i)
+                name = buf[i + _header.size:i + _header.size + n].rstrip(b'\0')
+                i += _header.size + n
+                if mask & IN_Q_OVERFLOW:
+                    out.append((None, '', mask))
+                    continue
+                if mask & IN_IGNORED: # watch was removed (e.g. directory deleted)
+                    p = self.wd.pop(wd, None)
+                    if p is not None:
+                        self.paths.pop(p, None)
+                    continue
+                if wd in self.wd:
+                    out.append((self.wd[wd], os.fsdecode(name), mask))
+        return out
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.wd.clear()
+        self.paths.clear()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
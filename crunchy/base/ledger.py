@@ -0,0 +1,146 @@
+"""
+Persistent (SQLite) record of the files crunchy has discovered, the outcome of each file trigger and the status
+of the resulting jobs. This allows crunchy to be restarted without re-processing files that have not changed.
+"""
+import os
+import json
+import sqlite3
+import time
+
+_schema = """
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, discovered REAL);
+CREATE TABLE IF NOT EXISTS triggers (path TEXT, trigger TEXT, outcome INTEGER, time REAL, PRIMARY KEY (path, trigger));
+CREATE TABLE IF NOT EXISTS jobs (path TEXT PRIMARY KEY, status INTEGER, queued REAL, started REAL, finished REAL,
+                                 trigger TEXT, error TEXT, result TEXT);
+CREATE TABLE IF NOT EXISTS artefacts (path TEXT PRIMARY KEY, finished REAL, trigger TEXT, key TEXT);
+"""
+
+class Ledger(object):
+    """
+    Wrapper around a SQLite database used to store the state of a crunchy workflow. Each process should open
+    its own Ledger (SQLite connections cannot be shared between processes).
+    """
+    def __init__(self, path):
+        """
+        :param path: the path to the SQLite database file. This will be created if it does not exist.
+        """
+        self.path = str(path)
+        self.pid = os.getpid()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.db = sqlite3.connect(self.path, timeout=60.0, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL") # allow reads while workers are writing
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(_schema)
+        if 'result' not in [r[1] for r in self.db.execute("PRAGMA table_info(jobs)")]: # created by an older version
+            self.db.execute("ALTER TABLE jobs ADD COLUMN result TEXT")
+
+    def discovered(self, files):
+        """
+        Record a batch of new files.
+
+        :param files: a dictionary with file paths as keys and their size as values.
+        """
+        now = time.time()
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO files VALUES (?,?,?)",
+                                [(str(p), int(s), now) for p, s in files.items()])
+
+    def outcomes(self, outcomes):
+        """
+        Record the result of a batch of file triggers.
+
+        :param outcomes: a list of (path, trigger name, status) tuples, where status is e.g. trigger.PROCESS.
+        """
+        now = time.time()
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO triggers VALUES (?,?,?,?)",
+                                [(str(p), str(t), int(s), now) for p, t, s in outcomes])
+
+    def job(self, path, status):
+        """
+        Record a change in job status.
+
+        :param path: the path that the job was triggered by.
+        :param status: 0 if queued, 1 if running, 2 if complete or -1 if failed (see crunchy.getProgress).
+        """
+        now = time.time()
+        with self.db:
+            if status == 0:
+                self.db.execute("INSERT OR REPLACE INTO jobs (path, status, queued) VALUES (?,0,?)", (str(path), now))
+            else:
+                col = 'started' if status == 1 else 'finished'
+                self.db.execute("UPDATE jobs SET status=?, %s=? WHERE path=?" % col, (int(status), now, str(path)))
+
+    def finished(self, record):
+        """
+        Record a finished job. The summaries returned by workflow jobs (their key and outputs; see trigger._job) are
+        also stored, so that job triggers can be restored when crunchy is restarted.
+
+        :param record: the job record, as returned by crunchy.collect().
+        """
+        status = 2 if record['error'] is None else -1
+        result = record.get('result', None)
+        try:
+            result = json.dumps(result) if isinstance(result, dict) and 'key' in result else None
+        except (TypeError, ValueError): # not a job summary
+            result = None
+        with self.db:
+            self.db.execute("""INSERT OR REPLACE INTO jobs VALUES (?,?,?,?,?,?,?,?)""",
+                            (str(record['path']), status, record['queued'], record['started'], record['finished'],
+                             record['trigger'], record['error'], result))
+
+    def jobs(self):
+        """
+        Get all job information.
+
+        :return: a list of dictionaries with path, status, queued, started, finished, trigger, error and result keys.
+                 The result is the summary returned by completed workflow jobs (see finished()), or None.
+        """
+        cols = ['path', 'status', 'queued', 'started', 'finished', 'trigger', 'error', 'result']
+        rows = self.db.execute("SELECT %s FROM jobs" % ",".join(cols))
+        out = [dict(zip(cols, r)) for r in rows]
+        for j in out:
+            j['result'] = None if j['result'] is None else json.loads(j['result'])
+        return out
+
+    def produced(self, artefacts):
+        """
+        Record output files produced by completed jobs (see crunchy.getArtefacts()).
+
+        :param artefacts: a list of (path, finished, trigger, key) tuples.
+        """
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO artefacts VALUES (?,?,?,?)", artefacts)
+
+    def artefacts(self, n=None):
+        """
+        Get the most recently produced output files.
+
+        :param n: the number of output files to return. Default is None (all of them).
+        :return: a list of (path, finished, trigger, key) tuples, oldest first.
+        """
+        rows = self.db.execute("""SELECT path, finished, trigger, key FROM artefacts
+                                  ORDER BY finished DESC, rowid DESC LIMIT ?""", (-1 if n is None else int(n),))
+        return [tuple(r) for r in rows][::-1]
+
+    def known(self):
+        """
+        Get the files that have been fully processed, i.e. that were passed to all file triggers, that no
+        trigger wanted to see again (trigger.WAIT) and for which all jobs were completed.
+
+        :return: a dictionary with file paths as keys and their size (when they were discovered) as values.
+        """
+        from crunchy.base.trigger import WAIT
+        rows = self.db.execute("""SELECT path, size FROM files WHERE
+                                  path NOT IN (SELECT path FROM triggers WHERE outcome=?) AND
+                                  path NOT IN (SELECT path FROM jobs WHERE status!=2)""", (WAIT,))
+        return {p: s for p, s in rows}
+
+    def progress(self):
+        """
+        Get the status of all jobs as a dictionary (see crunchy.getProgress).
+        """
+        return {p: s for p, s in self.db.execute("SELECT path, status FROM jobs")}
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,188 @@
+"""
+Logging for crunchy threads. Messages are sent (through a queue) to the thread that created the log, where they are
+stored in a fixed-size ring buffer for each thread and (optionally) written to a rotating log file.
+"""
+import os
+import time
+import logging
+import threading
+from collections import deque
+from logging.handlers import RotatingFileHandler
+from multiprocess.context import get_spawning_popen
+
+class LogBook(object):
+    """
+    Collects log messages from all crunchy threads. This behaves like a read-only dictionary with the PID of each thread
+    (and 'master') as keys and its most recent messages (as a single string) as values. Use tail(...) to get
+    individual messages without joining them.
+
+    N.B. messages can be written from any thread, but only the thread that created the LogBook can read them. When
+    passed to another thread (e.g. as part of a job) a LogBook becomes a reference to that thread's own log.
+    """
+    def __init__(self, queue, maxlen=1000):
+        """
+        :param queue: a (multiprocess) queue used to send messages from other threads.
+        :param maxlen: the maximum number of messages to keep for each thread. Older messages are discarded.
+        """
+        self.queue = queue
+        self.maxlen = maxlen
+        self.owner = os.getpid()
+        self.buffers = dict(master=deque(["[%s][%d] Logging started." % (_now(), self.owner)], maxlen=maxlen))
+        self.lock = threading.Lock()
+        self.file = None
+        self.thread = None
+        self.flushed = {}
+
+    def __reduce__(self):
+        if get_spawning_popen() is not None: # we are starting a new thread, so send everything needed to write logs
+            return (_unpickle, (self.queue, self.maxlen, self.owner))
+        from crunchy import getLogDict
+        return (getLogDict, ()) # resolve to the log of the receiving thread
+
+    def write(self, message, master=False):
+        """
+        Add a message to the log of the calling thread (and the master log, if master is True).
+        """
+        entry = (time.time(), os.getpid(), bool(master), str(message))
+        if os.getpid() == self.owner:
+            self._store(entry)
+        else:
+            self.queue.put(entry)
+
+    def start(self):
+        """
+        Start a thread that receives messages from other threads.
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._listen, daemon=True)
+            self.thread.start()
+
+    def close(self):
+        """
+        Stop receiving messages from other threads and close the log file. Messages that have already been
+        received can still be read.
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.setFile(None)
+
+    def flush(self, timeout=5.0):
+        """
+        Wait until all messages that were sent before this call have been received.
+        """
+        if self.thread is None or not self.thread.is_alive():
+            return
+        event = threading.Event()
+        key = id(event)
+        self.flushed[key] = event
+        self.queue.put(('flush', key))
+        event.wait(timeout)
+        self.flushed.pop(key, None)
+
+    def setFile(self, path, maxbytes=10*1024**2, backups=5):
+        """
+        Also write log messages to a (rotating) log file.
+
+        :param path: the log file. Set as None to stop writing to a file.
+        :param maxbytes: the size of log file at which it is rotated. Default is 10 Mb.
+        :param backups: the number of old log files to keep. Default is 5.
+        """
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if path is not None:
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                self.file = RotatingFileHandler(str(path), maxBytes=maxbytes, backupCount=backups)
+                self.file.setFormatter(logging.Formatter("%(asctime)s [%(process)d] %(message)s"))
+
+    def tail(self, key, n=None):
+        """
+        Return a list containing the last n messages logged by a thread (or all stored messages if n is None).
+        """
+        with self.lock:
+            b = self.buffers.get(key, [])
+            if n is None or n >= len(b):
+                return list(b)
+            return [b[i] for i in range(len(b) - n, len(b))]
+
+    def _listen(self):
+        while True:
+            try:
+                entry = self.queue.get()
+            except (EOFError, OSError): # the queue was closed (e.g. while exiting)
+                break
+            if entry is None:
+                break
+            if entry[0] == 'flush':
+                e = self.flushed.get(entry[1], None)
+                if e is not None:
+                    e.set()
+                continue
+            self._store(entry)
+
+    def _store(self, entry):
+        t, pid, master, message = entry
+        stamp = _now(t)
+        with self.lock:
+            if master:
+                self.buffers['master'].append("[%s][%d] %s." % (stamp, pid, message))
+            if pid not in self.buffers:
+                self.buffers[pid] = deque(maxlen=self.maxlen)
+            self.buffers[pid].append("[%s] %s." % (stamp, message))
+            if self.file is not None:
+                record = logging.makeLogRecord(dict(msg=message, created=t, msecs=(t % 1) * 1000, process=pid,
+                                                    levelno=logging.INFO, levelname='INFO'))
+                self.file.emit(record)
+
+    # read-only dictionary interface
+    def __getitem__(self, key):
+        if key not in self.buffers:
+            raise KeyError(key)
+        return "\n".join(self.tail(key)) + "\n"
+
+    def get(self, key, default=None):
+        return self[key] if key in self.buffers else default
+
+    def keys(self):
+        with self.lock:
+            return list(self.buffers.keys())
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, key):
+        return key in self.buffers
+
+    def __len__(self):
+        return len(self.buffers)
+
+class Relay(object):
+    """
+    Queue-like object that sends log messages through a connection (e.g. a pipe) rather than a shared queue. This is
+    used by jobs running in their own process (see crunchy._isolate()), so that killing them cannot leave the lock of
+    the shared queue held.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def put(self, entry):
+        with self.lock:
+            self.conn.send(('LOG', entry))
+
+def _unpickle(queue, maxlen, owner):
+    out = LogBook(queue, maxlen)
+    out.owner = owner
+    return out
+
+def _now(t=None):
+    return time.strftime("%H:%M:%S", time.localtime(t))
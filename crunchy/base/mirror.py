@@ -1,10 +1,18 @@
 from datetime import datetime
 import os
-from shutil import copy2
+import uuid
+import json
+import hashlib
+from shutil import copystat, copyfileobj
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import time
 import numpy as np
 
-def mirror( local_path, remote_path, sleeptime=5.0, maxiter=np.inf, delete = False, debug=True ):
+PART = '.crunchy-part-' # prefix of partially copied files (these are ignored by crunchy scouts)
+MANIFEST = os.path.join('.crunchy', 'manifest.json') # default location (in each mirrored directory) of chunk hashes
+
+def mirror( local_path, remote_path, sleeptime=5.0, maxiter=np.inf, delete = False, debug=True, workers=4,
+            bufsize=8*1024**2, manifest=False, chunksize=4*1024**2, manifests=None ):
     """
 
     Mirrors a local directory with a remote one to facilitate data transfer from a local machine to remote
@@ -16,6 +24,19 @@ def mirror( local_path, remote_path, sleeptime=5.0, maxiter=np.inf, delete = Fal
      - maxiter = the maximum number of iterations to run mirror. Default is inf (run forever).
      - delete = True if files in remote but not in local should be deleted. Dangerous - use with care!! (Default is False).
      - sleeptime = the sleep time between checks on directory. Default is 10 seconds.
+     - workers = the number of files to copy at once. Default is 4.
+     - bufsize = the buffer size (bytes) used to copy files if they cannot be copied by the kernel (see _copy). Default
+                 is 8 Mb.
+     - manifest = True if files should be compared using their size and modification time (rather than only their size),
+                  and only the chunks of modified files that differ from the remote copy should be sent. The hashes
+                  of each chunk are stored in a manifest file on both sides, so that unchanged files are not read
+                  again. Default is False.
+     - chunksize = the size (bytes) of the chunks that are compared if manifest is True. Default is 4 Mb.
+     - manifests = the directory to store manifests in. Default is None (the .crunchy directory in the root of each
+                   mirrored directory, which is not mirrored).
+
+    Files are copied to a temporary file (starting with .crunchy-part-) which is renamed once the copy is complete, so
+    that partial files are never visible under their real name on the remote side.
     """
 
     if debug:
@@ -28,6 +49,12 @@ def mirror( local_path, remote_path, sleeptime=5.0, maxiter=np.inf, delete = Fal
     # init directory maps
     local = {} # key = path, value = size
     waiting = False # print "waiting..." when no files are copying
+    pool = ThreadPoolExecutor(max_workers=max(1, int(workers)))
+    if manifest:
+        lfile = _manifest_file( local_path, manifests )
+        rfile = _manifest_file( remote_path, manifests )
+        lman = _load_manifest( lfile, chunksize )
+        rman = _load_manifest( rfile, chunksize )
     i = 0
     while i < maxiter: # loop indefinitely
 
@@ -38,8 +65,8 @@ def mirror( local_path, remote_path, sleeptime=5.0, maxiter=np.inf, delete = Fal
             os.makedirs(remote_path) # create outdir if necessary
 
         # map local and remote directories
-        L = _scrape_( local_path, local_path )
-        R = _scrape_( remote_path, remote_path )
+        L = _scrape_( local_path, local_path, stat=manifest )
+        R = _scrape_( remote_path, remote_path, stat=manifest )
 
         # remove keys with unstable filesize
         for key, val in L.items():
@@ -47,10 +74,10 @@ def mirror( local_path, remote_path, sleeptime=5.0, maxiter=np.inf, delete = Fal
                 if local[key] != L[key]: # file-size differ
                     del local[key] # remove this file for this iteration
 
-        # sleep here to ensure that sleeptime is guaranteed
-        time.sleep(sleeptime)
-        
-        # copy new / modified files
+        # copy new / modified files (in parallel). N.B. files are only copied once their size has been stable
+        # for at least one pass (i.e. sleeptime seconds)
+        jobs = {}
+        changed = False # True if the manifests need to be stored
         for key, val in local.items():
             if (key in R) and R[key] == local[key]:
                 continue # no need to copy
@@ -60,9 +87,28 @@ def mirror( local_path, remote_path, sleeptime=5.0, maxiter=np.inf, delete = Fal
                     now = datetime.now()
                     dt = now.strftime("%d/%m/%Y %H:%M:%S")
                     print("[%s] Copying new %s to remote." % (dt, key,))
-                os.makedirs(os.path.dirname(os.path.join(remote_path, key )), exist_ok=True)
-                copy2( os.path.join(local_path, key), os.path.join(remote_path, key ) ) # N.B. this will block until copying is complete!
+                if manifest:
+                    jobs[pool.submit(_sync, os.path.join(local_path, key), os.path.join(remote_path, key),
+                                     lman['files'].get(key, None), rman['files'].get(key, None),
+                                     chunksize, bufsize)] = key
+                else:
+                    jobs[pool.submit(_copy, os.path.join(local_path, key), os.path.join(remote_path, key), bufsize)] = key
+        for f in as_completed(jobs): # wait for this pass to finish
+            key = jobs[f]
+            try:
+                out = f.result()
                 R[key] = local[key] # update
+                if manifest:
+                    lman['files'][key], rman['files'][key], n = out
+                    changed = True
+                    if debug and n is not None:
+                        now = datetime.now()
+                        dt = now.strftime("%d/%m/%Y %H:%M:%S")
+                        print("[%s] Sent %d of %d chunks of %s." % (dt, n, len(out[0]['chunks']), key))
+            except OSError as E: # try again next pass
+                now = datetime.now()
+                dt = now.strftime("%d/%m/%Y %H:%M:%S")
+                print("[%s] Error copying %s: %s" % (dt, key, E))
 
         # delete files in remote that are not in local
         if delete:
@@ -77,6 +123,14 @@ def mirror( local_path, remote_path, sleeptime=5.0, maxiter=np.inf, delete = Fal
                         os.removedirs( os.path.dirname( os.path.join( remote_path, key ) ) )
 
         local = L # update local map
+        if manifest: # forget files that no longer exist and store manifests (if they changed)
+            for m, D in [(lman, L), (rman, R)]:
+                for key in [k for k in m['files'] if k not in D]:
+                    del m['files'][key]
+                    changed = True
+            if changed:
+                _save_manifest( lfile, lman )
+                _save_manifest( rfile, rman )
         
         if debug and not waiting:
             waiting = True
@@ -85,22 +139,162 @@ def mirror( local_path, remote_path, sleeptime=5.0, maxiter=np.inf, delete = Fal
         # sleep
         time.sleep(sleeptime)
         i += 1
+    pool.shutdown()
+
+def _copy( src, dst, bufsize=8*1024**2 ):
+    """
+    Copy a file (and its metadata) to a temporary file next to dst, and then rename it to dst. Data is copied within the
+    kernel (using copy_file_range or sendfile) where possible, or using a large buffer otherwise.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = os.path.join(os.path.dirname(dst), "%s%s-%s" % (PART, uuid.uuid4().hex[:8], os.path.basename(dst)))
+    try:
+        with open(src, 'rb') as fi, open(tmp, 'wb') as fo:
+            _transfer(fi, fo, os.fstat(fi.fileno()).st_size, bufsize)
+        copystat(src, tmp)
+        os.replace(tmp, dst) # N.B. this is atomic
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def _sync( src, dst, lentry, rentry, chunksize, bufsize=8*1024**2 ):
+    """
+    Update dst to match src, only writing the chunks that differ between them (as determined by their manifest entries,
+    which are recomputed if they are missing or outdated). The remote file is cloned (within the kernel where
+    possible) to a temporary file that is then patched and renamed to dst, so that changes appear atomically.
+
+    Returns a tuple containing the (updated) manifest entries of src and dst, and the number of chunks that were sent
+    (or None if src was copied in full).
+    """
+    lentry = _entry( src, chunksize, lentry )
+    if not os.path.exists(dst):
+        _copy( src, dst, bufsize )
+        n = None
+    else:
+        rentry = _entry( dst, chunksize, rentry )
+        old = rentry['chunks']
+        changed = [i for i, h in enumerate(lentry['chunks']) if i >= len(old) or old[i] != h]
+        n = len(changed)
+        if n > 0 or lentry['size'] != rentry['size']:
+            tmp = os.path.join(os.path.dirname(dst), "%s%s-%s" % (PART, uuid.uuid4().hex[:8], os.path.basename(dst)))
+            try:
+                with open(dst, 'rb') as fi, open(tmp, 'wb') as fo:
+                    _transfer(fi, fo, min(lentry['size'], rentry['size']), bufsize)
+                with open(src, 'rb') as fi, open(tmp, 'r+b') as fo:
+                    for c in changed:
+                        fi.seek(c * chunksize)
+                        fo.seek(c * chunksize)
+                        fo.write(fi.read(chunksize))
+                    fo.truncate(lentry['size'])
+                copystat(src, tmp)
+                os.replace(tmp, dst)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+        else:
+            copystat(src, dst) # only metadata differs
+    st = os.stat(dst)
+    return lentry, dict(size=st.st_size, mtime=st.st_mtime_ns, chunks=lentry['chunks']), n
+
+def _entry( path, chunksize, entry=None ):
+    """
+    Return the manifest entry (size, modification time and chunk hashes) of a file. The file is only read if the
+    specified entry is None or does not match its size and modification time.
+    """
+    st = os.stat(path)
+    if entry is not None and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime_ns:
+        return entry
+    chunks = []
+    with open(path, 'rb') as f:
+        while True:
+            b = f.read(chunksize)
+            if not b:
+                break
+            chunks.append(hashlib.blake2b(b, digest_size=16).hexdigest())
+    return dict(size=st.st_size, mtime=st.st_mtime_ns, chunks=chunks)
+
+def _manifest_file( path, manifests=None ):
+    """
+    Return the file that the manifest of a mirrored directory is stored in (see the manifests argument of mirror).
+    """
+    if manifests is None:
+        return os.path.join(path, MANIFEST)
+    key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+    return os.path.join(manifests, "%s-%s.json" % (os.path.basename(os.path.abspath(path)), key))
+
+def _load_manifest( path, chunksize ):
+    """
+    Load a manifest file (or create an empty manifest if it does not exist or used a different chunk size).
+    """
+    try:
+        with open(path, 'r') as f:
+            m = json.load(f)
+        if m.get('chunksize', None) == chunksize:
+            return m
+    except (OSError, ValueError):
+        pass
+    return dict(chunksize=chunksize, files={})
+
+def _save_manifest( path, m ):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = os.path.join(os.path.dirname(path), "%s%s" % (PART, os.path.basename(path)))
+    with open(tmp, 'w') as f:
+        json.dump(m, f)
+    os.replace(tmp, path)
 
-def _scrape_( p, base ):
+def _transfer( fi, fo, size, bufsize ):
     """
-    Add local files to dictionary and recurse on subdirectories.
+    Copy size bytes from one (open) file to another.
+
+    :raises OSError: if fewer than size bytes could be copied (e.g. the file was truncated while copying).
+    """
+    done = 0
+    for method in ['copy_file_range', 'sendfile']:
+        if not hasattr(os, method):
+            continue
+        try:
+            while done < size:
+                if method == 'copy_file_range':
+                    n = os.copy_file_range(fi.fileno(), fo.fileno(), size - done)
+                else:
+                    n = os.sendfile(fo.fileno(), fi.fileno(), done, min(size - done, 1024**3))
+                if n == 0: # end of file (or nothing copied by this method)
+                    break
+                done += n
+            else:
+                return
+            if done > 0:
+                break
+        except OSError: # not supported for this file system; fall back to next method
+            if done > 0:
+                raise
+    else:
+        copyfileobj(fi, fo, bufsize)
+        done = fo.tell()
+    if done < size:
+        raise OSError("Short copy of %s (%d of %d bytes); was it truncated?" % (fi.name, done, size))
+
+def _scrape_( p, base, stat=False ):
+    """
+    Add local files to dictionary and recurse on subdirectories. Values are file sizes, or tuples containing the size
+    and modification time (ns) of each file if stat is True.
     """
     out = {}
     for root, directories, files in os.walk(p):
         rel_root = os.path.relpath( root, base )
         if rel_root == '.': # avoid having '.' in paths
             rel_root = ''
+            directories[:] = [d for d in directories if not d.startswith('.crunchy')] # e.g. manifests
 
-        # add files
+        # add files (N.B. os.walk also visits subdirectories)
         for f in files:
-            out[ os.path.join(rel_root, f)] = os.path.getsize( os.path.join(root, f) )
-
-        # scrape subdirectories
-        for d in directories:
-            out = {**out, **_scrape_( os.path.join(root,d), base ) }
+            if f.startswith(PART) or (f.startswith('.crunchy') and rel_root == ''):
+                continue # ignore partially copied files and crunchy's own files
+            try:
+                st = os.stat( os.path.join(root, f) )
+                out[ os.path.join(rel_root, f)] = (st.st_size, st.st_mtime_ns) if stat else st.st_size
+            except OSError: # e.g. removed since listing directory
+                pass
     return out
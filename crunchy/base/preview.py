@@ -0,0 +1,217 @@
+"""
+Downsampled previews (thumbnails and tiles of an image pyramid) of result images and numpy arrays. Previews are
+rendered from (memory mapped) sources without loading them at full resolution where possible, and cached on disk
+until the source file is modified.
+"""
+import os
+import math
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+import crunchy
+
+TILE = 256 # size (pixels) of image pyramid tiles
+IMAGE_TYPES = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.gif')
+ARRAY_TYPES = ('.npy',)
+DECODED = 10**8 # maximum number of decoded image pixels kept in memory (see _decode)
+_decoded = OrderedDict() # (path, mtime, step) -> (source size, decoded image), least recently used first
+_decodedLock = threading.Lock()
+
+class TooLarge(ValueError):
+    """
+    Raised if an image has too many pixels to be decoded safely (see PIL.Image.MAX_IMAGE_PIXELS).
+    """
+
+def previewable( path ):
+    """
+    Return True if a preview can be rendered for the specified file (based on its extension).
+    """
+    return os.path.splitext(str(path))[1].lower() in IMAGE_TYPES + ARRAY_TYPES
+
+def getCache():
+    """
+    Return the directory that previews are cached in. This is in the output directory (if one is set) so that it can be
+    shared by workers (see makeThumbnails) and the crunchy app, or the system temporary directory otherwise.
+    """
+    outpath = crunchy.getSettings().get('outpath', None)
+    if outpath is not None:
+        return Path(outpath) / '.crunchy' / 'previews'
+    return Path(tempfile.gettempdir()) / 'crunchy-previews'
+
+def thumbnail( path, size=256, cache=None ):
+    """
+    Get a thumbnail of an image or array, rendering it if it is not cached (or the source has changed since it was).
+
+    :param path: the image (or .npy) file.
+    :param size: the maximum width and height of the thumbnail. Default is 256 pixels.
+    :param cache: the directory to cache previews in. Default is getCache().
+    :return: the path to a (jpg) thumbnail.
+    :raises ValueError: if the file cannot be previewed.
+    :raises TooLarge: if the image has too many pixels to decode.
+    """
+    out, valid, st = _cached(path, 'thumb%d' % size, cache)
+    if not valid:
+        w, h = _shape(path)
+        step = max(1, max(w, h) // size) # subsample (cheaply) before resizing
+        img = _region(path, 0, 0, w, h, step)
+        img.thumbnail((size, size))
+        _save(img, out, st)
+    return out
+
+def info( path ):
+    """
+    Get the information needed to display an image pyramid (see tile(...)).
+
+    :return: a dictionary containing the width and height of the source, the tile size and the maximum zoom level.
+    """
+    w, h = _shape(path)
+    return dict(width=w, height=h, tilesize=TILE, maxzoom=_maxzoom(w, h))
+
+def tile( path, z, x, y, cache=None ):
+    """
+    Get a tile from an image pyramid, rendering it if it is not cached (or the source has changed since it was).
+    At zoom level 0 the whole image fits in one tile, and the resolution doubles with each level until the source
+    resolution is reached (at info(path)['maxzoom']).
+
+    :param path: the image (or .npy) file.
+    :param z: the zoom level.
+    :param x: the tile column.
+    :param y: the tile row.
+    :param cache: the directory to cache previews in. Default is getCache().
+    :return: the path to a (jpg) tile.
+    :raises ValueError: if the file cannot be previewed or the tile does not exist.
+    :raises TooLarge: if the image has too many pixels to decode.
+    """
+    out, valid, st = _cached(path, 'tile%d_%d_%d' % (z, x, y), cache)
+    if not valid:
+        w, h = _shape(path)
+        if z < 0 or z > _maxzoom(w, h):
+            raise ValueError("Invalid zoom level %d." % z)
+        scale = 2 ** (_maxzoom(w, h) - z) # source pixels per tile pixel
+        x0, y0 = x * TILE * scale, y * TILE * scale
+        if x < 0 or y < 0 or x0 >= w or y0 >= h:
+            raise ValueError("Tile %d/%d/%d is outside of the image." % (z, x, y))
+        img = _region(path, x0, y0, min(w, x0 + TILE * scale), min(h, y0 + TILE * scale), scale)
+        _save(img, out, st)
+    return out
+
+def makeThumbnails( data, outpath, settings ):
+    """
+    Workflow function that renders thumbnails of all outputs (see data['outputs']) that can be previewed, so that they
+    do not need to be rendered when first viewed. Add this to the end of a workflow (e.g. flow=[..., makeThumbnails]).
+    """
+    for o in data.get('outputs', []):
+        if previewable(o) and os.path.exists(o):
+            thumbnail(o)
+
+def _maxzoom( w, h ):
+    return max(0, int(math.ceil(math.log2(max(w, h) / TILE)))) if max(w, h) > 0 else 0
+
+def _cached( path, name, cache ):
+    """
+    Return the cache file for a preview of path, whether it is valid and the stat result of path.
+    """
+    if not previewable(path):
+        raise ValueError("Cannot preview %s." % path)
+    st = os.stat(path)
+    key = hashlib.sha1(("%s|%s" % (os.path.abspath(path), name)).encode()).hexdigest()
+    out = Path(cache if cache is not None else getCache()) / key[:2] / (key + '.jpg')
+    try:
+        valid = os.stat(out).st_mtime_ns == st.st_mtime_ns # previews are given the mtime of their source
+    except OSError:
+        valid = False
+    return out, valid, st
+
+def _save( img, out, st ):
+    os.makedirs(out.parent, exist_ok=True)
+    tmp = out.parent / ('%s.%d.%d.tmp' % (out.name, os.getpid(), threading.get_ident())) # N.B. unique per thread
+    img.convert('RGB').save(tmp, 'JPEG', quality=85)
+    os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(tmp, out) # N.B. atomic, so readers never see partial previews
+
+def _shape( path ):
+    """
+    Return the width and height of an image or array.
+    """
+    if str(path).lower().endswith(ARRAY_TYPES):
+        arr = np.load(path, mmap_mode='r')
+        if arr.ndim < 2 or arr.ndim > 3: # N.B. only (h, w) or (h, w, bands)
+            raise ValueError("Cannot preview %d-D array %s." % (arr.ndim, path))
+        return arr.shape[1], arr.shape[0]
+    from PIL import Image
+    try:
+        with Image.open(path) as im:
+            return im.size
+    except Image.DecompressionBombError as E:
+        raise TooLarge(str(E))
+
+def _region( path, x0, y0, x1, y1, step ):
+    """
+    Return a PIL image of the region x0:x1, y0:y1 of an image or array, downsampled by the specified (integer) step.
+    """
+    from PIL import Image
+    if str(path).lower().endswith(ARRAY_TYPES):
+        arr = np.load(path, mmap_mode='r') # N.B. only the sampled pixels are read
+        return Image.fromarray(_toRGB(np.asarray(arr[y0:y1:step, x0:x1:step]), _range(arr)))
+    full, img = _decode(path, step)
+    f = img.size[0] / full[0] # N.B. draft may have reduced the size of the decoded image
+    img = img.crop(tuple([int(v * f) for v in (x0, y0, x1, y1)]))
+    return img.resize((max(1, math.ceil((x1 - x0) / step)), max(1, math.ceil((y1 - y0) / step))))
+
+def _decode( path, step ):
+    """
+    Decode an image (at a reduced resolution, if the format supports this and step > 1) and return its full size and
+    the decoded (RGB) image. Recently decoded images are kept in memory, so that formats that must be decoded in full
+    (e.g. png or tif) are decoded once rather than once for each tile of the image pyramid.
+    """
+    from PIL import Image
+    st = os.stat(path)
+    try:
+        with Image.open(path) as im:
+            full = im.size
+            if step > 1 and not im.draft('RGB', (max(1, full[0] // step), max(1, full[1] // step))):
+                step = 1 # this format is always decoded in full
+            key = (os.path.abspath(path), st.st_mtime_ns, step)
+            with _decodedLock:
+                if key in _decoded:
+                    _decoded.move_to_end(key)
+                    return _decoded[key]
+            img = im.convert('RGB')
+    except Image.DecompressionBombError as E:
+        raise TooLarge(str(E))
+    with _decodedLock:
+        _decoded[key] = (full, img)
+        while len(_decoded) > 1 and sum(v[1].size[0] * v[1].size[1] for v in _decoded.values()) > DECODED:
+            _decoded.popitem(last=False) # forget the least recently used
+    return full, img
+
+def _range( arr ):
+    """
+    Return the (1st and 99th percentile) range used to scale an array to 0 - 255. This is estimated from a subsample
+    of the whole array, so that all tiles of an image are scaled consistently.
+    """
+    if arr.dtype == np.uint8:
+        return 0, 255
+    step = max(1, max(arr.shape[:2]) // 512)
+    sample = np.asarray(arr[::step, ::step], dtype=float)
+    sample = sample[np.isfinite(sample)]
+    if sample.size == 0:
+        return 0, 1
+    return np.percentile(sample, (1, 99))
+
+def _toRGB( arr, rng ):
+    """
+    Convert an array to an RGB (uint8) image.
+    """
+    if arr.ndim == 2:
+        arr = arr[..., None]
+    arr = arr[..., :3] if arr.shape[-1] >= 3 else arr[..., :1]
+    if arr.dtype != np.uint8:
+        mn, mx = rng
+        arr = (np.clip((np.nan_to_num(arr.astype(float)) - mn) / max(mx - mn, 1e-12), 0, 1) * 255).astype(np.uint8)
+    if arr.shape[-1] == 1:
+        arr = np.repeat(arr, 3, axis=-1)
+    return np.ascontiguousarray(arr)
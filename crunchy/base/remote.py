@@ -0,0 +1,184 @@
+"""
+Distributed execution. A coordinator (run by the main crunchy thread, see crunchy.listen()) lends jobs from the worker
+queue to remote workers (see crunchy.connect()) over TCP, e.g. on other servers that mount the same storage. Leases
+are kept alive by heartbeats sent while a job runs, and jobs leased by workers that disconnect or stop sending
+heartbeats are returned to the queue.
+"""
+import os
+import time
+import socket
+import threading
+from queue import Empty
+from multiprocess.connection import Listener, Client, AuthenticationError
+
+class Link(object):
+    """
+    A connection between a coordinator and a remote worker that can be written to by more than one thread.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def send(self, msg):
+        with self.lock:
+            self.conn.send(msg)
+
+    def recv(self):
+        return self.conn.recv()
+
+    def poll(self, timeout):
+        return self.conn.poll(timeout)
+
+    def close(self):
+        self.conn.close()
+
+class RemoteLog(object):
+    """
+    Log used by remote workers, which sends messages to the log of the main crunchy thread (see base.logs.LogBook).
+    """
+    def __init__(self, link):
+        self.link = link
+        self.owner = None
+
+    def write(self, message, master=False):
+        self.link.send(('LOG', (time.time(), os.getpid(), bool(master), str(message))))
+
+    def flush(self, timeout=5.0):
+        pass
+
+class Coordinator(object):
+    """
+    Accepts connections from remote workers and lends them jobs from the crunchy worker queue. Each connected
+    worker adds one to the number of jobs the control thread passes to the queue at once (see crunchy.dispatch()).
+    """
+    def __init__(self, address, authkey, timeout=60.0):
+        """
+        :param address: the (host, port) to listen on. Use port 0 to pick a free port.
+        :param authkey: the key (bytes) that remote workers must present to connect.
+        :param timeout: the time (in seconds) after the last message (e.g. heartbeat) from a worker that it is
+                        considered dead and any jobs it has leased are returned to the queue.
+        """
+        self.listener = Listener(tuple(address), authkey=authkey)
+        self.address = self.listener.address
+        self.authkey = authkey
+        self.timeout = timeout
+        self.workers = {} # worker name -> dict(host, pid, connected, seen, leased)
+        self.thread = None
+        self.closed = False
+
+    def start(self):
+        """
+        Start a thread that accepts connections from remote workers.
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._accept, daemon=True)
+            self.thread.start()
+
+    def close(self):
+        """
+        Stop accepting new workers. Connected workers are told to finish when they next ask for a job.
+        """
+        self.closed = True
+        self.listener.close()
+
+    def _accept(self):
+        while not self.closed:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                continue # N.B. the listener raises OSError once closed
+            threading.Thread(target=self._serve, args=(Link(conn),), daemon=True).start()
+
+    def _serve(self, link):
+        """
+        Handle messages from one remote worker until it disconnects.
+        """
+        import crunchy
+        name = None
+        leased = {} # job id -> job
+        capacity = crunchy.capacity
+        queue = crunchy.queue
+        try:
+            msg, host, pid = link.recv()
+            name = "%s:%d" % (host, pid)
+            version = crunchy.settings_version.value
+            link.send(('INIT', dict(crunchy.workerinit), dict(crunchy.settings.copy()), version))
+            self.workers[name] = dict(host=host, pid=pid, connected=time.time(), seen=time.time(), leased=0)
+            with capacity.get_lock():
+                capacity.value += 1
+            crunchy.log("Remote worker %s connected" % name, crunchy.logdict, master=True)
+            while True:
+                if not link.poll(self.timeout):
+                    raise TimeoutError("no heartbeat for %.1f seconds" % self.timeout)
+                msg = link.recv()
+                self.workers[name]['seen'] = time.time()
+                if msg[0] == 'LEASE':
+                    if self.closed or (crunchy.endwhenempty.value and crunchy.pending.value <= 0):
+                        link.send(('END',))
+                        break
+                    if not crunchy.active.is_set(): # paused
+                        time.sleep(0.5)
+                        link.send(('WAIT',))
+                        continue
+                    try:
+                        _, job = queue.get(True, 0.5)
+                    except Empty:
+                        link.send(('WAIT',))
+                        continue
+                    leased[job['id']] = job
+                    crunchy.setProgress(job['path'], 1)
+                    s = None
+                    if crunchy.settings_version.value != version: # send settings only when they change
+                        version = crunchy.settings_version.value
+                        s = dict(crunchy.settings.copy())
+                    link.send(('EXEC', job, s, version))
+                elif msg[0] == 'DONE':
+                    leased.pop(msg[1]['id'], None)
+                    crunchy.results.put(msg[1])
+                elif msg[0] == 'LOG':
+                    crunchy.logdict.queue.put(msg[1]) # N.B. as if written by another local thread
+                elif msg[0] == 'SET':
+                    crunchy.updateSettings(msg[1])
+                self.workers[name]['leased'] = len(leased)
+        except (EOFError, OSError, TimeoutError, ValueError) as E:
+            if name is not None:
+                crunchy.log("Remote worker %s disconnected (%s)" % (name, E), crunchy.logdict, master=True)
+        finally:
+            link.close()
+            if name is not None:
+                self.workers.pop(name, None)
+                with capacity.get_lock():
+                    capacity.value -= 1
+            for job in leased.values(): # give jobs held by this worker to someone else
+                crunchy.log("Requeuing %s (leased by %s)" % (job['path'], name), crunchy.logdict, master=True)
+                crunchy.setProgress(job['path'], 0)
+                queue.put(("EXEC", job))
+
+def heartbeat(link, interval, stop):
+    """
+    Send heartbeats to the coordinator (from a remote worker) until stop is set.
+    """
+    while not stop.wait(interval):
+        try:
+            link.send(('BEAT',))
+        except (OSError, ValueError):
+            break
+
+def connect(address, authkey):
+    """
+    Connect to a coordinator and return a Link.
+    """
+    link = Link(Client(tuple(address), authkey=authkey))
+    link.send(('HELLO', socket.gethostname(), os.getpid()))
+    return link
+
+if __name__ == '__main__': # e.g. CRUNCHY_AUTHKEY=... python -m crunchy.base.remote server 6000 4
+    import sys
+    import crunchy
+    host, port = sys.argv[1], int(sys.argv[2])
+    nworkers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    if not os.environ.get('CRUNCHY_AUTHKEY'):
+        sys.exit("Set CRUNCHY_AUTHKEY to the key used by the coordinator (see crunchy.listen()).")
+    authkey = os.environ['CRUNCHY_AUTHKEY'].encode()
+    for p in crunchy.connect((host, port), authkey, nworkers):
+        p.join()
@@ -0,0 +1,70 @@
+"""
+Scheduler used by the control thread to decide which queued job should be passed to the workers next.
+"""
+from collections import deque
+
+class Scheduler(object):
+    """
+    Holds jobs submitted in the control thread (one queue per trigger) and releases them in order of priority. Triggers
+    with the same priority share workers in proportion to their weight (using a simple virtual-time fair
+    queueing scheme), so that a large backlog from one trigger cannot starve the others.
+    """
+    def __init__(self):
+        self.queues = {} # trigger name -> deque of jobs
+        self.priority = {} # trigger name -> priority
+        self.weight = {} # trigger name -> weight
+        self.vtime = {} # trigger name -> virtual time (jobs dispatched / weight)
+
+    def add(self, job):
+        """
+        Add a job to the scheduler.
+
+        :param job: a job dictionary (see crunchy.submit). The trigger, priority and weight keys are used to
+                    schedule it (defaults are None, 0 and 1 respectively).
+        """
+        t = job.get('trigger', None)
+        if t not in self.queues:
+            self.queues[t] = deque()
+            self.vtime[t] = 0.
+        if len(self.queues[t]) == 0: # trigger is (re)activated; don't let it catch up on time it was idle
+            active = [self.vtime[k] for k, q in self.queues.items() if len(q) > 0]
+            if len(active) > 0:
+                self.vtime[t] = max(self.vtime[t], min(active))
+        self.priority[t] = job.get('priority', 0)
+        self.weight[t] = max(job.get('weight', 1), 1e-6)
+        self.queues[t].append(job)
+
+    def pop(self):
+        """
+        Remove and return the next job that should be run, or None if there are no jobs.
+        """
+        best = self._next()
+        if best is None:
+            return None
+        self.vtime[best] += 1. / self.weight[best]
+        return self.queues[best].popleft()
+
+    def peek(self):
+        """
+        Return (without removing it) the next job that should be run, or None if there are no jobs.
+        """
+        best = self._next()
+        return None if best is None else self.queues[best][0]
+
+    def _next(self):
+        best = None
+        for t, q in self.queues.items():
+            if len(q) == 0:
+                continue
+            if best is None or (self.priority[t], -self.vtime[t]) > (self.priority[best], -self.vtime[best]):
+                best = t
+        return best
+
+    def counts(self):
+        """
+        Return a dictionary containing the number of jobs waiting for each trigger.
+        """
+        return {t: len(q) for t, q in self.queues.items()}
+
+    def __len__(self):
+        return sum([len(q) for q in self.queues.values()])
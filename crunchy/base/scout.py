@@ -2,10 +2,13 @@
 Scouting thread that updates file maps for CrunchyServer (without blocking HTTP requests).
 """
 import os
-from time import sleep
+import errno
+from stat import S_ISDIR, S_ISREG
+from time import sleep, time, monotonic
 import numpy as np
 
-def scout( paths, depth, new_files, known_files, file_size_dict,  wait = 5, idle=5.0, maxiter=np.inf  ):
+def scout( paths, depth, new_files, known_files, file_size_dict,  wait = 5, idle=5.0, maxiter=np.inf,
+           backend='poll', rescan=60.0, inbox=None, stats=None ):
     """
     Monitor specified path at given depth.
 
@@ -13,28 +16,194 @@ def scout( paths, depth, new_files, known_files, file_size_dict,  wait = 5, idle
      - path = a list of directories to search in.
      - depth = a list containing the depth to search in each directory listed in path. If an integer, then a constant
                value is used for all files.
-     - new_files = list to append newly found files to.
-     - known_files = dictionary of known files (known_files[p] = True if a file should be ignored).
+     - new_files = dictionary to store newly found files (and their size) in. This can also be a Queue, in which case
+                   a dictionary of the files found during each pass is put in it (so that only one message is sent
+                   per pass).
+     - known_files = dictionary of known files (known_files[p] = size if a file should be ignored). Files that
+                     are found are added to this dictionary.
      - file_size_dict = dictionary to store visited file size in (file_size_dict[p] = [size1, size2, size3 ... ]
      - wait = the number of times to touch a file before it's filesize is considered to be "stable".
      - idle = time to sleep between iterations. Default is 5 seconds.
      - maxiter = the maximum number of iterations to run mirror. Default is inf (run forever).
+     - backend = 'poll' to periodically list all hot directories, or 'inotify' to only check files
+                 that the (Linux) kernel reports as changed. If inotify is not available then this will fall
+                 back to polling (as it does if the kernel runs out of watches). Default is 'poll'.
+     - rescan = time (in seconds) between full rescans of the hot directories when using the 'inotify' backend.
+                These catch any missed events.
+     - inbox = a Queue containing lists of paths that should be removed from known_files (e.g. because a file trigger
+               wants to see them again). This is checked once per pass. Default is None.
+     - stats = a dictionary that the number of monitored and known files is written to once per pass.
+               Default is None.
     """
-    i = 0
     if isinstance(depth, int) or isinstance(depth, float):
         depth = [depth] * len(paths)
+    if backend == 'inotify':
+        from crunchy.base import inotify
+        if inotify.available():
+            try:
+                watcher = inotify.Watcher()
+            except OSError as e:
+                print("Warning: could not start inotify scout (%s). Falling back to polling." % e)
+            else:
+                try:
+                    return _scoutEvents(watcher, paths, depth, new_files, known_files, file_size_dict,
+                                        wait, idle, maxiter, rescan, inbox, stats)
+                except OSError as e:
+                    if e.errno != errno.ENOSPC:
+                        raise
+                    print("Warning: ran out of inotify watches (%s). Increase fs.inotify.max_user_watches to use the "
+                          "inotify scout for this many directories. Falling back to polling." % e)
+        else:
+            print("Warning: inotify is not available on this system. Falling back to polling.")
+    index = SizeIndex(strict=True) # N.B. strict, as nothing tells us about files that are modified in place
+    i = 0
     while i < maxiter:
         for p,d in zip(paths, depth):
             if p == '' or p is None:
                 continue # allow input path or output path to be None (e.g. if we only want to run analyses)
 
-            files = _checkNewFiles( p, d, wait, known_files, file_size_dict ) # check for new files in path
-            for f,s in files:
-                new_files[f] = s # store new file and its size
+            _readInbox( inbox, known_files )
+            files = _checkNewFiles( p, d, wait, known_files, file_size_dict, index ) # check for new files in path
+            _publish( dict(files), new_files, known_files, file_size_dict, stats )
             sleep(idle)
             i+=1
 
-def _checkNewFiles(path, level, wait, known_files, file_size_dict):
+def _scoutEvents( watcher, paths, depth, new_files, known_files, file_size_dict, wait, idle, maxiter, rescan,
+                  inbox=None, stats=None ):
+    """
+    Event-driven version of scout(...). Directories are watched using inotify and only entries that
+    have changed (or are still waiting for their size to stabilise) are checked during each iteration, so
+    the cost of each iteration depends on the rate of file events rather than on the size of the directory tree.
+    As iterations end as soon as events arrive, an entry is only visited again (towards the wait count) once idle
+    seconds have passed since its last visit, so busy directories cannot make files look stable sooner.
+    """
+    from crunchy.base.inotify import IN_ISDIR
+    roots = [(str(p), int(d)) for p, d in zip(paths, depth) if p != '' and p is not None]
+    pending = set() # entries that need to be checked (until they are stable)
+    visited = {} # (monotonic) time that each pending entry was last visited
+    index = SizeIndex() # file sizes are only re-read for directories that have events
+    try:
+        last = -np.inf
+        i = 0
+        while i < maxiter:
+            if time() - last > rescan: # (re)build watches and check everything not yet known
+                index.clear()
+                for p, d in roots:
+                    _watchTree( watcher, p, d, pending, known_files )
+                last = time()
+
+            # check entries that have changed or have not yet stabilised
+            pending.update( _readInbox( inbox, known_files ) )
+            found = {}
+            for p in list(pending):
+                if not os.path.exists(p):
+                    pending.discard(p)
+                    visited.pop(p, None)
+                    file_size_dict.pop(p, None)
+                    continue
+                if monotonic() - visited.get(p, -np.inf) < idle:
+                    continue # visited too recently
+                visited[p] = monotonic()
+                new, stable = _checkEntry(p, index.size(p), wait, known_files, file_size_dict)
+                if new:
+                    found[p] = file_size_dict.pop(p)[0] # store new file and its size
+                if new or stable:
+                    pending.discard(p) # nothing to do until we see another event
+                    visited.pop(p, None)
+            _publish( found, new_files, known_files, file_size_dict, stats )
+
+            # wait for events
+            for d, name, mask in watcher.read(idle):
+                if d is None: # event queue overflowed, so do a full rescan
+                    last = -np.inf
+                    continue
+                path = os.path.join(d, name)
+                index.invalidate(d)
+                for r, rd in roots:
+                    if path == r or not path.startswith(os.path.join(r, '')):
+                        continue
+                    parts = os.path.relpath(path, r).split(os.sep)
+                    if any(ignore(n) for n in parts[:rd + 1]):
+                        break
+                    if len(parts) <= rd: # structural directory above the search depth
+                        if mask & IN_ISDIR and os.path.isdir(path):
+                            _watchTree( watcher, path, rd - len(parts), pending, known_files )
+                    else: # change within (or to) an entry
+                        pending.add(os.path.join(r, *parts[:rd + 1]))
+                        if mask & IN_ISDIR and os.path.isdir(path):
+                            _watchAll( watcher, path )
+                    break
+            i += 1
+    finally:
+        watcher.close()
+
+def ignore( name ):
+    """
+    Return True if a file or directory name should be ignored by the scout. This applies to the files crunchy
+    uses for its own bookkeeping (e.g. the ledger), which all start with ".crunchy".
+    """
+    return name.startswith('.crunchy')
+
+def _readInbox( inbox, known_files ):
+    """
+    Remove any paths listed in messages from the inbox from known_files, so that they will be found again.
+
+    *Returns*:
+     - a list of the removed paths.
+    """
+    out = []
+    if inbox is None:
+        return out
+    while True:
+        try:
+            paths = inbox.get_nowait()
+        except Exception: # empty queue
+            return out
+        for p in paths:
+            known_files.pop(p, None)
+            out.append(p)
+
+def _publish( found, new_files, known_files, file_size_dict, stats=None ):
+    """
+    Pass files found during a scout pass to new_files (as one message) and record them as known.
+    """
+    if len(found) > 0:
+        known_files.update(found)
+        if hasattr(new_files, 'put'): # this is a queue
+            new_files.put(found)
+        else:
+            new_files.update(found)
+    if stats is not None:
+        stats.update(monitored=len(file_size_dict), known=len(known_files))
+
+def _watchTree( watcher, path, level, pending, known_files ):
+    """
+    Add watches for path and all directories down to the specified level, and flag all entries at this level
+    that are not in known_files as pending.
+    """
+    os.makedirs(path, exist_ok=True)  # scout dir must exist.
+    watcher.add(path)
+    for f in os.scandir(path):
+        if ignore(f.name):
+            continue
+        if level > 0:
+            if f.is_dir():
+                _watchTree(watcher, f.path, level - 1, pending, known_files)
+        else:
+            if f.is_dir(follow_symlinks=False) and f.path not in watcher.paths:
+                _watchAll(watcher, f.path)
+            if f.path not in known_files:
+                pending.add(f.path)
+
+def _watchAll( watcher, path ):
+    """
+    Recursively add watches to a directory and all of its subdirectories.
+    """
+    for dirpath, dirnames, filenames in os.walk(path):
+        if not watcher.add(dirpath):
+            dirnames.clear()
+
+def _checkNewFiles(path, level, wait, known_files, file_size_dict, index=None):
     """
     Search the specified directory at the specified depth and return a list of
     files that (1) have a stable file size, and (2) are not in self.known_files.
@@ -45,6 +214,8 @@ def _checkNewFiles(path, level, wait, known_files, file_size_dict):
      - wait = how many iterations to wait before deciding file size has stabilised.
      - known_files = a dictionary with known_files[ path ] = True if paths should be ignored.
      - file_size_dict = dictionary with file_size_dict[ path ] = [ size1, size2, size3 ... ].
+     - index = a SizeIndex used to cache directory sizes between calls. If None, directory sizes are
+               computed from scratch.
     *Returns*:
      - a list of newly found files that have stable file size.
     """
@@ -53,38 +224,61 @@ def _checkNewFiles(path, level, wait, known_files, file_size_dict):
         # move down a level and recurse
         out = []
         for f in os.scandir(path):
-            if os.path.isdir(f.path):
-                out += _checkNewFiles(f.path, level - 1, wait, known_files, file_size_dict)
+            if os.path.isdir(f.path) and not ignore(f.name):
+                out += _checkNewFiles(f.path, level - 1, wait, known_files, file_size_dict, index)
         return out
     else:
         # search directory and update file size dictionary
         out = []
         for f in os.scandir(path):
+            if ignore(f.name):
+                continue
             p = f.path
-            fsize = _getFileSize(p)
-            if p in known_files:
-                try:
-                    if known_files[p] != fsize:
-                        del known_files[p] # remove from known files as size has changed
-                except KeyError:
-                    print("Warning: key error for %s" % p )
-                    pass # No idea where this key error comes from, but it does...
-            if p not in known_files:
-                if p not in file_size_dict:  # this is a completely new file
-                    file_size_dict[p] = (fsize, 1) # size, visited once
-                else:  # track this files file size
-                    old_size, visits = file_size_dict[p]
-                    if fsize == old_size: # size hasn't changed!
-                        file_size_dict[p] = (fsize, visits+1)  # size, visited once
-
-                        # have we visited this enough times to consider it stable?
-                        if visits >= wait:  # yes! Return it
-                            out.append( (p, fsize ) )
-                            del file_size_dict[p]  # cleanup
-                    else: # file size has changed, go directly to jail. Do not pass go. Do not collect $200.
-                        file_size_dict[p] = (fsize, 1) # size, reset visit count
+            fsize = _getFileSize(p) if index is None else index.size(p)
+            found, _ = _checkEntry(p, fsize, wait, known_files, file_size_dict)
+            if found:
+                out.append( (p, fsize ) )
+                del file_size_dict[p]  # cleanup
         return out
 
+def _checkEntry(p, fsize, wait, known_files, file_size_dict):
+    """
+    Update the file size dictionary for a single file or directory.
+
+    *Arguments*:
+     - p = the path to check.
+     - fsize = the current size of this file or directory.
+     - wait = how many iterations to wait before deciding file size has stabilised.
+     - known_files = a dictionary with known_files[ path ] = True if paths should be ignored.
+     - file_size_dict = dictionary with file_size_dict[ path ] = [ size1, size2, size3 ... ].
+    *Returns*:
+     - found = True if this is a new file with a stable size.
+     - known = True if this file is known (and unchanged).
+    """
+    if p in known_files:
+        try:
+            if known_files[p] != fsize:
+                del known_files[p] # remove from known files as size has changed
+            else:
+                return False, True
+        except KeyError:
+            print("Warning: key error for %s" % p )
+            pass # No idea where this key error comes from, but it does...
+    if p not in known_files:
+        if p not in file_size_dict:  # this is a completely new file
+            file_size_dict[p] = (fsize, 1) # size, visited once
+        else:  # track this files file size
+            old_size, visits = file_size_dict[p]
+            if fsize == old_size: # size hasn't changed!
+                file_size_dict[p] = (fsize, visits+1)  # size, visited once
+
+                # have we visited this enough times to consider it stable?
+                if visits >= wait:  # yes! Return it
+                    return True, False
+            else: # file size has changed, go directly to jail. Do not pass go. Do not collect $200.
+                file_size_dict[p] = (fsize, 1) # size, reset visit count
+    return False, False
+
 def _getFileSize(path):
     """
     This will get the full size of a file or directory (including subdirs).
@@ -99,4 +293,104 @@ def _getFileSize(path):
     elif os.path.isfile(path):
         total_size += os.path.getsize(path)
 
-    return total_size
\ No newline at end of file
+    return total_size
+
+class SizeIndex(object):
+    """
+    Incremental cache of file and directory sizes. The listing of each directory is stored along with the
+    (mtime, inode) it had when it was listed, and directories are only listed again once these change (i.e. when
+    entries are added, removed or renamed). Checking the size of a stable directory tree then only requires
+    a stat of each directory (and, in strict mode, of each file) rather than a full os.walk(...).
+
+    Note that modifying (e.g. appending to) a file does not change the mtime of its parent directory. By default, cached
+    file sizes are used until their directory changes, so such changes are only seen once the directory is flagged
+    using invalidate(...) (e.g. by inotify). Set strict to True to re-read file sizes on every call instead.
+    """
+    def __init__(self, strict=False, racy=2.0):
+        """
+        :param strict: True if file sizes should be re-read on every call, or False (default) if cached sizes should be
+                       used until the parent directory changes or is invalidated.
+        :param racy: directories modified less than this many seconds before being listed are listed again on
+                     the next call, in case changes were made within the resolution of the file system timestamps.
+        """
+        self.strict = strict
+        self.racy = racy
+        self.dirs = {} # path -> [(mtime, inode), {file name: size}, [subdirectory names]]
+
+    def size(self, path):
+        """
+        Get the full size of a file or directory (including subdirs), skipping symbolic links within directories.
+        Returns 0 if the path does not exist.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return 0
+        if S_ISDIR(st.st_mode):
+            return self._dirsize(str(path), st)
+        elif S_ISREG(st.st_mode):
+            return st.st_size
+        return 0
+
+    def invalidate(self, path):
+        """
+        Flag a directory as changed, so that it is listed (and its file sizes read) again next time it is visited.
+        """
+        entry = self.dirs.get(str(path))
+        if entry is not None:
+            entry[0] = None
+
+    def forget(self, path):
+        """
+        Remove a directory and all of its (cached) subdirectories from the index.
+        """
+        entry = self.dirs.pop(str(path), None)
+        if entry is not None:
+            for d in entry[2]:
+                self.forget(os.path.join(path, d))
+
+    def clear(self):
+        self.dirs.clear()
+
+    def __len__(self):
+        return len(self.dirs)
+
+    def _dirsize(self, path, st):
+        key = (st.st_mtime_ns, st.st_ino)
+        entry = self.dirs.get(path)
+        if entry is None or entry[0] != key: # (re)list this directory
+            files = {}
+            subdirs = []
+            try:
+                for f in os.scandir(path):
+                    try:
+                        if f.is_symlink():
+                            continue  # skip if it is symbolic link
+                        if f.is_dir():
+                            subdirs.append(f.name)
+                        elif f.is_file():
+                            files[f.name] = f.stat().st_size
+                    except OSError:
+                        continue # file was removed while listing
+            except OSError:
+                self.forget(path)
+                return 0
+            if entry is not None:
+                for d in set(entry[2]).difference(subdirs):
+                    self.forget(os.path.join(path, d)) # drop removed subdirectories
+            if time() - st.st_mtime < self.racy:
+                key = None # directory changed very recently; don't trust mtime next time
+            entry = [key, files, subdirs]
+            self.dirs[path] = entry
+        elif self.strict: # refresh file sizes
+            files = entry[1]
+            for name in list(files.keys()):
+                try:
+                    files[name] = os.stat(os.path.join(path, name)).st_size
+                except OSError:
+                    del files[name]
+
+        total_size = sum(entry[1].values())
+        for d in entry[2]:
+            total_size += self.size(os.path.join(path, d))
+        return total_size
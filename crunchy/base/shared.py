@@ -0,0 +1,209 @@
+"""
+A store of named numpy arrays that can be shared between workflow steps and worker threads without copying
+or serialising them. Arrays are kept in memory-mapped .npy files (in /dev/shm where available, so they stay in RAM)
+and tracked by a shared registry that handles reference counting (per thread) and eviction.
+"""
+import os
+import time
+import uuid
+import shutil
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+
+class ArrayStore(object):
+    """
+    Shared store of named arrays. Each thread should use the store returned by crunchy.getArrayStore(), but
+    ArrayStore objects can also be pickled and passed to other threads (as long as registry and lock can be).
+    """
+    def __init__(self, root, registry, lock, limit=np.inf, owner=None):
+        """
+        :param root: directory to store memory-mapped arrays in. This will be created if needed.
+        :param registry: a (shared) dictionary used to store information on each array. Use a multiprocess
+                         Manager().dict() if the store will be used by more than one thread.
+        :param lock: a (shared) lock used to ensure registry updates are atomic.
+        :param limit: the maximum number of bytes to store before unreferenced arrays are evicted. Default is no limit.
+        :param owner: a (shared) value used to store the PID of the thread holding the lock, so that it can be released
+                      if that thread is killed (see recover(...)). Default is None.
+        """
+        self.root = str(root)
+        self.registry = registry
+        self.lock = lock
+        self.limit = limit
+        self.owner = owner
+        os.makedirs(self.root, exist_ok=True)
+
+    @contextmanager
+    def locked(self):
+        """
+        Hold the lock (and record which thread holds it).
+        """
+        with self.lock:
+            if self.owner is not None:
+                self.owner.value = os.getpid()
+            try:
+                yield
+            finally:
+                if self.owner is not None:
+                    self.owner.value = 0
+
+    def recover(self, pid):
+        """
+        Release the lock if it was held by a thread that has died (e.g. a job that was killed because it took too long).
+
+        :param pid: the PID of the dead thread.
+        :return: True if the lock was released.
+        """
+        if self.owner is None or self.owner.value != pid:
+            return False
+        self.owner.value = 0
+        self.lock.release()
+        return True
+
+    def create(self, name, shape, dtype=float):
+        """
+        Create a new (writable) array in the store. This can be filled directly to avoid making any copies. If an
+        array with this name already exists it is replaced (threads that attached it will keep their copy).
+
+        :param name: the name of the new array.
+        :param shape: the shape of the new array.
+        :param dtype: the data type of the new array.
+        :return: a writable numpy memmap.
+        """
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        with self.locked():
+            self.evict(nbytes)
+            old = self.registry.pop(name, None)
+            if old is not None:
+                _remove(old['file'])
+            file = os.path.join(self.root, "%s.npy" % uuid.uuid4().hex)
+            arr = np.lib.format.open_memmap(file, mode='w+', shape=tuple(shape), dtype=dtype)
+            self.registry[name] = dict(file=file, nbytes=nbytes, refs={}, used=time.time()) # refs = {pid: count}
+        return arr
+
+    def publish(self, name, arr):
+        """
+        Copy an array into the store so that it can be attached by other workflow steps or threads.
+
+        :param name: the name to publish this array under.
+        :param arr: the array to publish.
+        :return: a writable numpy memmap containing a copy of arr.
+        """
+        arr = np.asarray(arr)
+        out = self.create(name, arr.shape, arr.dtype)
+        out[...] = arr
+        out.flush()
+        return out
+
+    def attach(self, name, writable=False):
+        """
+        Attach an array in the store (without copying it). Arrays that are attached will not be evicted until they
+        are released again (see release(...)), or the thread that attached them dies (see detach(...)).
+
+        :param name: the name of the array to attach.
+        :param writable: True if changes to the returned array should be written to the store. Default is False.
+        :return: a numpy memmap.
+        :raises KeyError: if no array with this name exists.
+        """
+        with self.locked():
+            entry = self.registry[name]
+            pid = os.getpid()
+            entry['refs'][pid] = entry['refs'].get(pid, 0) + 1
+            entry['used'] = time.time()
+            self.registry[name] = entry # N.B. update the shared copy
+        return np.load(entry['file'], mmap_mode='r+' if writable else 'r')
+
+    def release(self, name, discard=False):
+        """
+        Release an array attached using attach(...).
+
+        :param name: the name of the array to release.
+        :param discard: True if the array should be removed from the store once it is no longer attached anywhere.
+        """
+        with self.locked():
+            entry = self.registry.get(name, None)
+            if entry is None:
+                return
+            refs, pid = entry['refs'], os.getpid()
+            if pid in refs: # N.B. releasing an array this thread has not attached does nothing
+                refs[pid] -= 1
+                if refs[pid] <= 0:
+                    del refs[pid]
+            if discard and len(refs) == 0:
+                del self.registry[name]
+                _remove(entry['file'])
+            else:
+                self.registry[name] = entry
+
+    def detach(self, pid):
+        """
+        Release all arrays attached by a thread that has died or been replaced, as its copies no longer exist.
+
+        :param pid: the PID of the thread.
+        :return: the number of references that were released.
+        """
+        n = 0
+        with self.locked():
+            for name, entry in list(self.registry.items()):
+                if pid in entry['refs']:
+                    n += entry['refs'].pop(pid)
+                    self.registry[name] = entry
+        return n
+
+    def remove(self, name):
+        """
+        Remove an array from the store (regardless of whether it is still attached).
+        """
+        with self.locked():
+            entry = self.registry.pop(name, None)
+            if entry is not None:
+                _remove(entry['file'])
+
+    def evict(self, nbytes=0):
+        """
+        Remove the least recently used arrays that are not attached anywhere until there is space to store
+        nbytes more data without exceeding the limit. N.B. callers should hold the lock (see locked()).
+        """
+        entries = sorted(self.registry.items(), key=lambda e: e[1]['used'])
+        total = sum([e['nbytes'] for _, e in entries])
+        for name, e in entries:
+            if total + nbytes <= self.limit:
+                break
+            if len(e['refs']) == 0:
+                del self.registry[name]
+                _remove(e['file'])
+                total -= e['nbytes']
+
+    def nbytes(self):
+        """
+        Return the number of bytes currently stored.
+        """
+        return sum([e['nbytes'] for e in self.registry.values()])
+
+    def names(self):
+        return list(self.registry.keys())
+
+    def __contains__(self, name):
+        return name in self.registry
+
+    def clear(self):
+        """
+        Remove all arrays and delete the store directory.
+        """
+        with self.locked():
+            self.registry.clear()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+def getRoot():
+    """
+    Return a directory that can be used to store shared arrays. This will be in /dev/shm if it exists (so that
+    arrays are stored in memory) or the system temporary directory otherwise.
+    """
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base, 'crunchy-%d-%s' % (os.getpid(), uuid.uuid4().hex[:8]))
+
+def _remove(file):
+    try:
+        os.remove(file)
+    except OSError:
+        pass # N.B. attached arrays cannot be deleted on windows, so this leaves them in place
@@ -6,8 +6,7 @@ from pathlib import Path
 
 import crunchy
 from crunchy import getQueue
-from crunchy import block
-from crunchy import entries, setup, finalize
+from crunchy import entries, setup, finalize, workerinit
 from crunchy import log, getLogDict
 from crunchy.base.errors import logAndStop
 
@@ -48,20 +47,74 @@ def finish( func ):
     finalize[func.__name__] = func
     return func
 
-def fileTrigger(*, flow, fail=logAndStop, block=False, vb=1):
+def workerInit( func ):
+    """
+    Functions flagged by this decorator should take two arguments (a state object and a settings dictionary), and
+    will be called once in each worker thread before it runs any jobs. Attributes added to the state object (e.g.
+    reference data, models or lookup tables that are expensive to load) persist across all jobs run by that
+    worker, and can be retrieved by workflow functions using crunchy.getWorkerState().
+
+    :param func:
+    :return:
+    """
+    # store reference to function
+    workerinit[func.__name__] = func
+    return func
+
+def timeout( seconds ):
+    """
+    Limit the time that a workflow function can take. Jobs for workflows with such functions run in their own process,
+    which is killed if the function takes longer (and the job is retried, if the trigger allows it). For example:
+
+    @timeout(60)
+    def copy_from_instrument( data, outpath, settings ): ...
+
+    :param seconds: the time limit (in seconds).
+    """
+    def decorator(func):
+        func.timeout = seconds
+        return func
+    return decorator
+
+def fileTrigger(*, flow, fail=logAndStop, block=False, priority=0, weight=1, memory=0, cores=1, threads=None,
+                timeout=None, retries=0, backoff=10.0, checkpoint=False, vb=1):
     """
     Makes a function a trigger point for a crunchy workflow and registers it with crunchy.
 
     :param flow: A list containing all workflow functions to be exectued (in order) on success of this filter.
     :param fail: An error handling functions if this or any subsequent workflow function fails.
     :param block: True if this workflow should be run in the current thread (blocking it). Default is False.
+    :param priority: Jobs from triggers with a higher priority are passed to workers before those of lower priority
+                     triggers. Use this to keep e.g. cheap steps that produce results for operators responsive while
+                     a large backlog is being processed. Default is 0.
+    :param weight: The share of workers given to this trigger relative to other triggers with the same priority
+                   while they all have jobs waiting. Default is 1.
+    :param memory: The memory (Mb) each job needs at most. Jobs are only started while the host (or the budget set
+                   in crunchy_settings['memorymb']) has enough memory left for them. Default is 0.
+    :param cores: The number of CPU cores each job uses. Jobs are only started while there are enough cores left (see
+                  crunchy_settings['cores']). Default is 1.
+    :param threads: The number of threads numerical libraries (e.g. BLAS) can use in each job. Default is None (use
+                    cores).
+    :param timeout: The time (in seconds) each job can take before it is killed. Jobs with a time limit run in their
+                    own process (see crunchy.submit()). Individual workflow functions can also be given a time limit
+                    using the @timeout decorator. Default is None (no limit).
+    :param retries: The number of times to retry jobs that fail (or time out). Jobs that fail every time are added
+                    to the dead letters (see crunchy.getDeadLetters()). Default is 0.
+    :param backoff: The time (in seconds) to wait before the first retry. This doubles with each further retry.
+                    Can also be a function that takes the retry number and returns the time to wait. Default is 10.
+    :param checkpoint: True if the data dictionary should be stored (in the output directory) after each workflow
+                       function, so that jobs that are retried (or run again after crunchy is restarted) resume from the
+                       last completed function. Large arrays are stored as .npy files and memory-mapped when resuming.
+                       Use this for workflows with slow early steps. Default is False.
     :param vb: A number from 0 to 3 defining the amount of outputs to the log. Higher numbers give more outputs. Default is 1.
     :return: A filefilter decorator for wrapping around the underlying filter.
     """
+    options = dict(memory=memory, cores=cores, threads=threads, timeout=timeout, retries=retries, backoff=backoff)
     def decorator(func):
         func.flow = flow  # store workflow functions
         func.fail = fail  # what do do if it fails
         func.block = block
+        func.checkpoint = checkpoint
         func.log = getLogDict
         func.queue = getQueue
         def wrapper(path, outpath, settings):
@@ -71,45 +124,190 @@ def fileTrigger(*, flow, fail=logAndStop, block=False, vb=1):
             # run source function to evaluate if file is valid for this workflow
             data = dict(path=Path(path))
             #print(path, os.path.exists(path))
-            status = ERROR
-            try:
-                status, outpath = func(data, Path(outpath), settings)
-            except BaseException as E:
-                # pass everything to error handler
-                func.fail( func.log(), E, function=func,
-                             data=data,
-                             outpath=outpath,
-                             settings=settings)
-
-            # the file filter ran and says we should process this file - add to queue!
-            if status == PROCESS:
-                os.makedirs(outpath, exist_ok=True)  # make sure outpath exists!
-                if block:  # run job in this thread (block == True)
-                    if vb >= 2:
-                        log("Executing and blocking: %s" % path, func.log() )
-                    crunchy.prog[path] = 1  # register job as running
-                    _job(func.flow, func.fail, func.log(),
-                         data, outpath, settings )
-                    crunchy.prog[path] = 2  # register job as complete
-                else:  # pass job to queue (block == False )
-                    if vb >= 2:
-                        log("Queuing job for: %s" % path, func.log())
-                    crunchy.prog[path] = 0 # register job as queued.
-                    func.queue().put( ("EXEC", (_job, (func.flow, func.fail, func.log(),
-                                                      data, outpath, settings ), {})))
+            return _fire(func, data, path, outpath, settings, block, priority, weight, vb, options, fingerprint=True)
+
+        # register function with crunchy
+        entries[func.__name__] = wrapper
+        return wrapper
+    return decorator
+
+def jobTrigger(*, after, flow, count=1, fail=logAndStop, block=False, priority=0, weight=1, memory=0, cores=1,
+               threads=None, timeout=None, retries=0, backoff=10.0, checkpoint=False, vb=1):
+    """
+    Makes a function a trigger point that is run (in the control thread) when jobs created by other triggers have
+    completed, rather than when new files are found. This allows e.g. assembly steps to run as soon as all of the
+    results they need exist, without scanning the output directory for them.
+
+    Completed jobs are grouped by key. This is the output directory of the upstream job, unless a workflow function
+    stores a different value in data['key']. Once jobs for count different paths have completed for a key, the
+    decorated function is called with a data dictionary containing the key (as path and key), the job records (records)
+    and the output files that the upstream workflow functions added to data['outputs'] (inputs). Like file filters, it
+    should return a status and output directory; if the status is PROCESS then flow is run on a worker. Jobs that
+    complete more than once for the same path (e.g. because a file changed) are only counted once. N.B. groups are
+    kept in memory by the control thread; if the ledger is enabled they are rebuilt from it when crunchy is
+    (re)started, so jobs completed before a restart are still counted.
+
+    :param after: The name (or a list of names) of the trigger(s) whose jobs this trigger depends on.
+    :param flow: A list containing all workflow functions to be exectued (in order) on success of this trigger.
+    :param count: The number of upstream jobs that must complete (for each key) before this trigger runs. This can
+                  also be a function that takes the settings dictionary and returns this number. Default is 1.
+    :param fail: An error handling functions if this or any subsequent workflow function fails.
+    :param block: True if this workflow should be run in the current thread (blocking it). Default is False.
+    :param priority: The priority of jobs created by this trigger (see fileTrigger). Default is 0.
+    :param weight: The share of workers given to jobs created by this trigger (see fileTrigger). Default is 1.
+    :param memory: The memory (Mb) each job needs at most (see fileTrigger). Default is 0.
+    :param cores: The number of CPU cores each job uses (see fileTrigger). Default is 1.
+    :param threads: The number of threads numerical libraries can use in each job (see fileTrigger). Default is None.
+    :param timeout: The time (in seconds) each job can take (see fileTrigger). Default is None (no limit).
+    :param retries: The number of times to retry jobs that fail (see fileTrigger). Default is 0.
+    :param backoff: The time (in seconds) to wait before retrying (see fileTrigger). Default is 10.
+    :param checkpoint: True if jobs should resume from the last completed workflow function (see fileTrigger).
+                       Default is False.
+    :param vb: A number from 0 to 3 defining the amount of outputs to the log. Higher numbers give more outputs. Default is 1.
+    :return: A decorator for wrapping around the underlying trigger.
+    """
+    if isinstance(after, str):
+        after = [after]
+    options = dict(memory=memory, cores=cores, threads=threads, timeout=timeout, retries=retries, backoff=backoff)
+    def decorator(func):
+        func.flow = flow  # store workflow functions
+        func.fail = fail  # what do do if it fails
+        func.block = block
+        func.checkpoint = checkpoint
+        func.log = getLogDict
+        func.queue = getQueue
+        groups = {} # key -> {path: record} of completed upstream jobs
+        def add(record):
+            result = record['result'] if isinstance(record['result'], dict) else {}
+            key = result.get('key', record['path'])
+            groups.setdefault(key, {})[str(record['path'])] = record # N.B. only the latest job for each path
+            return key
+        def check(key, settings):
+            n = count(settings) if callable(count) else count
+            if len(groups[key]) < n:
+                return WAIT # wait for more upstream jobs
+            records = list(groups[key].values())
+            if vb >= 3:
+                log("%d jobs completed for %s; running %s" % (len(records), key, func.__name__), func.log())
+            data = dict(path=Path(key), key=key, records=records,
+                        inputs=[o for r in records for o in r['result'].get('outputs', [])])
+            status = _fire(func, data, key, Path(key), settings, block, priority, weight, vb, options)
+            if status in (PROCESS, REJECT): # N.B. keep the group if the trigger wants to wait (or failed)
+                groups.pop(key, None)
             return status
+        def wrapper(record, settings):
+            if record['trigger'] not in after or record['error'] is not None:
+                return REJECT
+            return check(add(record), settings)
+        def restore(ledger, settings):
+            """
+            Rebuild the groups from the jobs recorded in the ledger (e.g. when crunchy is restarted), and run this
+            trigger for any that are complete. Keys that this trigger has already completed a job for are skipped.
+            """
+            groups.clear()
+            jobs = ledger.jobs()
+            fired = set(j['path'] for j in jobs if j['trigger'] == func.__name__ and j['status'] == 2)
+            for j in jobs:
+                if j['trigger'] in after and j['status'] == 2 and j['result'] is not None:
+                    if str(j['result'].get('key', j['path'])) not in fired:
+                        add(dict(j, error=None))
+            for key in list(groups.keys()):
+                check(key, settings)
+        wrapper.after = after
+        wrapper.restore = restore
 
         # register function with crunchy
         entries[func.__name__] = wrapper
         return wrapper
     return decorator
 
+def _fire(func, data, path, outpath, settings, block, priority, weight, vb, options, fingerprint=False):
+    """
+    Run a trigger function and, if it says we should process this path, submit its workflow. If fingerprint is True
+    then checkpoints of the job are tied to the current contents of path (see checkpoint.signature).
+    """
+    status = ERROR
+    try:
+        status, outpath = func(data, Path(outpath), settings)
+    except BaseException as E:
+        # pass everything to error handler
+        func.fail( func.log(), E, function=func,
+                     data=data,
+                     outpath=outpath,
+                     settings=settings)
+
+    # the trigger ran and says we should process this file - add to queue!
+    if status == PROCESS:
+        os.makedirs(outpath, exist_ok=True)  # make sure outpath exists!
+        if block:  # run job in this thread (block == True)
+            if vb >= 2:
+                log("Executing and blocking: %s" % path, func.log() )
+        else:  # pass job to queue (block == False )
+            if vb >= 2:
+                log("Queuing job for: %s" % path, func.log())
+        isolate = options['timeout'] is not None or any(getattr(f, 'timeout', None) for f in func.flow)
+        kwargs = {}
+        if func.checkpoint:
+            from crunchy.base import checkpoint as cp
+            kwargs = dict(checkpoint=True, signature=cp.signature(path) if fingerprint else None)
+        crunchy.submit(_job, (func.flow, func.fail, func.log(), data, outpath), kwargs, isolate=isolate, path=path,
+                       trigger=func.__name__, block=block, priority=priority, weight=weight, **options)
+    return status
+
 # function for executing jobs in queue
-def _job(flow, fail, logdict, data, outpath, settings):
-    for f in flow:
+def _job(flow, fail, logdict, data, outpath, checkpoint=False, signature=None):
+    """
+    Run each function in a workflow. If a function fails and the error handler says we should stop, the
+    exception is re-raised so that it is reported back to the control thread. Otherwise the job key and any
+    outputs that the workflow functions added to data['outputs'] are returned (see jobTrigger). N.B. settings are
+    not sent with each job; workers use their (cached) copy from crunchy.getSettings(). If checkpoint is True then
+    the job resumes from (and stores) checkpoints of the data dictionary (see base.checkpoint), which are only valid
+    for the input with the specified signature (see checkpoint.signature).
+    """
+    settings = crunchy.getSettings()
+    start = 0
+    if checkpoint:
+        from crunchy.base import checkpoint as cp
+        folder = cp.getFolder(data, flow, settings.get('outpath', None) or outpath, signature)
+        try:
+            start, saved = cp.load(folder)
+        except Exception as E: # e.g. written by an incompatible version of the workflow
+            log("Ignoring checkpoint for %s (%s)" % (data['path'], E), logdict)
+            start, saved = 0, None
+        if saved is not None:
+            data = saved
+            log("Resuming %s after %s" % (data['path'], flow[start - 1].__name__), logdict)
+    for i, f in enumerate(flow):
+        if i < start:
+            continue # completed before this job was interrupted
         try:
             log("Running %s on %s"%(f.__name__, data['path']), logdict)
+            crunchy.limit(getattr(f, 'timeout', None)) # see @timeout
             f(data, outpath, settings)
         except BaseException as E:
             if not fail(logdict, E, function=f, data=data, outpath=outpath, settings=settings):
-                return
\ No newline at end of file
+                raise
+        finally:
+            crunchy.limit()
+        if checkpoint and i < len(flow) - 1:
+            try:
+                cp.save(folder, i + 1, data)
+            except Exception as E: # e.g. data cannot be pickled; carry on without a checkpoint
+                log("Could not checkpoint %s after %s (%s)" % (data['path'], f.__name__, E), logdict)
+    if checkpoint:
+        cp.clear(folder)
+
+    # return a (small) summary of the outputs, used by job triggers
+    return dict(key=str(data.get('key', outpath)), outputs=[str(o) for o in data.get('outputs', [])])
+
+def _discard(job):
+    """
+    Delete the checkpoints of a job created by a trigger (see _job) once it has failed on every attempt, as it will
+    not be resumed (it is run from the start if it is triggered again).
+    """
+    if job['func'] is not _job or not job['kwargs'].get('checkpoint', False):
+        return
+    from crunchy.base import checkpoint as cp
+    flow, fail, logdict, data, outpath = job['args']
+    cp.clear(cp.getFolder(data, flow, crunchy.getSettings().get('outpath', None) or outpath,
+                          job['kwargs'].get('signature', None)))
@@ -0,0 +1,69 @@
+"""
+Watchdog that replaces (local) workers that have died, and reports the jobs they were running as failed so that they
+can be retried (or added to the dead letters; see crunchy.getDeadLetters()). N.B. jobs that take longer than their
+time limit are killed by the worker running them (see crunchy._isolate()), so workers are never killed here.
+"""
+import time
+import threading
+
+class Watchdog(object):
+    """
+    Thread (in the main crunchy thread) that periodically checks the state of each worker. Each worker publishes the
+    job it is running (in its slot; see crunchy._execute()).
+    """
+    def __init__(self, interval=1.0):
+        """
+        :param interval: the time (seconds) between checks. Default is 1.
+        """
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._loop, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def _loop(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.step()
+            except (EOFError, OSError, BrokenPipeError): # crunchy is shutting down
+                break
+
+    def step(self):
+        """
+        Check each worker once, and replace those that have died.
+        """
+        import crunchy
+        if not crunchy.initialised():
+            return
+        for w in list(crunchy.workers):
+            if w.retire.is_set() or w.is_alive() or w.exitcode == 0:
+                continue # retired, running or finished normally
+            pid, count = w.slot[0], w.slot[1]
+            self.replace(w, "Worker %d died (exit code %s)" % (w.pid, w.exitcode),
+                         None if pid == 0 else '%d:%d' % (pid, count))
+
+    def replace(self, worker, reason, job):
+        """
+        Report the job a dead worker was running (if any) as failed, release the array store lock (if it held it) and
+        the arrays it attached, and start a new worker in its place.
+        """
+        import crunchy
+        worker.retire.set()
+        crunchy.log("%s; replacing worker %d" % (reason, worker.pid), crunchy.getLogDict(), master=True)
+        if crunchy.arraystore is not None:
+            crunchy.arraystore.recover(worker.pid)
+            crunchy.arraystore.detach(worker.pid)
+        crunchy._spawn() # N.B. before the job is reported, so the pool is full again once it is collected
+        if job is not None:
+            now = time.time()
+            crunchy.results.put(dict(id=job, path=None, trigger=None, pid=worker.pid, queued=None, started=None,
+                                     finished=now, duration=None, result=None, error=reason, lost=True))
@@ -4,7 +4,8 @@ A dummy workflow that constructs several noisy images, applies a median filter t
 uses a histogram equalisation method to scale them to the same range.
 
 Unlike real applications, these functions have intentionally written to be slow to demonstrate threading
-capabilities in a more realistic sense.
+capabilities in a more realistic sense. Vectorised versions can be selected using the "vectorise" setting, so that
+the overhead of crunchy itself can be measured (and stress-tested using many small jobs; see the "objects" setting).
 
 Sam Thiele; 2022
 
@@ -13,8 +14,9 @@ Sam Thiele; 2022
 import numpy as np
 import os
 import crunchy
-from crunchy.base.trigger import fileTrigger, init, finish
+from crunchy.base.trigger import fileTrigger, jobTrigger, init, finish, workerInit
 import crunchy.base.trigger as trigger
+from crunchy.base.preview import makeThumbnails
 
 """
 All workflows can/should provide a name variable, which will be used to select in through the app and for
@@ -40,6 +42,8 @@ crunchy.workflow_settings = dict(
     set_count = dict(type='int', value=8, min=3, max=8,desc=''),
     assemble = dict(type='bool', value=True,desc='boolean variables (represented by check boxes in app).'),
     workflow_stage = dict( type='int', value=0, min=0, max=3,desc='staging variable for multi-step workflows.' ),
+    objects = dict(type='int', value=3, min=1, max=10000, desc='number of objects to create in each set. Use large values to stress-test crunchy with many jobs.'),
+    vectorise = dict(type='bool', value=False, desc='use vectorised (numpy) versions of the workflow functions, so that crunchy overheads can be compared to compute costs.'),
 )
 
 """
@@ -57,15 +61,17 @@ crunchy.dashboard = """
 {% block content %}
 <h1>Dummy monitor</h1>
 <p>Display useful real-time monitoring data here. This page has access to the entire settings dictionary (crunchy.settings) 
-   and functions such as <i>os</i>, <i>re</i>, <i>glob</i>, <i>natsort</i> and <i>listdir</i>. 
+   and functions such as <i>os</i>, <i>re</i>, <i>glob</i>, <i>natsort</i> and <i>listdir</i>. Results produced by
+   completed jobs can be found (without searching the output directory) using <i>crunchy.getArtefacts(pattern)</i>. 
    For linking to files or images, the root path of crunchy is provided as the variable <i>root</i>.</p>
 <hr>
-{%for f in glob( os.path.join(outpath,"*/comp.image.png") )%}
+{% set results = crunchy.getArtefacts("*/comp.image.png") %}
+{%for f in results%}
     <h1>{{os.path.basename(os.path.dirname(f))}}</h1>
-    <img src="{{os.path.relpath(f,root)}}" alt={{f}}>
+    <a href="{{os.path.relpath(f,root)}}"><img src="thumb/{{os.path.relpath(f,root)}}" alt={{f}}></a>
     <p>Result file stored in: {{os.path.relpath(f,root)}}</p>
 {%endfor%}
-{% if len(glob( os.path.join(outpath,"*/comp.image.png"))) == 0 %}
+{% if len(results) == 0 %}
     <p>No results have been generated yet</p>
 {% endif %}
 {% endblock %}'
@@ -92,7 +98,7 @@ def setup( indir, outdir, settings ):
         return False
 
     set_count = settings['set_count']
-    for j in range(3):
+    for j in range(settings.get('objects', 3)):
         o = '%s%d' % (settings['name'], j) # object name
         center = np.random.rand(2)
         for i in range(set_count):
@@ -107,7 +113,6 @@ def setup( indir, outdir, settings ):
     print("Output to: ", outdir)
     os.makedirs(outdir, exist_ok=True)
     crunchy.add(path = indir, depth=1, clear=False )
-    crunchy.add(path = outdir, depth=0, clear=False )
 
     # progress to stage 1
     settings['workflow_stage'] = 1
@@ -115,6 +120,18 @@ def setup( indir, outdir, settings ):
     return True
 
 
+@workerInit
+def worker_setup( state, settings ):
+    """
+    This will be called once in each worker thread, before it runs any jobs. It can be used to load reference data
+    or models that are needed by every job, so that this (potentially slow) setup is not repeated for each one.
+
+    :param state: a persistent object to store things in. This can be retrieved by workflow functions
+                  using crunchy.getWorkerState().
+    :param settings: Workflow settings dictionary.
+    """
+    state.rng = np.random.default_rng() # random number generator used to add noise
+
 """
 The following functions define the core of our workflow functionality.
 """
@@ -125,8 +142,8 @@ def build_image( data, outpath, settings ):
     :param data: A dictionary with data stored as keys. Data can be added or retrieved from this dictionary
                  to facilitate information sharing within different workflow steps (running in the same thread).
     :param outpath: A directory where any results should be written.
-    :param settings: A dictionary of settings that can be modified / changed by the GUI. Use for e.g. customisable
-                     arguments.
+    :param settings: A (read-only) dictionary of settings that can be changed by the GUI. Use for e.g. customisable
+                     arguments. Use crunchy.updateSettings(...) to change settings from within a workflow.
     :return: Anything returned by workflow functions will be ignored. Results should be written to files instead
              (as other methods for passing values between threads is slow and expensive).
     """
@@ -151,33 +168,49 @@ def build_image( data, outpath, settings ):
     cy = int(c[1] * ydim) # center of signal
 
     # fill it with random numbers and a nice wave pattern
-    # N.B. this is done with loops so as to be as sloow as possible ;-)
-    for x in range(xdim):
-        for y in range(ydim):
-
-            # populate with signal (sign wave)
-            r = np.sqrt( (x-cx)**2 + (y-cy)**2 )
-            arr[x,y,:] = np.sin( 32 * r / xdim) * a**(-np.clip(r / xdim, 0.5, 1.0 ) )
+    if settings.get('vectorise', False): # fast version
+        x, y = np.meshgrid( np.arange(xdim), np.arange(ydim), indexing='ij' )
+        r = np.sqrt( (x-cx)**2 + (y-cy)**2 )
+        arr[...] = ( np.sin( 32 * r / xdim) * a**(-np.clip(r / xdim, 0.5, 1.0 ) ) )[..., None]
+    else:
+        # N.B. this is done with loops so as to be as sloow as possible ;-)
+        for x in range(xdim):
+            for y in range(ydim):
+
+                # populate with signal (sign wave)
+                r = np.sqrt( (x-cx)**2 + (y-cy)**2 )
+                arr[x,y,:] = np.sin( 32 * r / xdim) * a**(-np.clip(r / xdim, 0.5, 1.0 ) )
 
     # store in data dictionary to make accessible to other functions
     data['image'] = arr
 
 def add_noise( data, outpath, settings ):
     sigma = settings['noise']
+    rng = crunchy.getWorkerState().rng # get random number generator created by worker_setup
     arr = data['image']
-    noise = np.zeros_like(arr)
-    for x in range(arr.shape[0]):
-        for y in range(arr.shape[1]):
-            for z in range(arr.shape[2]):
-                noise[x,y,z] = np.random.rand()*sigma
-                arr[x,y,z] += noise[x,y,z]
-
-    # write noisy image to output directory
+    if settings.get('vectorise', False): # fast version
+        noise = rng.random(arr.shape)*sigma
+        arr += noise
+    else:
+        noise = np.zeros_like(arr)
+        for x in range(arr.shape[0]):
+            for y in range(arr.shape[1]):
+                for z in range(arr.shape[2]):
+                    noise[x,y,z] = rng.random()*sigma
+                    arr[x,y,z] += noise[x,y,z]
+
+    # write noisy image to the output directory, and also publish it to the shared array store (if there is one,
+    # e.g. not on remote workers) so that the assembly step can usually use it without reloading it. N.B. the store
+    # is only a cache; arrays can be evicted from it at any time
     fname = "%s_%d.image.npy" % (data['name'], os.getpid())
     np.save( outpath / fname, arr )
+    store = crunchy.getArrayStore()
+    if store is not None:
+        store.publish( str(outpath / fname), arr )
+    data.setdefault('outputs', []).append( outpath / fname ) # tell downstream (job) triggers about this output
 
 def save_image( data, outpath, settings ):
-    fmt = settings['format']
+    fmt = data.get('format', settings['format']) # N.B. the format can be overridden for individual jobs
     name = data['name']
     arr = data['image']
 
@@ -194,6 +227,7 @@ def save_image( data, outpath, settings ):
     from PIL import Image # try importing PIL. This will fail if not installed
     image = Image.fromarray(arr)
     image.save(outpath / fname)
+    data.setdefault('outputs', []).append( outpath / fname ) # add to crunchy.getArtefacts()
 
 """
 And finally we define entry points that trigger the workflow execution. The simplest of these is a file filter,
@@ -224,29 +258,38 @@ def process( data, outpath, settings ):
     return trigger.REJECT, ''
 
 """
-We add a second file filter that averages the different images of each object together once they've been created 
-to reduce noise. This demonstrates how file filters can also be used to perform assembly steps on results.
+We add a job trigger that averages the different images of each object together once they've been created 
+to reduce noise. This runs as soon as all of the process jobs writing to an object's output directory have completed,
+and demonstrates how job triggers can be used to perform assembly steps on results.
 """
 def average( data, outpath, settings ):
-    # load data
+    # load data (from the shared array store if possible, to avoid reading files again)
     assert 'files' in data, "Error - files must be specified."
-    arr = np.array( [np.load(str(f))for f in data['files'] ] )
-    settings['workflow_stage'] = 2  # upgrade workflow stage (just to test settings can be modified)
+    store = crunchy.getArrayStore()
+    total = 0
+    for f in data['files']:
+        arr = None
+        if store is not None:
+            try:
+                arr = np.array( store.attach( str(f) ) )
+                store.release( str(f), discard=True ) # we don't need this anymore
+            except KeyError: # evicted (or never published)
+                pass
+        if arr is None:
+            arr = np.load(str(f))
+        total = total + arr
+    crunchy.updateSettings(workflow_stage=2)  # upgrade workflow stage (just to test settings can be modified)
     # average it
-    data['image'] = np.mean(arr, axis=0 )
+    data['image'] = total / len(data['files'])
 
-@fileTrigger(flow = [average, save_image], fail=crunchy.base.errors.logAndStop, vb=3)
+@jobTrigger(after='process', count=lambda settings: settings['set_count'],
+            flow = [average, save_image, makeThumbnails], fail=crunchy.base.errors.logAndStop, priority=1, vb=3)
 def assemble( data, outpath, settings ):
-    files = list( data['path'].glob("*.image.npy"))
-    comp = list( data['path'].glob("comp.image.png"))
-
     if settings['assemble']:
-        if len(files) == settings['set_count']: # check all preprocessing has been done
-            if len(comp) == 0: # check average hasn't already been created
-                data['files'] = files # store list of files to average
-                data['name'] ='comp' # output file name
-                settings['format'] = 'png' # force output format to be png
-                return trigger.PROCESS, data['path'] # output directory in same spot as input
+        data['files'] = [f for f in data['inputs'] if f.endswith('.image.npy')] # images made by process jobs
+        data['name'] ='comp' # output file name
+        data['format'] = 'png' # force output format to be png
+        return trigger.PROCESS, outpath # output directory in same spot as input
     return trigger.REJECT, ''
 
 @finish
@@ -10,6 +10,7 @@ setup(
     install_requires=[
           'multiprocess',
           'Flask',
+          'threadpoolctl',
       ],
     url='',
     license='',
@@ -1,5 +1,6 @@
 import unittest
 import os
+import sys
 from tempfile import mkdtemp
 from pathlib import Path
 import numpy as np
@@ -7,6 +8,77 @@ import time
 import shutil
 import crunchy
 
+def square(x):
+    return x**2
+
+def broken(x):
+    raise ValueError("Broken job %d" % x)
+
+def setting(key):
+    return crunchy.getSettings()[key]
+
+def noop(data, outpath, settings):
+    pass
+
+def acceptAll(data, outpath, settings):
+    from crunchy.base import trigger
+    return trigger.PROCESS, outpath
+
+def produce(name):
+    return dict(key=name, outputs=['%s/result.png' % name, '%s/result.npy' % name])
+
+def blas_threads():
+    import numpy
+    from threadpoolctl import threadpool_info
+    return [i['num_threads'] for i in threadpool_info() if i['user_api'] == 'blas']
+
+def sleepy(t, limit=None):
+    if limit is not None:
+        crunchy.limit(limit) # e.g. a step with a shorter time limit
+    time.sleep(t)
+    return t
+
+def locking(t):
+    with crunchy.getArrayStore().locked(): # e.g. killed while publishing an array
+        time.sleep(t)
+
+def dying(code):
+    os._exit(code)
+
+def flaky(marker):
+    if not os.path.exists(marker): # fail the first time
+        open(marker, 'w').close()
+        raise ValueError("Flaky job")
+    return 'ok'
+
+def loadModel(state, settings): # e.g. expensive setup (see test_worker_state)
+    state.pid = os.getpid()
+    state.jobs = 0
+
+def brokenInit(state, settings):
+    raise ValueError("Broken worker initialisation")
+
+def useModel():
+    state = crunchy.getWorkerState()
+    state.jobs += 1
+    return state.pid, os.getpid(), state.jobs
+
+CALLS = [] # workflow steps run in this thread (see test_checkpoint)
+
+def big_step(data, outpath, settings):
+    CALLS.append('big_step')
+    data['big'] = np.arange(300000.)
+
+def interrupted_step(data, outpath, settings):
+    if not os.path.exists(data['marker']): # fail the first time
+        open(data['marker'], 'w').close()
+        raise ValueError("Interrupted")
+    data['outputs'] = ['%.1f' % data['big'].sum()]
+
+def chatter(book, n):
+    for i in range(n):
+        book.write("Child message %d" % i, master=True)
+
 class MyTestCase(unittest.TestCase):
 
     @classmethod
@@ -66,6 +138,62 @@ class MyTestCase(unittest.TestCase):
         self.assertTrue(os.path.exists(outdir / 'randomthing.npy'))
         self.assertEqual( random[0], np.load(indir / 'randomthing.npy')[0]) # check the data was actually copied!
 
+    def test_mirror_copy(self):
+        from crunchy.base.mirror import _copy, _scrape_
+        src = self.base_path / self.input_path / 'Sensor1/Object1/data.npy'
+        dst = self.base_path / 'copyOut' / 'nested' / 'data.npy'
+        _copy( str(src), str(dst), bufsize=16 ) # N.B. small buffer to test fallback (if used)
+        self.assertEqual( src.read_bytes(), dst.read_bytes() )
+        self.assertEqual( int(os.stat(src).st_mtime), int(os.stat(dst).st_mtime) ) # metadata is copied too
+        self.assertEqual( ['data.npy'], os.listdir( dst.parent ) ) # no partial files left behind
+
+        # partial files are not mirrored
+        (dst.parent / '.crunchy-part-1234-x.npy').write_bytes(b'partial')
+        self.assertEqual( ['nested/data.npy'], list(_scrape_( str(dst.parent.parent), str(dst.parent.parent) ).keys()) )
+
+        # short copies (e.g. of files truncated while copying) fail rather than replacing the remote file
+        from crunchy.base.mirror import _transfer
+        with open(src, 'rb') as fi, open(dst.parent / 'short.npy', 'wb') as fo:
+            self.assertRaises( OSError, _transfer, fi, fo, os.stat(src).st_size + 10, 16 )
+
+    def test_mirror_manifest(self):
+        from crunchy.base.mirror import mirror, _sync, MANIFEST
+        indir = self.base_path / 'manifestIn'
+        outdir = self.base_path / 'manifestOut'
+        os.makedirs(indir, exist_ok=True)
+        data = np.random.bytes(1000)
+        (indir / 'blob.bin').write_bytes(data)
+        mirror(indir, outdir, debug=False, maxiter=2, sleeptime=0.1, manifest=True, chunksize=100)
+        self.assertEqual( data, (outdir / 'blob.bin').read_bytes() )
+        self.assertTrue( os.path.exists( outdir / MANIFEST ) )
+
+        # rewrite one chunk in place (same size) and append some data
+        data = data[:450] + b'x' * 10 + data[460:] + b'y' * 50
+        (indir / 'blob.bin').write_bytes(data)
+        mirror(indir, outdir, debug=False, maxiter=2, sleeptime=0.1, manifest=True, chunksize=100)
+        self.assertEqual( data, (outdir / 'blob.bin').read_bytes() )
+
+        # only changed chunks are sent
+        data = b'z' + data[1:]
+        (indir / 'blob.bin').write_bytes(data)
+        lentry, rentry, n = _sync( str(indir / 'blob.bin'), str(outdir / 'blob.bin'), None, None, 100 )
+        self.assertEqual( 1, n )
+        self.assertEqual( lentry['chunks'], rentry['chunks'] )
+        self.assertEqual( data, (outdir / 'blob.bin').read_bytes() )
+
+        # manifests are only stored if they change, and can be kept outside of the mirrored directories
+        mirror(indir, outdir, debug=False, maxiter=2, sleeptime=0.1, manifest=True, chunksize=100)
+        mtime = os.stat( outdir / MANIFEST ).st_mtime_ns
+        time.sleep(0.01)
+        mirror(indir, outdir, debug=False, maxiter=2, sleeptime=0.1, manifest=True, chunksize=100)
+        self.assertEqual( mtime, os.stat( outdir / MANIFEST ).st_mtime_ns )
+        shutil.rmtree( outdir )
+        mirror(indir, outdir, debug=False, maxiter=2, sleeptime=0.1, manifest=True, chunksize=100,
+               manifests=self.base_path / 'manifests')
+        self.assertEqual( data, (outdir / 'blob.bin').read_bytes() )
+        self.assertEqual( ['blob.bin'], os.listdir( outdir ) )
+        self.assertEqual( 2, len( os.listdir( self.base_path / 'manifests' ) ) )
+
     def test_scout(self):
         from crunchy.base.scout import scout
 
@@ -97,6 +225,334 @@ class MyTestCase(unittest.TestCase):
         # check that the other objects have been moved to the new files list
         self.assertTrue( str(self.base_path / 'DummyDataIn/Sensor1/Object2') in new_files)
 
+    def test_size_index(self):
+        from crunchy.base.scout import SizeIndex, _getFileSize
+        index = SizeIndex(strict=True, racy=0)
+        path = self.base_path / 'IndexTest'
+        os.makedirs(path / 'sub', exist_ok=True)
+        np.save(path / 'a.npy', np.full(100, 10))
+        np.save(path / 'sub' / 'b.npy', np.full(100, 10))
+
+        self.assertEqual(index.size(path), _getFileSize(path))
+        self.assertEqual(index.size(path), 1856)
+
+        # modify a file in place (this does not change the directory mtime)
+        np.save(path / 'sub' / 'b.npy', np.full(100, 10).astype(np.uint8))
+        self.assertEqual(index.size(path), _getFileSize(path))
+
+        # add and remove files
+        np.save(path / 'sub' / 'c.npy', np.full(100, 10))
+        os.remove(path / 'a.npy')
+        self.assertEqual(index.size(path), _getFileSize(path))
+        shutil.rmtree(path / 'sub')
+        self.assertEqual(index.size(path), 0)
+
+        # by default, files modified in place are only re-read once their directory is invalidated
+        index = SizeIndex(racy=0)
+        np.save(path / 'a.npy', np.full(100, 10))
+        self.assertEqual(index.size(path), 928)
+        np.save(path / 'a.npy', np.full(100, 10).astype(np.uint8))
+        self.assertEqual(index.size(path), 928)
+        index.invalidate(path)
+        self.assertEqual(index.size(path), _getFileSize(path))
+        self.assertEqual(len(index), 1)
+        shutil.rmtree(path)
+
+    def test_scout_inotify(self):
+        from crunchy.base import inotify
+        from crunchy.base.scout import scout
+        if not inotify.available():
+            self.skipTest("inotify is not available on this system.")
+
+        new_files = {}
+        known_files = {}
+        file_size_dict = {}
+        scout([self.base_path], depth=2, new_files=new_files, known_files=known_files,
+              file_size_dict=file_size_dict, wait=1, idle=0.1, maxiter=3, backend='inotify')
+
+        # all (stable) objects should have been found
+        self.assertTrue(str(self.base_path / 'DummyDataIn/Sensor2/Object3') in new_files)
+        self.assertEqual(len(file_size_dict), 0)
+
+        # mark them as known, then add a new object and check that only this is found
+        known_files.update(new_files)
+        new_files.clear()
+        os.makedirs(self.base_path / 'EventDataIn' / 'Sensor1' / 'Object4', exist_ok=True)
+
+        from threading import Thread
+        def write(): # add a file while the scout is waiting for events
+            time.sleep(0.2)
+            np.save(self.base_path / 'EventDataIn' / 'Sensor1' / 'Object4' / 'data.npy', np.full(100, 30))
+        t = Thread(target=write)
+        t.start()
+        scout([self.base_path], depth=2, new_files=new_files, known_files=known_files,
+              file_size_dict=file_size_dict, wait=1, idle=0.1, maxiter=10, backend='inotify')
+        t.join()
+        self.assertEqual(list(new_files.keys()), [str(self.base_path / 'EventDataIn/Sensor1/Object4')])
+
+        # a steady stream of events should not make new objects look stable any sooner
+        known_files.update(new_files)
+        new_files.clear()
+        os.makedirs(self.base_path / 'EventDataIn' / 'Sensor1' / 'Object5', exist_ok=True)
+        os.makedirs(self.base_path / 'EventDataIn' / 'Sensor2', exist_ok=True)
+        np.save(self.base_path / 'EventDataIn' / 'Sensor1' / 'Object5' / 'data.npy', np.full(100, 30))
+        from threading import Event
+        stop = Event()
+        def touch(): # generate events (and hence iterations) much faster than idle
+            i = 0
+            while not stop.is_set():
+                np.save(self.base_path / 'EventDataIn' / 'Sensor2' / ('Busy%d.npy' % (i % 10)), np.full(100, i))
+                time.sleep(0.01)
+                i += 1
+        t = Thread(target=touch)
+        t.start()
+        scout([self.base_path], depth=2, new_files=new_files, known_files=known_files,
+              file_size_dict=file_size_dict, wait=2, idle=2.0, maxiter=20, backend='inotify')
+        stop.set()
+        t.join()
+        self.assertEqual(len(new_files), 0)
+        shutil.rmtree(self.base_path / 'EventDataIn')
+
+        # fall back to polling if the kernel runs out of watches
+        import errno
+        def full(self, path):
+            raise OSError(errno.ENOSPC, "No space left on device")
+        add = inotify.Watcher.add
+        inotify.Watcher.add = full
+        try:
+            new_files.clear()
+            known_files.clear()
+            scout([self.base_path], depth=2, new_files=new_files, known_files=known_files,
+                  file_size_dict=file_size_dict, wait=1, idle=0.1, maxiter=3, backend='inotify')
+        finally:
+            inotify.Watcher.add = add
+        self.assertTrue(str(self.base_path / 'DummyDataIn/Sensor2/Object3') in new_files)
+
+    def test_ledger(self):
+        from crunchy.base.ledger import Ledger
+        from crunchy.base import trigger
+        ledger = Ledger(self.base_path / 'LedgerTest' / 'ledger.sqlite')
+        ledger.discovered({'a': 10, 'b': 20, 'c': 30, 'd': 40})
+        ledger.outcomes([('a', 'process', trigger.PROCESS), ('b', 'process', trigger.REJECT),
+                         ('c', 'process', trigger.WAIT), ('d', 'process', trigger.PROCESS)])
+        for s in range(3):
+            ledger.job('a', s) # queued, running, complete
+        ledger.job('d', 0) # queued only
+        ledger.close()
+
+        # reload and check that only completed (or rejected) files are known
+        ledger = Ledger(self.base_path / 'LedgerTest' / 'ledger.sqlite')
+        self.assertEqual(ledger.known(), {'a': 10, 'b': 20})
+        self.assertEqual(ledger.progress(), {'a': 2, 'd': 0})
+        ledger.produced([('a/out.png', 2.0, 'process', 'a'), ('d/out.png', 1.0, 'process', 'd')])
+        self.assertEqual(ledger.artefacts(), [('d/out.png', 1.0, 'process', 'd'), ('a/out.png', 2.0, 'process', 'a')])
+        self.assertEqual(ledger.artefacts(1), [('a/out.png', 2.0, 'process', 'a')])
+        ledger.close()
+        shutil.rmtree(self.base_path / 'LedgerTest')
+
+    def test_array_store(self):
+        from threading import Lock
+        from crunchy.base.shared import ArrayStore
+        store = ArrayStore(self.base_path / 'ArrayStore', {}, Lock(), limit=2 * 800)
+        a = np.arange(100, dtype=float)
+        store.publish('a', a)
+        b = store.attach('a')
+        self.assertTrue(np.all(a == b))
+
+        # fill the store; 'a' is attached so 'b' should be evicted instead
+        store.publish('b', a)
+        store.publish('c', a * 2)
+        self.assertEqual(sorted(store.names()), ['a', 'c'])
+        self.assertEqual(store.nbytes(), 1600)
+
+        # release 'a' and check it is removed
+        store.release('a', discard=True)
+        self.assertFalse('a' in store)
+        self.assertTrue(np.all(store.attach('c') == a * 2))
+
+        # arrays attached by threads that have died can be evicted again
+        entry = store.registry['c']
+        entry['refs'][1234] = 2 # e.g. also attached twice by a killed job
+        store.registry['c'] = entry
+        self.assertEqual(store.detach(os.getpid()), 1)
+        store.release('c') # N.B. not attached by this thread any more, so does nothing
+        self.assertEqual(store.detach(1234), 2)
+        store.publish('d', a)
+        store.publish('e', a)
+        self.assertEqual(sorted(store.names()), ['d', 'e'])
+        store.clear()
+        self.assertFalse(os.path.exists(self.base_path / 'ArrayStore'))
+
+    def test_scheduler(self):
+        from crunchy.base.scheduler import Scheduler
+        scheduler = Scheduler()
+        for i in range(6):
+            scheduler.add(dict(id='bulk%d' % i, trigger='bulk'))
+        for i in range(6):
+            scheduler.add(dict(id='light%d' % i, trigger='light', weight=2))
+        for i in range(2):
+            scheduler.add(dict(id='urgent%d' % i, trigger='urgent', priority=1))
+        self.assertEqual(len(scheduler), 14)
+        self.assertEqual(scheduler.counts(), dict(bulk=6, light=6, urgent=2))
+
+        # high priority jobs go first, then bulk and light share 1:2
+        order = [scheduler.pop()['trigger'] for i in range(14)]
+        self.assertEqual(order[:2], ['urgent', 'urgent'])
+        self.assertEqual(order[2:11].count('light'), 6)
+        self.assertIsNone(scheduler.pop())
+
+        # a trigger that was idle should not monopolise workers when it becomes active again
+        for i in range(4):
+            scheduler.add(dict(id='bulk%d' % i, trigger='bulk'))
+            scheduler.add(dict(id='light%d' % i, trigger='light'))
+        order = [scheduler.pop()['trigger'] for i in range(4)]
+        self.assertEqual(sorted(order), ['bulk', 'bulk', 'light', 'light'])
+
+    def test_job_trigger(self):
+        from crunchy.base import trigger
+        seen = []
+        @trigger.jobTrigger(after='upstream', count=lambda settings: settings['n'], flow=[])
+        def downstream(data, outpath, settings):
+            seen.append(data)
+            return trigger.REJECT, ''
+        crunchy.entries.pop('downstream') # don't leave this registered for other tests
+
+        def record(path, key, error=None, name='upstream'):
+            return dict(trigger=name, path=path, error=error, queued=0, started=0, finished=0,
+                        result=dict(key=key, outputs=[path + '/out.npy']))
+        settings = dict(n=2)
+        self.assertEqual(downstream(record('a1', 'a'), settings), trigger.WAIT)
+        self.assertEqual(downstream(record('b1', 'b'), settings), trigger.WAIT)
+        self.assertEqual(downstream(record('a2', 'a', error='Failed'), settings), trigger.REJECT) # failed jobs don't count
+        self.assertEqual(downstream(record('a2', 'a', name='other'), settings), trigger.REJECT) # nor do other triggers
+        self.assertEqual(downstream(record('a1', 'a'), settings), trigger.WAIT) # nor do repeated jobs for one path
+        self.assertEqual(len(seen), 0)
+        self.assertEqual(downstream(record('a2', 'a'), settings), trigger.REJECT) # fired (and returned REJECT)
+        self.assertEqual(len(seen), 1)
+        self.assertEqual(seen[0]['key'], 'a')
+        self.assertEqual(sorted(seen[0]['inputs']), ['a1/out.npy', 'a2/out.npy'])
+
+        # rebuild groups from the ledger, e.g. after a restart
+        from crunchy.base.ledger import Ledger
+        ledger = Ledger(self.base_path / 'LedgerTest' / 'ledger.sqlite')
+        for r in [record('c1', 'c'), record('c2', 'c'), record('d1', 'd'), record('e1', 'e'), record('e2', 'e')]:
+            ledger.finished(r)
+        ledger.finished(dict(record('e', 'e', name='downstream'), result=None)) # already assembled
+        del seen[:]
+        downstream.restore(ledger, settings)
+        self.assertEqual([d['key'] for d in seen], ['c'])
+        self.assertEqual(downstream(record('d2', 'd'), settings), trigger.REJECT) # counts jobs from before the restart
+        self.assertEqual([d['key'] for d in seen], ['c', 'd'])
+
+        # groups are kept until the trigger stops waiting
+        ready = []
+        @trigger.jobTrigger(after='upstream', count=1, flow=[])
+        def patient(data, outpath, settings):
+            seen.append(data)
+            return (trigger.REJECT if ready else trigger.WAIT), ''
+        crunchy.entries.pop('patient')
+        self.assertEqual(patient(record('f1', 'f'), settings), trigger.WAIT)
+        ready.append(True)
+        self.assertEqual(patient(record('f2', 'f'), settings), trigger.REJECT)
+        self.assertEqual(sorted(seen[-1]['inputs']), ['f1/out.npy', 'f2/out.npy'])
+        self.assertEqual(patient(record('f3', 'f'), settings), trigger.REJECT)
+        self.assertEqual(seen[-1]['inputs'], ['f3/out.npy']) # a new group
+        ledger.close()
+        shutil.rmtree(self.base_path / 'LedgerTest')
+
+    def test_log(self):
+        from multiprocess import Queue, Process
+        from crunchy.base.logs import LogBook
+        book = LogBook(Queue(), maxlen=5)
+        book.start()
+        book.setFile(self.base_path / 'LogTest' / 'crunchy.log')
+        for i in range(10):
+            book.write("Message %d" % i)
+        p = Process(target=chatter, args=(book, 8))
+        p.start()
+        p.join()
+        book.flush()
+
+        # only the most recent messages are kept in memory
+        self.assertEqual(len(book.tail(os.getpid())), 5)
+        self.assertTrue(book.tail(os.getpid())[-1].endswith("Message 9."))
+        self.assertEqual(len(book.tail(p.pid, 2)), 2)
+        self.assertTrue(book[p.pid].strip().endswith("Child message 7."))
+        self.assertEqual(sorted(book.keys(), key=str), sorted(['master', os.getpid(), p.pid], key=str))
+
+        # but everything is written to file
+        book.close()
+        with open(self.base_path / 'LogTest' / 'crunchy.log') as f:
+            self.assertEqual(len(f.readlines()), 18)
+        shutil.rmtree(self.base_path / 'LogTest')
+
+    def test_listing(self):
+        from crunchy.app.listing import ListingCache
+        path = self.base_path / 'ListingTest'
+        for i in range(12):
+            os.makedirs(path / ('dir%d' % i), exist_ok=True)
+            np.save(path / ('file%d.npy' % i), np.zeros(1))
+        cache = ListingCache(racy=0)
+        dirs, files = cache.list(path)
+        self.assertEqual(dirs[:3], ['dir0', 'dir1', 'dir2']) # natural sorting
+        self.assertEqual(len(files), 12)
+        self.assertTrue(cache.list(path)[0] is dirs) # cached
+
+        # pages contain directories first, then files
+        d, f, pages = cache.page(path, page=2, per=10)
+        self.assertEqual((d, f, pages), (['dir10', 'dir11'], ['file%d.npy' % i for i in range(8)], 3))
+        d, f, pages = cache.page(path, page=1, per=10, q='FILE1*')
+        self.assertEqual((d, f, pages), ([], ['file1.npy', 'file10.npy', 'file11.npy'], 1))
+
+        # changes are picked up
+        os.remove(path / 'file0.npy')
+        time.sleep(0.01)
+        self.assertEqual(len(cache.list(path)[1]), 11)
+        shutil.rmtree(path)
+
+    def test_preview(self):
+        from crunchy.base import preview
+        from PIL import Image
+        path = self.base_path / 'PreviewTest'
+        cache = path / 'cache'
+        os.makedirs(path, exist_ok=True)
+        np.save(path / 'big.npy', np.random.rand(600, 1000, 5)) # height, width, bands
+        Image.fromarray((np.random.rand(300, 200, 3) * 255).astype(np.uint8)).save(path / 'small.png')
+
+        # thumbnails
+        t = preview.thumbnail(path / 'big.npy', 128, cache=cache)
+        self.assertEqual(Image.open(t).size, (128, 77))
+        self.assertEqual(Image.open(preview.thumbnail(path / 'small.png', 64, cache=cache)).size, (43, 64))
+        mtime = os.stat(t).st_mtime_ns
+        self.assertEqual(preview.thumbnail(path / 'big.npy', 128, cache=cache), t) # cached
+        np.save(path / 'big.npy', np.random.rand(300, 300)) # changes should invalidate the cache
+        os.utime(path / 'big.npy', ns=(mtime + 10**9, mtime + 10**9))
+        self.assertEqual(Image.open(preview.thumbnail(path / 'big.npy', 128, cache=cache)).size, (128, 128))
+
+        # tiles
+        self.assertEqual(preview.info(path / 'big.npy')['maxzoom'], 1)
+        self.assertEqual(Image.open(preview.tile(path / 'big.npy', 0, 0, 0, cache=cache)).size, (150, 150))
+        self.assertEqual(Image.open(preview.tile(path / 'big.npy', 1, 1, 0, cache=cache)).size, (44, 256))
+        self.assertRaises(ValueError, preview.tile, path / 'big.npy', 1, 2, 0, cache=cache)
+        np.save(path / 'cube.npy', np.zeros((4, 30, 20, 3))) # arrays with more than 3 dimensions can't be previewed
+        self.assertRaises(ValueError, preview.thumbnail, path / 'cube.npy', 32, cache=cache)
+
+        # images that must be decoded in full are only decoded once for all of their tiles
+        Image.fromarray((np.random.rand(300, 600, 3) * 255).astype(np.uint8)).save(path / 'wide.png')
+        preview._decoded.clear()
+        self.assertEqual(Image.open(preview.tile(path / 'wide.png', 2, 0, 0, cache=cache)).size, (256, 256))
+        self.assertEqual(Image.open(preview.tile(path / 'wide.png', 2, 2, 1, cache=cache)).size, (88, 44))
+        self.assertEqual(len(preview._decoded), 1)
+
+        # images with too many pixels are refused
+        limit = Image.MAX_IMAGE_PIXELS
+        try:
+            Image.MAX_IMAGE_PIXELS = 1000
+            self.assertRaises(preview.TooLarge, preview.thumbnail, path / 'wide.png', 32, cache=cache)
+        finally:
+            Image.MAX_IMAGE_PIXELS = limit
+        shutil.rmtree(path)
+
     def test_workers(self):
         """
         Setup crunchy queue then tear it down, and check that threads are initialising correctly etc.
@@ -134,6 +590,387 @@ class MyTestCase(unittest.TestCase):
             if isinstance(k, int):
                 self.assertTrue('complete' in v.lower())
 
+    def test_futures(self):
+        """
+        Submit jobs directly and check that their futures are resolved (including while paused).
+        """
+        from crunchy.base.errors import JobError
+        crunchy.init(2)
+        crunchy.pause()
+        futures = [crunchy.submit(square, (i,), path='job%d' % i) for i in range(5)]
+        self.assertFalse(crunchy.wait(timeout=1.0)) # nothing should run while paused
+        self.assertEqual(len(crunchy.getProgress(0)), 5)
+
+        # blocking jobs run in this thread, and their records are collected with the others (e.g. by job triggers)
+        blocked = crunchy.submit(square, (6,), path='blocked', block=True)
+        self.assertEqual(blocked.result(), 36)
+        self.assertEqual([r['path'] for r in crunchy.collect()], ['blocked'])
+        retried = crunchy.submit(broken, (2,), path='retried', block=True, retries=1, backoff=0)
+        self.assertFalse(retried.done()) # N.B. failed, so passed to the workers to retry
+        crunchy.resume()
+        failed = crunchy.submit(broken, (1,), path='broken')
+        self.assertTrue(crunchy.wait(timeout=30.0))
+        self.assertEqual([f.result() for f in futures], [0, 1, 4, 9, 16])
+        self.assertTrue(futures[0].record['duration'] >= 0)
+        self.assertRaises(JobError, failed.result)
+        self.assertRaises(JobError, retried.result)
+        self.assertEqual(retried.record['attempt'], 2)
+        self.assertEqual(sorted(crunchy.getProgress(-1)), ['broken', 'retried'])
+        self.assertEqual(len(crunchy.getProgress(2)), 6) # including the blocking job
+        crunchy.complete()
+
+    def test_remote(self):
+        """
+        Run jobs on workers connected over TCP, and check that jobs leased by dead workers are requeued.
+        """
+        from crunchy.base.remote import connect
+        from multiprocess.connection import AuthenticationError
+        crunchy.init(0) # no local workers
+        address = crunchy.listen(('localhost', 0), timeout=5.0)
+        key = crunchy.coordinator.authkey # generated
+        self.assertNotEqual(key, b'crunchy')
+        self.assertRaises(AuthenticationError, connect, address, b'crunchy')
+        futures = [crunchy.submit(square, (i,), path='job%d' % i) for i in range(4)]
+
+        # lease a job then die without finishing it
+        link = connect(address, key)
+        link.recv()
+        link.send(('LEASE',))
+        self.assertEqual(link.recv()[0], 'EXEC')
+        link.close()
+
+        workers = crunchy.connect(address, key, nworkers=2, heartbeat=0.5)
+        self.assertTrue(crunchy.wait(timeout=30.0))
+        self.assertEqual([f.result() for f in futures], [0, 1, 4, 9])
+        self.assertTrue(all(f.record['pid'] in [w.pid for w in workers] for f in futures))
+        crunchy.complete()
+        for w in workers:
+            w.join(10.0)
+            self.assertFalse(w.is_alive())
+
+    def test_autoscale(self):
+        """
+        Check the number of workers chosen by the autoscaler, and that the pool can be resized while running.
+        """
+        from crunchy.base.autoscale import target
+        s = dict(minthreads=1, maxthreads=4, scaletime=10)
+        self.assertEqual(target(2, 0, None, s), 1) # idle
+        self.assertEqual(target(1, 3, None, s), 3) # one worker per job
+        self.assertEqual(target(1, 100, None, s), 4) # up to the maximum
+        self.assertEqual(target(1, 100, 0.2, s), 2) # short jobs: 100 x 0.2 s in 10 s
+        self.assertEqual(target(2, 100, None, s, load=2.0), 2) # host is busy; don't grow
+        self.assertEqual(target(3, 100, None, s, memory=0.01), 2) # low on memory; shrink
+
+        crunchy.init(1)
+        crunchy.resize(3)
+        self.assertEqual(crunchy.capacity.value, 3)
+        self.assertEqual(len([w for w in crunchy.workers if w.is_alive()]), 3)
+        crunchy.resize(1)
+        self.assertEqual(crunchy.capacity.value, 1)
+        for w in crunchy.workers[1:]:
+            w.join(10.0)
+            self.assertFalse(w.is_alive()) # retired
+        future = crunchy.submit(square, (3,))
+        self.assertTrue(crunchy.wait(timeout=30.0))
+        self.assertEqual(future.result(), 9)
+        self.assertTrue(crunchy.jobtime.value > 0)
+        crunchy.complete()
+
+    def test_admission(self):
+        """
+        Check that jobs are only dispatched while they fit in the memory and core budget, and that thread limits are set.
+        """
+        from crunchy.base.scheduler import Scheduler
+        crunchy.init(0) # no workers, so dispatched jobs stay in the queue
+        crunchy.updateSettings(memorymb=1000, cores=3)
+        crunchy.scheduler = Scheduler()
+        crunchy.capacity.value = 10
+        for i, m in enumerate([600, 300, 600, 100, 0]):
+            crunchy.scheduler.add(dict(id='job%d' % i, trigger='big', memory=m, cores=1))
+        crunchy.dispatch()
+        self.assertEqual(list(crunchy._dispatched), ['job0', 'job1']) # job2 doesn't fit (and job3 waits behind it)
+        crunchy._dispatched.pop('job0')
+        crunchy.dispatch()
+        self.assertEqual(list(crunchy._dispatched), ['job1', 'job2', 'job3'])
+        crunchy._dispatched.pop('job1')
+        crunchy.dispatch()
+        self.assertEqual(list(crunchy._dispatched), ['job2', 'job3', 'job4']) # limited by cores
+        crunchy.scheduler = None
+        crunchy._dispatched.clear()
+        crunchy.complete()
+
+        crunchy.init(1)
+        futures = [crunchy.submit(blas_threads, threads=t) for t in [3, 1, None]]
+        self.assertTrue(crunchy.wait(timeout=30.0))
+        n = [f.result() for f in futures]
+        if len(n[0]) > 0: # N.B. numpy may not be linked to a BLAS library that threadpoolctl can control
+            self.assertEqual([set(v) for v in n], [{3}, {1}, {1}]) # N.B. threads defaults to cores (1)
+        crunchy.complete()
+
+    def test_watchdog(self):
+        """
+        Check that jobs that take too long are killed, that dead workers are replaced, and that failed jobs are
+        retried or added to the dead letters.
+        """
+        from crunchy.base.errors import JobError
+        crunchy.init(1)
+        worker = crunchy.workers[0]
+        hung = crunchy.submit(sleepy, (60,), path='hung', timeout=0.5, retries=1, backoff=0.1)
+        stuck = crunchy.submit(sleepy, (60, 0.5), path='stuck', isolate=True)
+        locked = crunchy.submit(locking, (60,), path='locked', timeout=0.5)
+        ok = crunchy.submit(square, (2,), path='ok')
+        retried = crunchy.submit(flaky, (str(self.base_path / 'flaky.txt'),), path='flaky', retries=2, backoff=0.1)
+        self.assertTrue(crunchy.wait(timeout=60.0))
+        self.assertEqual(ok.result(), 4)
+        self.assertEqual(retried.result(), 'ok')
+        self.assertRaises(JobError, hung.result)
+        dead = crunchy.getDeadLetters()
+        self.assertEqual(sorted([d['path'] for d in dead]), ['hung', 'locked', 'stuck'])
+        self.assertEqual([d['attempts'] for d in dead if d['path'] == 'hung'], [2])
+        self.assertTrue(all('TimeoutError' in d['error'] for d in dead))
+        self.assertTrue(worker.is_alive()) # only the jobs were killed
+        crunchy.getArrayStore().publish('after', np.arange(3)) # N.B. the lock was released
+
+        # workers that die are replaced
+        died = crunchy.submit(dying, (3,), path='died')
+        self.assertTrue(crunchy.wait(timeout=60.0))
+        self.assertRaises(JobError, died.result)
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(len([w for w in crunchy.workers if w.is_alive() and not w.retire.is_set()]), 1)
+        self.assertTrue('died' in crunchy.getDeadLetters()[-1]['error'])
+        crunchy.complete()
+
+    def test_control(self):
+        """
+        Check that futures of jobs submitted by the main thread are resolved (and failed jobs retried) while the
+        control thread collects job records.
+        """
+        inpath = self.base_path / 'controlIn'
+        os.makedirs(inpath, exist_ok=True)
+        saved = dict(setup=dict(crunchy.setup), finalize=dict(crunchy.finalize), entries=dict(crunchy.entries))
+        for k in saved: # run without a workflow
+            getattr(crunchy, k).clear()
+        try:
+            crunchy.init(1)
+            crunchy.setInpath(inpath)
+            crunchy.setOutpath(self.base_path / 'controlOut')
+            crunchy.add(inpath, 1)
+            crunchy.run()
+            self.assertTrue(crunchy._controlling())
+            ok = crunchy.submit(square, (3,), path='ok')
+            retried = crunchy.submit(flaky, (str(self.base_path / 'control.txt'),), path='flaky', retries=1,
+                                     backoff=0.1)
+            self.assertEqual(ok.result(timeout=30.0), 9)
+            self.assertEqual(retried.result(timeout=30.0), 'ok')
+            self.assertTrue(crunchy.wait(timeout=10.0))
+            crunchy.complete()
+        finally:
+            for k, v in saved.items():
+                getattr(crunchy, k).update(v)
+
+    def test_backlog(self):
+        """
+        Check that files found by the scout wait in the backlog while the job queue is full (see maxqueue).
+        """
+        from crunchy.base import trigger
+        inpath = self.base_path / 'backlogIn'
+        os.makedirs(inpath, exist_ok=True)
+        for i in range(6):
+            np.save(inpath / ('file%d.npy' % i), np.zeros(10))
+        saved = dict(setup=dict(crunchy.setup), finalize=dict(crunchy.finalize), entries=dict(crunchy.entries))
+        for k in saved: # run with only the trigger below
+            getattr(crunchy, k).clear()
+        options = {k: crunchy.crunchy_settings[k]['value'] for k in ['wait', 'idle', 'maxqueue']}
+        crunchy.crunchy_settings['wait']['value'] = 1
+        crunchy.crunchy_settings['idle']['value'] = 0.1
+        crunchy.crunchy_settings['maxqueue']['value'] = 2
+        try:
+            trigger.fileTrigger(flow=[noop])(acceptAll)
+            crunchy.init(1)
+            crunchy.setInpath(inpath)
+            crunchy.setOutpath(self.base_path / 'backlogOut')
+            crunchy.add(inpath, 0)
+            crunchy.pause() # N.B. so jobs stay queued
+            crunchy.run()
+            start = time.time()
+            while crunchy.getScoutStats()['backlog'] != 3 and time.time() - start < 30:
+                time.sleep(0.1)
+            self.assertEqual(crunchy.getScoutStats()['backlog'], 3) # one job passed to the worker, two held
+            self.assertEqual(len(crunchy.getProgress(0)), 3)
+            crunchy.resume()
+            while len(crunchy.getProgress(2)) < 6 and time.time() - start < 60:
+                time.sleep(0.1)
+            self.assertEqual(len(crunchy.getProgress(2)), 6)
+            self.assertEqual(crunchy.getScoutStats()['backlog'], 0)
+            crunchy.complete()
+        finally:
+            for k, v in options.items():
+                crunchy.crunchy_settings[k]['value'] = v
+            for k, v in saved.items():
+                getattr(crunchy, k).clear()
+                getattr(crunchy, k).update(v)
+
+    def test_checkpoint(self):
+        """
+        Check that jobs resume from the last completed workflow step.
+        """
+        from crunchy.base.trigger import _job
+        from crunchy.base.errors import logAndStop
+        from crunchy.base import checkpoint
+        outdir = self.base_path / 'checkpointOut'
+        crunchy.init(0)
+        crunchy.setOutpath(outdir)
+        data = dict(path=Path('object1'), marker=str(self.base_path / 'interrupted.txt'))
+        flow = [big_step, interrupted_step]
+        with self.assertRaises(ValueError):
+            _job(flow, logAndStop, crunchy.getLogDict(), dict(data), outdir, checkpoint=True)
+        folder = checkpoint.getFolder(data, flow, outdir)
+        step, saved = checkpoint.load(folder)
+        self.assertEqual(step, 1)
+        self.assertIsInstance(saved['big'], np.memmap)
+
+        result = _job(flow, logAndStop, crunchy.getLogDict(), dict(data), outdir, checkpoint=True)
+        self.assertEqual(result['outputs'], ['%.1f' % np.arange(300000.).sum()])
+        self.assertEqual(CALLS, ['big_step']) # not run again
+        self.assertFalse(folder.exists()) # removed once complete
+
+        # checkpoints are not resumed once the input has changed, and are removed if the job is dead-lettered
+        from crunchy.base.trigger import _discard
+        source = self.base_path / 'checkpointIn'
+        os.makedirs(source, exist_ok=True)
+        (source / 'a.txt').write_text('first')
+        sig = checkpoint.signature(source)
+        data = dict(data, path=source, marker=str(self.base_path / 'interrupted2.txt'))
+        folder = checkpoint.getFolder(data, flow, outdir, sig)
+        with self.assertRaises(ValueError):
+            _job(flow, logAndStop, crunchy.getLogDict(), dict(data), outdir, checkpoint=True, signature=sig)
+        self.assertTrue(folder.exists())
+        (source / 'a.txt').write_text('second version')
+        self.assertNotEqual(checkpoint.signature(source), sig)
+        _discard(dict(func=_job, args=(flow, logAndStop, None, data, outdir), kwargs=dict(checkpoint=True,
+                                                                                         signature=sig)))
+        self.assertFalse(folder.exists())
+
+        # without a signature (e.g. job triggers) the folder only depends on the path
+        folder = checkpoint.getFolder(data, flow, outdir)
+        (source / 'b.txt').write_text('written by the flow')
+        self.assertEqual(checkpoint.getFolder(data, flow, outdir), folder)
+        crunchy.complete()
+
+    def test_settings(self):
+        """
+        Check that workers see settings changed with updateSettings, and that their copy is read-only.
+        """
+        crunchy.init(2)
+        crunchy.updateSettings(workflow_stage=1, name='first')
+        first = crunchy.submit(setting, ('name',))
+        self.assertTrue(crunchy.wait(timeout=30.0))
+        self.assertEqual(first.result(), 'first')
+        crunchy.updateSettings({'name': 'second'})
+        futures = [crunchy.submit(setting, ('name',)) for i in range(4)]
+        self.assertTrue(crunchy.wait(timeout=30.0))
+        self.assertEqual([f.result() for f in futures], ['second'] * 4)
+        self.assertEqual(crunchy.settings['name'], 'second')
+        s = crunchy.getSettings()
+        self.assertEqual(s['workflow_stage'], 1)
+        with self.assertRaises(TypeError):
+            s['name'] = 'third'
+        crunchy.complete()
+
+    def test_worker_state(self):
+        """
+        Check that @workerInit functions run once in each worker process, and that their state persists between jobs.
+        """
+        from crunchy.base.trigger import workerInit
+        workerInit(loadModel)
+        try:
+            crunchy.init(2)
+            futures = [crunchy.submit(useModel) for i in range(10)]
+            self.assertTrue(crunchy.wait(timeout=30.0))
+            results = [f.result() for f in futures]
+            for pid, worker, jobs in results:
+                self.assertEqual(pid, worker) # initialised in the worker process that ran the job
+                self.assertNotEqual(pid, os.getpid())
+            for worker in set(r[1] for r in results):
+                jobs = sorted(r[2] for r in results if r[1] == worker)
+                self.assertEqual(jobs, list(range(1, len(jobs) + 1))) # N.B. not initialised again for each job
+            crunchy.complete()
+
+            # errors are reported (without a log) if the state is needed before init()
+            crunchy.workerinit.pop('loadModel')
+            workerInit(brokenInit)
+            logdict, crunchy.logdict, crunchy.worker_state = crunchy.logdict, None, None
+            try:
+                self.assertFalse(hasattr(crunchy.getWorkerState(), 'pid'))
+            finally:
+                crunchy.logdict, crunchy.worker_state = logdict, None
+        finally:
+            for k in ['loadModel', 'brokenInit']:
+                crunchy.workerinit.pop(k, None)
+
+    def test_artefacts(self):
+        """
+        Check that outputs of completed jobs are added to the artefact index.
+        """
+        crunchy.init(2)
+        self.assertEqual(crunchy.getArtefacts(), [])
+        for i in range(3):
+            crunchy.submit(produce, ('object%d' % i,))
+        crunchy.submit(broken, (1,)) # failed jobs don't produce anything
+        self.assertTrue(crunchy.wait(timeout=30.0))
+        self.assertEqual(len(crunchy.getArtefacts()), 6)
+        self.assertEqual(sorted(crunchy.getArtefacts('*.png')), ['object%d/result.png' % i for i in range(3)])
+        crunchy.submit(produce, ('object3',), block=True)
+        self.assertEqual(len(crunchy.getArtefacts('*.png')), 4)
+        crunchy.submit(produce, ('object0',), block=True) # produced again, so now the most recent
+        self.assertEqual(crunchy.getArtefacts('*.png')[-1], 'object0/result.png')
+        self.assertEqual(len(crunchy.getArtefacts()), 8)
+
+        # only the most recent artefacts are kept
+        crunchy.updateSettings(maxartefacts=3)
+        crunchy.submit(produce, ('object4',), block=True)
+        self.assertEqual(crunchy.getArtefacts(), ['object0/result.npy', 'object4/result.png', 'object4/result.npy'])
+        self.assertEqual(len(crunchy.artefacts), 3)
+
+        # the index can be read by several threads (e.g. of the app) while it grows
+        import threading
+        crunchy.updateSettings(maxartefacts=1000)
+        errors = []
+        def read(i):
+            try:
+                for j in range(500):
+                    crunchy.getArtefacts('*%d/*' % (i * 1000 + j)) # N.B. a new query each time
+            except Exception as e:
+                errors.append(e)
+        readers = [threading.Thread(target=read, args=(i,)) for i in range(4)]
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            for t in readers:
+                t.start()
+            for i in range(200):
+                crunchy.addArtefacts([dict(error=None, result=produce('many%d' % i), finished=0, trigger=None)])
+            for t in readers:
+                t.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(errors, [])
+        self.assertEqual(crunchy.getArtefacts('*199/*'), ['many199/result.png', 'many199/result.npy'])
+        crunchy.complete()
+
+    def test_history(self):
+        """
+        Check that only the most recently completed jobs are kept in the progress dictionary.
+        """
+        crunchy.init(2)
+        crunchy.updateSettings(history=3)
+        for i in range(6):
+            crunchy.submit(square, (i,), path='job%d' % i)
+        crunchy.submit(broken, (1,), path='broken')
+        self.assertTrue(crunchy.wait(timeout=30.0))
+        self.assertEqual(len(crunchy.getProgress(2)), 3)
+        self.assertEqual(crunchy.getProgress(-1), ['broken']) # failures are not forgotten
+        crunchy.complete()
 
 if __name__ == '__main__':
     unittest.main()
@@ -85,6 +85,27 @@ class MyTestCase(unittest.TestCase):
         print("Saving image...", end='')
         save_image(data, outdir, crunchy.settings)
 
+    def test_vectorised(self):
+        """
+        Check that the vectorised versions of the workflow functions give the same result as the (slow) loops.
+        """
+        import numpy as np
+        from crunchy.workflows.dummy import build_image
+        outdir = self.base_path / self.output_path
+        os.makedirs(outdir, exist_ok=True)
+        np.save(outdir / 'center.npy', np.array([0.3, 0.6]))
+        settings = dict(self.settings)
+        settings['xdim'] = settings['ydim'] = 256
+
+        images = []
+        for vectorise in [False, True]:
+            np.random.seed(42) # same signal amplitude
+            data = dict(input=outdir / 'center.npy', name='test')
+            settings['vectorise'] = vectorise
+            build_image(data, outdir, settings)
+            images.append(data['image'])
+        self.assertTrue(np.allclose(images[0], images[1]))
+
     def test_file_trigger(self):
         import crunchy.workflows.dummy
 